@@ -1,23 +1,65 @@
 import sys
 import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional, Tuple
 import asyncio
 import re
+import threading
+import weakref
 import json
-from openai import OpenAI
+import hashlib
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 from dotenv import load_dotenv
 from config.logging_config import logger
+from config.settings import (
+    OPENAI_MODEL,
+    OPENAI_TIMEOUT,
+    OPENAI_MAX_CONCURRENT_REQUESTS,
+    OPENAI_MAX_CONNECTIONS
+)
 from agents.base_agent import BaseAgent
-from data_processing.document_parser import extract_text_from_pdf
+from data_processing.document_parser import extract_text_from_pdf_async, PdfSource
 from data_processing.ocr_helper import ocr_process_image
 from data_processing.confidence_scoring import compute_confidence_score
-from data_processing.rag_helper import InvoiceRAGIndex
+from data_processing.rag_helper import get_rag_index
+from data_processing.extraction_cache import get_extraction_cache, hash_document, make_cache_key
 from models.invoice import InvoiceData
 from decimal import Decimal
 
 load_dotenv()  # Load environment variables from .env
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+# Async clients and semaphores are bound to the event loop that first uses them,
+# so each running loop gets its own pair; entries go away with their loop
+_loop_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Tuple[AsyncOpenAI, asyncio.Semaphore]]" = weakref.WeakKeyDictionary()
+_loop_clients_lock = threading.Lock()
+
+def get_openai_client() -> Tuple[AsyncOpenAI, asyncio.Semaphore]:
+    """
+    Return the running loop's shared OpenAI client (one pooled HTTP connection
+    set for every extraction on the loop) and the semaphore capping in-flight
+    completions so a burst of invoices cannot exhaust the pool or rate limits.
+    """
+    loop = asyncio.get_running_loop()
+    with _loop_clients_lock:
+        pair = _loop_clients.get(loop)
+        if pair is None:
+            client = AsyncOpenAI(
+                api_key=os.getenv("OPENAI_API_KEY"),
+                timeout=OPENAI_TIMEOUT,
+                http_client=DefaultAsyncHttpxClient(
+                    limits=httpx.Limits(
+                        max_connections=OPENAI_MAX_CONNECTIONS,
+                        max_keepalive_connections=OPENAI_MAX_CONNECTIONS
+                    )
+                )
+            )
+            pair = _loop_clients[loop] = (client, asyncio.Semaphore(OPENAI_MAX_CONCURRENT_REQUESTS))
+        return pair
+
+EXTRACTION_PROMPT = "Extract the following fields from the invoice text and return them in JSON format: vendor_name, invoice_number, invoice_date, total_amount. Ensure total_amount is a numeric string without currency symbols."
+# Cached extractions are only reused while the model and prompt stay the same
+EXTRACTION_VERSION = hashlib.sha256(f"{OPENAI_MODEL}\n{EXTRACTION_PROMPT}".encode()).hexdigest()[:16]
 
 class InvoiceExtractionTool:
     """A simple tool to extract structured invoice data as a fallback."""
@@ -49,43 +91,87 @@ class InvoiceExtractionAgent(BaseAgent):
     def __init__(self):
         super().__init__()
         self.tools = [InvoiceExtractionTool()]
-        self.rag_index = InvoiceRAGIndex()
+        self.rag_index = get_rag_index()  # Shared by every workflow in the process
+        self.cache = get_extraction_cache()
 
-    async def run(self, document_path: str) -> InvoiceData:
-        logger.info(f"Processing document: {document_path}")
-        if document_path.lower().endswith(".pdf"):
-            invoice_text = extract_text_from_pdf(document_path)
-        else:
-            invoice_text = ocr_process_image(document_path)
+    async def _extract_with_openai(self, invoice_text: str) -> Dict:
+        """Extract invoice fields with a non-blocking OpenAI call bounded by a timeout."""
+        client, semaphore = get_openai_client()
+        async with semaphore:
+            response = await client.chat.completions.create(
+                model=OPENAI_MODEL,
+                messages=[
+                    {"role": "system", "content": EXTRACTION_PROMPT},
+                    {"role": "user", "content": invoice_text}
+                ],
+                response_format={"type": "json_object"},
+                timeout=OPENAI_TIMEOUT
+            )
+        json_data = json.loads(response.choices[0].message.content)
+        return {
+            "vendor_name": json_data.get("vendor_name", ""),
+            "invoice_number": json_data.get("invoice_number", ""),
+            "invoice_date": json_data.get("invoice_date", ""),
+            "total_amount": json_data.get("total_amount", "")
+        }
 
-        # Check RAG for similar invoices
-        rag_result = self.rag_index.classify_invoice(invoice_text)
+    async def _read_document(self, document_path: PdfSource, record_stats: bool = True) -> Tuple[Optional[str], Optional[str], str]:
+        """Return (cache_key, cached InvoiceData JSON, invoice text), parsing the PDF only on a cache miss; bytes are PDF content."""
+        if isinstance(document_path, str) and not document_path.lower().endswith(".pdf"):
+            return None, None, ocr_process_image(document_path)
+        document_hash = await asyncio.to_thread(hash_document, document_path)
+        cache_key = make_cache_key(document_hash, EXTRACTION_VERSION)
+        cached = await asyncio.to_thread(self.cache.get, cache_key, record_stats)
+        if cached and cached["invoice_json"]:
+            return cache_key, cached["invoice_json"], cached["invoice_text"]
+        invoice_text = cached["invoice_text"] if cached else None
+        if not invoice_text:
+            invoice_text = await extract_text_from_pdf_async(document_path)
+            await asyncio.to_thread(self.cache.put, cache_key, invoice_text=invoice_text)
+        return cache_key, None, invoice_text
+
+    async def classify_documents(self, document_paths: List[PdfSource]) -> Dict[PdfSource, dict]:
+        """RAG-classify many documents with one batched embedding pass, keyed by path."""
+        reads = await asyncio.gather(
+            *[self._read_document(path, record_stats=False) for path in document_paths],
+            return_exceptions=True
+        )
+        texts = {}
+        for path, read in zip(document_paths, reads):
+            if isinstance(read, Exception):
+                logger.warning(f"Skipping RAG classification for {path}: {str(read)}")
+            else:
+                texts[path] = read[2]
+        if not texts:
+            return {}
+        classifications = await asyncio.to_thread(self.rag_index.classify_batch, list(texts.values()))
+        return dict(zip(texts, classifications))
+
+    async def run(self, document_path: PdfSource, rag_result: Optional[dict] = None) -> InvoiceData:
+        label = f"<{len(document_path)} byte PDF>" if isinstance(document_path, bytes) else document_path
+        logger.info(f"Processing document: {label}")
+        cache_key, cached_json, invoice_text = await self._read_document(document_path)
+        if cached_json:
+            logger.info(f"Extraction cache hit for {label}")
+            return InvoiceData.model_validate_json(cached_json)
+
+        # Check RAG for similar invoices, unless the caller already classified this one in a batch
+        if rag_result is None:
+            rag_result = await asyncio.to_thread(self.rag_index.classify_invoice, invoice_text)
         if rag_result['status'] == 'similar_error':
             logger.warning(f"Invoice similar to known error: {rag_result['matched_invoice_id']}")
 
         try:
             # Use OpenAI API to extract fields
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": "Extract the following fields from the invoice text and return them in JSON format: vendor_name, invoice_number, invoice_date, total_amount. Ensure total_amount is a numeric string without currency symbols."},
-                    {"role": "user", "content": invoice_text}
-                ],
-                response_format={"type": "json_object"}
-            )
-            json_data = json.loads(response.choices[0].message.content)
-            extracted_data = {
-                "vendor_name": json_data.get("vendor_name", ""),
-                "invoice_number": json_data.get("invoice_number", ""),
-                "invoice_date": json_data.get("invoice_date", ""),
-                "total_amount": json_data.get("total_amount", "")
-            }
+            extracted_data = await self._extract_with_openai(invoice_text)
             confidence = 0.95  # Default confidence for OpenAI success
+            cacheable = True
             cleaned_total_amount = re.sub(r'[^\d.]', '', extracted_data["total_amount"])
             extracted_data["total_amount"] = cleaned_total_amount
             logger.info(f"OpenAI extraction succeeded with cleaned total_amount: {cleaned_total_amount}")
         except Exception as e:
             logger.warning(f"OpenAI extraction failed: {str(e)}. Falling back to placeholder.")
+            cacheable = False  # Never cache placeholder data
             extracted_data = self.tools[0]._run(invoice_text)
             confidence = extracted_data.get("confidence", 0.0)
             if "error" not in extracted_data:
@@ -109,6 +195,8 @@ class InvoiceExtractionAgent(BaseAgent):
             total_amount=Decimal(str(extracted_data["total_amount"])),
             confidence=confidence
         )
+        if cache_key and cacheable:
+            await asyncio.to_thread(self.cache.put, cache_key, invoice_json=invoice_data.model_dump_json())
         logger.info(f"Successfully extracted invoice data with confidence {confidence}")
         return invoice_data
 
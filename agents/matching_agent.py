@@ -4,18 +4,32 @@ import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 import logging
 import asyncio
+import threading
+from typing import List
 import pandas as pd
-from fuzzywuzzy import fuzz
+from rapidfuzz import fuzz, process, utils
 from config.logging_config import logger  # Import singleton logger
+from config.settings import PO_MATCH_THRESHOLD, PO_MATCH_TOP_K
 from agents.base_agent import BaseAgent
 from models.invoice import InvoiceData
+from data_processing.vendor_index import VendorBlockingIndex
 
 import os
+
+_matching_agent = None
+_matching_agent_lock = threading.Lock()
+
 class PurchaseOrderMatchingAgent:
-    def __init__(self):
+    def __init__(self, top_k: int = PO_MATCH_TOP_K):
         # Updated to fix the relative path for vendor_data.csv
         self.po_file = os.path.join(os.path.dirname(__file__), '..', 'data', 'raw', 'vendor_data.csv')
         self.po_data = self._load_po_data(self.po_file)
+        self.top_k = top_k
+        # Normalize vendor names once instead of per comparison
+        self.vendor_names = [utils.default_process(str(name)) for name in self.po_data["Vendor Name"]]
+        self.po_numbers = self.po_data["Approved PO List"].tolist()
+        # Shortlists vendors so only plausible candidates get the expensive fuzzy scoring
+        self.blocking_index = VendorBlockingIndex(self.vendor_names, PO_MATCH_THRESHOLD)
 
     def _load_po_data(self, po_file: str) -> pd.DataFrame:
         logger.debug(f"Loading PO data from: {po_file}")
@@ -31,44 +45,69 @@ class PurchaseOrderMatchingAgent:
             logger.error(f"Failed to load PO data: {str(e)}")
             raise
 
-    async def run(self, invoice_data: InvoiceData) -> dict:
-        logger.info(f"Matching invoice: {invoice_data.invoice_number}")
-        logger.debug(f"Invoice data for matching: {invoice_data.model_dump()}")
-        matches = []
-        for _, po in self.po_data.iterrows():
-            logger.debug(f"Comparing with PO: {po['Approved PO List']}")
-            vendor_similarity = fuzz.token_sort_ratio(
-                str(invoice_data.vendor_name).lower(),
-                str(po["Vendor Name"]).lower()
-            )
-            match_confidence = vendor_similarity / 100
-            logger.debug(f"Vendor similarity score: {vendor_similarity} (confidence: {match_confidence})")
-            if match_confidence > 0.85:
-                matches.append({
-                    "po_number": po["Approved PO List"],
-                    "match_confidence": match_confidence
-                })
-        if matches:
-            best_match = max(matches, key=lambda x: x["match_confidence"])
-            result = {
+    def _candidate(self, row: int, score: int) -> dict:
+        return {
+            "po_number": self.po_numbers[row],
+            "vendor_name": self.po_data["Vendor Name"].iat[row],
+            "match_confidence": score / 100
+        }
+
+    def _result(self, candidates: List[dict]) -> dict:
+        """Build the match result from candidates sorted by descending confidence."""
+        if candidates:
+            best_match = candidates[0]
+            logger.debug(f"Best match found: {best_match}")
+            return {
                 "status": "matched",
                 "po_number": best_match["po_number"],
-                "match_confidence": best_match["match_confidence"]
-            }
-            logger.debug(f"Best match found: {best_match}")
-        else:
-            result = {
-                "status": "unmatched",
-                "po_number": None,
-                "match_confidence": 0.0
+                "match_confidence": best_match["match_confidence"],
+                "top_matches": candidates
             }
-            logger.debug("No matches found above threshold")
+        logger.debug("No matches found above threshold")
+        return {
+            "status": "unmatched",
+            "po_number": None,
+            "match_confidence": 0.0,
+            "top_matches": []
+        }
+
+    def match(self, invoice_data: InvoiceData) -> dict:
+        """Score one invoice against its shortlisted vendors in a single C-accelerated call."""
+        query = utils.default_process(str(invoice_data.vendor_name))
+        rows = self.blocking_index.candidates(query)
+        scored = process.extract(
+            query,
+            [self.vendor_names[row] for row in rows],
+            scorer=fuzz.token_sort_ratio,
+            processor=None,
+            score_cutoff=PO_MATCH_THRESHOLD * 100,
+            limit=self.top_k
+        )
+        # Round like fuzzywuzzy's integer scores so borderline names match as before
+        return self._result([
+            self._candidate(int(rows[position]), round(score)) for _, score, position in scored
+            if round(score) / 100 > PO_MATCH_THRESHOLD
+        ])
+
+    async def run(self, invoice_data: InvoiceData) -> dict:
+        logger.info(f"Matching invoice: {invoice_data.invoice_number}")
+        logger.debug(f"Invoice data for matching: {invoice_data.model_dump()}")
+        result = await asyncio.to_thread(self.match, invoice_data)
         logger.info(f"Matching result: {result}")
         return result
 
+def get_matching_agent() -> PurchaseOrderMatchingAgent:
+    """Return the process-wide matching agent, loading the PO list and vendor index once."""
+    global _matching_agent
+    if _matching_agent is None:
+        with _matching_agent_lock:
+            if _matching_agent is None:
+                _matching_agent = PurchaseOrderMatchingAgent()
+    return _matching_agent
+
 if __name__ == "__main__":
     async def main():
-        agent = PurchaseOrderMatchingAgent()
+        agent = get_matching_agent()
         sample_data = InvoiceData(
             vendor_name="ABC Corp Ltd.",
             invoice_number="INV-2024-001",
@@ -78,4 +117,4 @@ if __name__ == "__main__":
         )
         result = await agent.run(sample_data)
         print(result)
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
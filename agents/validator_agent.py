@@ -5,18 +5,21 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 import logging
 import asyncio
 from datetime import datetime
+from typing import Optional
 from config.logging_config import logger  # Import singleton logger
 from agents.base_agent import BaseAgent
 from models.invoice import InvoiceData
 from models.validation_schema import ValidationResult
 from data_processing.anomaly_detection import AnomalyDetector
+from db import get_db
 
 class InvoiceValidationAgent(BaseAgent):
     def __init__(self):
         super().__init__()
-        self.anomaly_detector = AnomalyDetector()
+        # Back anomaly history with invoices.db so every request and worker shares it
+        self.anomaly_detector = AnomalyDetector(store=get_db())
 
-    async def run(self, invoice_data: InvoiceData) -> ValidationResult:
+    async def run(self, invoice_data: InvoiceData, run_id: Optional[str] = None) -> ValidationResult:
         logger.info(f"Validating invoice data: {invoice_data.invoice_number}")
         logger.debug(f"Starting validation for invoice: {invoice_data.model_dump()}")
         errors = {}
@@ -59,7 +62,7 @@ class InvoiceValidationAgent(BaseAgent):
             logger.debug("Confidence below threshold")
 
         logger.debug("Running anomaly detection")
-        anomaly_errors = await asyncio.to_thread(self.anomaly_detector.detect_anomalies, invoice_data)
+        anomaly_errors = await asyncio.to_thread(self.anomaly_detector.detect_anomalies, invoice_data, None, run_id)
         errors.update(anomaly_errors)
         if anomaly_errors:
             logger.debug(f"Anomalies detected: {anomaly_errors}")
@@ -1,13 +1,11 @@
 import sys
 import os
-import shutil
 import asyncio  # Add asyncio import
 import time  # Add time import
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from fastapi.middleware.cors import CORSMiddleware
 import json
-import uuid
 from pathlib import Path
 from glob import glob
 from shutil import copyfile
@@ -15,18 +13,51 @@ from typing import Optional, List
 from datetime import datetime
 from pydantic import BaseModel, Field
 from fastapi import FastAPI, UploadFile, File, HTTPException, status, WebSocket, WebSocketDisconnect
-from fastapi.responses import FileResponse, JSONResponse, StreamingResponse  # Add StreamingResponse
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse  # Add StreamingResponse
 from config.logging_config import logger
-from db import InvoiceDB  # Import InvoiceDB for database operations
-from setup_s3 import upload_to_s3, BUCKET_NAME
-import boto3
+from config.settings import MAX_CONCURRENT_INVOICES
+from db import get_db, get_async_db  # Shared pooled database access
+from setup_s3 import get_s3_service  # Process-wide S3 client and transfer settings
+from storage.backends import get_storage_backend, invoice_pdf_key, StorageData
 from botocore.exceptions import ClientError
-from io import BytesIO
 
 from workflows.orchestrator import InvoiceProcessingWorkflow
+from agents.matching_agent import get_matching_agent
+from workflows.upload_stage import UploadStage
+from data_processing.document_parser import shutdown_parser_pool
+from data_processing.rag_helper import get_rag_index
+from data_processing.record_journal import get_journal, snapshot_journals
+from data_processing.anomaly_detection import AnomalyDetector
 
 app = FastAPI()
 
+@app.on_event("startup")
+async def warm_up_rag_index():
+    """Load the embedding model and RAG index once, before the first upload needs them."""
+    await asyncio.to_thread(get_rag_index)
+
+@app.on_event("startup")
+async def warm_up_matching_agent():
+    """Load the PO list and build the vendor blocking index once, off the event loop."""
+    await asyncio.to_thread(get_matching_agent)
+
+@app.on_event("startup")
+async def init_database():
+    """Run the invoices.db schema setup once at startup instead of on first request."""
+    await asyncio.to_thread(get_db)
+
+@app.on_event("startup")
+async def rebuild_anomaly_model():
+    """Refresh the per-vendor outlier statistics from the full anomaly history in one pass."""
+    await asyncio.to_thread(AnomalyDetector(store=get_db()).rebuild_vendor_model)
+
+@app.on_event("shutdown")
+async def shutdown_workers():
+    """Stop the shared PDF parser processes and database executor, and leave the JSON snapshots current."""
+    await asyncio.to_thread(shutdown_parser_pool)
+    await asyncio.to_thread(get_async_db().shutdown)
+    await asyncio.to_thread(snapshot_journals)
+
 # WebSocket connection manager
 class ConnectionManager:
     def __init__(self):
@@ -99,44 +130,37 @@ class StorageConfig:
     BASE_DIR = Path("data")
     RAW_DIR = BASE_DIR / "raw" / "invoices"
     PROCESSED_DIR = BASE_DIR / "processed"
-    TEMP_DIR = BASE_DIR / "temp"
     ANOMALIES_FILE = PROCESSED_DIR / "anomalies.json"
     INVOICES_FILE = PROCESSED_DIR / "structured_invoices.json"
+    INVOICES_JOURNAL = PROCESSED_DIR / "structured_invoices.jsonl"
 
     @classmethod
     def initialize(cls):
-        for directory in [cls.RAW_DIR, cls.PROCESSED_DIR, cls.TEMP_DIR]:
+        for directory in [cls.RAW_DIR, cls.PROCESSED_DIR]:
             directory.mkdir(parents=True, exist_ok=True)
         logger.info("Storage directories initialized")
 
     @classmethod
-    def get_pdf_path(cls, invoice_id: str) -> Path:
-        return cls.PROCESSED_DIR / f"{invoice_id}.pdf"
+    def invoice_journal(cls):
+        return get_journal(cls.INVOICES_JOURNAL, ("invoice_number", "file_name"), legacy_path=cls.INVOICES_FILE)
+
+    @classmethod
+    def storage(cls):
+        """Backend that holds each processed invoice PDF (S3, local or in-memory per STORAGE_BACKEND)."""
+        return get_storage_backend()
 
     @classmethod
-    def get_temp_path(cls) -> Path:
-        return cls.TEMP_DIR / f"{uuid.uuid4()}.pdf"
+    def get_pdf_key(cls, invoice_id: str) -> str:
+        return invoice_pdf_key(invoice_id)
 
 # Initialize storage
 StorageConfig.initialize()
 
-def process_invoice_and_save(pdf_content: bytes, invoice_id: str) -> dict:
-    """Process and upload invoice PDF to S3, returning the S3 URL."""
+def process_invoice_and_save(pdf_content: StorageData, invoice_id: str) -> dict:
+    """Persist the invoice PDF (bytes or a readable stream) once to the storage backend, returning its URL."""
     try:
-        s3_client = boto3.client("s3")
-        s3_key = f"invoices/{invoice_id}.pdf"
-        
-        # Upload directly from bytes to S3
-        s3_client.upload_fileobj(
-            BytesIO(pdf_content),
-            BUCKET_NAME,
-            s3_key,
-            ExtraArgs={'ContentType': 'application/pdf'}
-        )
-        
-        # Generate the S3 URL
-        pdf_url = f"https://{BUCKET_NAME}.s3.amazonaws.com/{s3_key}"
-        logger.info(f"Successfully uploaded invoice {invoice_id} to S3: {pdf_url}")
+        pdf_url = StorageConfig.storage().save(StorageConfig.get_pdf_key(invoice_id), pdf_content)
+        logger.info(f"Successfully stored invoice {invoice_id}: {pdf_url}")
         
         return {
             "invoice_id": invoice_id,
@@ -233,125 +257,126 @@ async def process_all_invoices():
         processed = 0
         failed = 0
         skipped = 0
-        db = InvoiceDB()
-        batch_size = 5
-
-        # Process in batches
-        for batch_start in range(0, len(pdf_files), batch_size):
-            batch_end = min(batch_start + batch_size, len(pdf_files))
-            batch_files = pdf_files[batch_start:batch_end]
-            batch_results = []
-            
-            # First, extract invoice numbers from batch to check duplicates
-            for pdf_path in batch_files:
-                temp_path = Path(f"data/temp/{uuid.uuid4()}.pdf")
-                try:
-                    shutil.copy2(pdf_path, temp_path)
-                    result = await workflow.process_invoice(str(temp_path), save_pdf=False)
-                    if result and result.get('extracted_data', {}).get('invoice_number'):
-                        batch_results.append({
-                            'path': pdf_path,
-                            'extracted_data': result.get('extracted_data'),
-                            'processing_result': result
-                        })
-                    else:
-                        failed += 1
-                        await manager.broadcast({
-                            "type": "error",
-                            "file": pdf_path.name,
-                            "error": "Failed to extract data"
-                        })
-                except Exception as e:
+        db = get_async_db()
+        storage = StorageConfig.storage()
+
+        def upload_invoice(job: dict) -> str:
+            """Runs on the upload stage's thread pool; streams straight from the source file."""
+            with open(job['path'], 'rb') as pdf_file:
+                return storage.save(StorageConfig.get_pdf_key(job['db_entry']['invoice_number']), pdf_file)
+
+        async def insert_uploaded(outcomes):
+            """Completion callback: one bulk insert for every invoice uploaded since the last call."""
+            nonlocal processed, failed, skipped
+            to_process = []
+            for job, pdf_url, error in outcomes:
+                if error:
                     failed += 1
-                    logger.error(f"Error processing {pdf_path.name}: {str(e)}")
+                    logger.error(f"S3 upload error for {job['path'].name}: {error}")
                     await manager.broadcast({
                         "type": "error",
-                        "file": pdf_path.name,
-                        "error": str(e)
+                        "file": job['path'].name,
+                        "error": f"S3 upload failed: {error}"
                     })
-                finally:
-                    if temp_path.exists():
-                        temp_path.unlink()
-
-            if batch_results:
-                # Check for duplicates efficiently
-                invoice_numbers = [r['extracted_data']['invoice_number'] for r in batch_results]
-                duplicates = db.batch_check_duplicates(invoice_numbers)
-                
-                # Process non-duplicates
-                to_process = []
-                for result in batch_results:
-                    invoice_number = result['extracted_data']['invoice_number']
-                    if duplicates.get(invoice_number):
-                        skipped += 1
-                        await manager.broadcast({
-                            "type": "warning",
-                            "file": result['path'].name,
-                            "message": "Skipped duplicate invoice"
-                        })
-                        continue
-                    
-                    # Upload to S3
-                    try:
-                        with open(result['path'], 'rb') as pdf_file:
-                            s3_result = process_invoice_and_save(pdf_file.read(), invoice_number)
-                            
-                            # Prepare database entry
-                            extracted_data = result['extracted_data']
-                            to_process.append({
-                                'invoice_number': invoice_number,
-                                'vendor_name': extracted_data.get('vendor_name', ''),
-                                'invoice_date': extracted_data.get('invoice_date', ''),
-                                'total_amount': float(extracted_data.get('total_amount', 0)),
-                                'status': 'valid' if extracted_data.get('confidence', 0) >= 0.7 else 'needs_review',
-                                'pdf_url': s3_result.get('pdf_url', ''),
-                                'confidence': extracted_data.get('confidence', 0.0),
-                                'total_time': result['processing_result'].get('total_time', 0.0)
-                            })
-                    except Exception as e:
-                        failed += 1
-                        logger.error(f"S3 upload error for {result['path'].name}: {str(e)}")
-                        await manager.broadcast({
-                            "type": "error",
-                            "file": result['path'].name,
-                            "error": f"S3 upload failed: {str(e)}"
+                else:
+                    to_process.append(dict(job['db_entry'], pdf_url=pdf_url))
+            if not to_process:
+                return
+            insert_results = await db.bulk_insert_invoices(to_process)
+            for (success, _, error), result in zip(insert_results, to_process):
+                if success:
+                    processed += 1
+                    # Check confidence and save anomaly if needed
+                    if result['confidence'] < 0.7:
+                        await save_anomaly({
+                            "file_name": f"{result['invoice_number']}.pdf",
+                            "invoice_number": result['invoice_number'],
+                            "vendor_name": result['vendor_name'],
+                            "reason": "Low confidence extraction",
+                            "confidence": result['confidence'],
+                            "review_status": "needs_review",
+                            "type": "low_confidence"
                         })
-                
-                # Batch insert into database
-                if to_process:
-                    insert_results = db.batch_insert_invoices(to_process)
-                    for (success, _, error), result in zip(insert_results, to_process):
-                        if success:
-                            processed += 1
-                            # Check confidence and save anomaly if needed
-                            if result['confidence'] < 0.7:
-                                save_anomaly({
-                                    "file_name": f"{result['invoice_number']}.pdf",
-                                    "invoice_number": result['invoice_number'],
-                                    "vendor_name": result['vendor_name'],
-                                    "reason": "Low confidence extraction",
-                                    "confidence": result['confidence'],
-                                    "review_status": "needs_review",
-                                    "type": "low_confidence"
-                                })
-                        else:
-                            failed += 1
-                            logger.error(f"Database error for invoice {result['invoice_number']}: {error}")
-            
-            # Update progress after batch
-            current_progress = min(batch_end, total_files)
+                elif error and "already exists" in error:
+                    # Same invoice number seen twice in this run
+                    skipped += 1
+                else:
+                    failed += 1
+                    logger.error(f"Database error for invoice {result['invoice_number']}: {error}")
+
+        upload_stage = UploadStage(upload_invoice, insert_uploaded)
+        upload_stage.start()
+
+        async def enqueue_upload(document_path: str, result: dict):
+            """process_many callback: queue each extracted invoice for upload as soon as it finishes."""
+            nonlocal failed, skipped
+            pdf_path = Path(document_path)
+            extracted_data = (result or {}).get('extracted_data') or {}
+            invoice_number = extracted_data.get('invoice_number')
+            if not invoice_number:
+                failed += 1
+                await manager.broadcast({
+                    "type": "error",
+                    "file": pdf_path.name,
+                    "error": result.get("message", "Failed to extract data")
+                })
+                return
+            duplicates = await db.batch_check_duplicates([invoice_number])
+            if duplicates.get(invoice_number):
+                skipped += 1
+                await manager.broadcast({
+                    "type": "warning",
+                    "file": pdf_path.name,
+                    "message": "Skipped duplicate invoice"
+                })
+                return
+            await upload_stage.submit({
+                'path': pdf_path,
+                'db_entry': {
+                    'invoice_number': invoice_number,
+                    'vendor_name': extracted_data.get('vendor_name', ''),
+                    'invoice_date': extracted_data.get('invoice_date', ''),
+                    'total_amount': float(extracted_data.get('total_amount', 0)),
+                    'status': 'valid' if extracted_data.get('confidence', 0) >= 0.7 else 'needs_review',
+                    'confidence': extracted_data.get('confidence', 0.0),
+                    'total_time': result.get('total_time', 0.0)
+                }
+            })
+
+        completed = 0
+
+        async def on_result(document_path: str, result: dict):
+            """Hand each finished invoice to the upload stage and report progress."""
+            nonlocal completed
+            await enqueue_upload(document_path, result)
+            completed += 1
             await manager.broadcast({
-                "type": "progress", 
-                "current": current_progress, 
+                "type": "progress",
+                "current": completed,
                 "total": total_files,
-                "failed": failed, 
+                "failed": failed,
                 "processed": processed,
                 "skipped": skipped,
-                "currentFile": batch_files[-1].name if batch_files else None
+                "currentFile": Path(document_path).name,
+                "stages": workflow.stage_queue_depth()
             })
-            
-            # Small delay between batches
-            await asyncio.sleep(0.2)
+
+        try:
+            # Classify every invoice against known error invoices in one embedding pass, then
+            # stream them all through the pipeline with MAX_CONCURRENT_INVOICES in flight;
+            # uploads and DB inserts run in the upload stage as each invoice finishes
+            all_paths = [str(pdf_path) for pdf_path in pdf_files]
+            rag_results = await workflow.extraction_agent.classify_documents(all_paths)
+            await workflow.process_many(
+                all_paths,
+                concurrency=MAX_CONCURRENT_INVOICES,
+                save_pdf=False,
+                rag_results=rag_results,
+                on_result=on_result
+            )
+        finally:
+            # Drain outstanding uploads and their DB inserts before reporting the totals
+            await upload_stage.close()
         
         # Final status
         summary_message = f"Processing complete: {processed} processed, {failed} failed, {skipped} skipped"
@@ -380,33 +405,10 @@ async def process_all_invoices():
             "error": f"Batch processing failed: {str(e)}"
         })
         return {"status": "error", "message": str(e)}
-    finally:
-        # Cleanup temp files
-        try:
-            for temp_file in Path("data/temp").glob("*.pdf"):
-                try:
-                    temp_file.unlink()
-                except Exception as e:
-                    logger.error(f"Failed to clean up temp file {temp_file}: {str(e)}")
-        except Exception:
-            pass
 
 def save_invoice(invoice_data: dict):
     try:
-        os.makedirs(StorageConfig.INVOICES_FILE.parent, exist_ok=True)
-        try:
-            with StorageConfig.INVOICES_FILE.open('r') as f:
-                data = json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
-            data = []
-        for idx, inv in enumerate(data):
-            if inv.get('invoice_number') == invoice_data.get('invoice_number'):
-                data[idx] = invoice_data
-                break
-        else:
-            data.append(invoice_data)
-        with StorageConfig.INVOICES_FILE.open('w') as f:
-            json.dump(data, f, indent=4)
+        StorageConfig.invoice_journal().upsert(invoice_data, match_on=("invoice_number",))
     except Exception as e:
         logger.error(f"Error saving invoice: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error saving invoice: {str(e)}")
@@ -418,26 +420,14 @@ def validate_pdf_content(content: bytes) -> tuple[bool, str]:
         return False, "File is missing PDF end marker"
     return True, ""
 
-def save_anomaly(anomaly_data: dict):
+async def save_anomaly(anomaly_data: dict):
     try:
-        os.makedirs(StorageConfig.PROCESSED_DIR, exist_ok=True)
-        try:
-            with StorageConfig.ANOMALIES_FILE.open('r') as f:
-                anomalies = json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
-            anomalies = []
         anomaly_data.update({
             "timestamp": datetime.utcnow().isoformat(),
             "review_status": anomaly_data.get("review_status", "needs_review")
         })
-        for idx, anomaly in enumerate(anomalies):
-            if anomaly.get('file_name') == anomaly_data.get('file_name'):
-                anomalies[idx] = anomaly_data
-                break
-        else:
-            anomalies.append(anomaly_data)
-        with StorageConfig.ANOMALIES_FILE.open('w') as f:
-            json.dump(anomalies, f, indent=4)
+        if await get_async_db().upsert_anomaly(anomaly_data, match_on=("file_name",)) is None:
+            raise RuntimeError("database write failed")
         logger.info(f"Saved anomaly: {anomaly_data.get('file_name')}")
     except Exception as e:
         logger.error(f"Error saving anomaly: {str(e)}")
@@ -450,7 +440,6 @@ async def upload_invoice(file: UploadFile = File(...)):
             status_code=400,
             detail="No file provided"
         )
-    temp_path = StorageConfig.get_temp_path()
     try:
         content = await file.read()
         is_valid_pdf, error_message = validate_pdf_content(content)
@@ -462,19 +451,17 @@ async def upload_invoice(file: UploadFile = File(...)):
                 "review_status": "needs_review",
                 "type": "invalid_pdf"
             }
-            save_anomaly(anomaly_data)
+            await save_anomaly(anomaly_data)
             return {
                 "status": "error",
                 "detail": f"Invalid PDF file: {error_message}",
                 "type": "validation_error"
             }
             
-        with open(temp_path, "wb") as f:
-            f.write(content)
-            
         try:
+            # Parse from memory; the PDF is persisted once below, after the duplicate check
             workflow = InvoiceProcessingWorkflow()
-            result = await workflow.process_invoice(str(temp_path))
+            result = await workflow.process_invoice(content, save_pdf=False, file_name=file.filename)
             extracted_data = result.get('extracted_data')
             
             if not extracted_data:
@@ -485,7 +472,7 @@ async def upload_invoice(file: UploadFile = File(...)):
                     "review_status": "needs_review",
                     "type": "extraction_error"
                 }
-                save_anomaly(anomaly_data)
+                await save_anomaly(anomaly_data)
                 return {
                     "status": "error",
                     "detail": "Could not extract any data from the file",
@@ -500,7 +487,7 @@ async def upload_invoice(file: UploadFile = File(...)):
                     "review_status": "needs_review",
                     "type": "missing_data"
                 }
-                save_anomaly(anomaly_data)
+                await save_anomaly(anomaly_data)
                 return {
                     "status": "error",
                     "detail": "Could not find invoice number in the document",
@@ -510,8 +497,8 @@ async def upload_invoice(file: UploadFile = File(...)):
             invoice_id = extracted_data['invoice_number']
             
             # Check if invoice already exists before processing
-            db = InvoiceDB()
-            existing_invoice = db.get_invoice_by_number(invoice_id)
+            db = get_async_db()
+            existing_invoice = await db.get_invoice_by_number(invoice_id)
             
             if existing_invoice:
                 logger.info(f"Invoice {invoice_id} already exists in the database")
@@ -530,9 +517,9 @@ async def upload_invoice(file: UploadFile = File(...)):
                     }
                 }
             
-            # Save PDF to S3
-            s3_result = process_invoice_and_save(content, invoice_id)
-            logger.info(f"Saved PDF for invoice {invoice_id} to S3: {s3_result['pdf_url']}")
+            # Write the bytes already read for parsing (the only copy written)
+            s3_result = await asyncio.to_thread(process_invoice_and_save, content, invoice_id)
+            logger.info(f"Saved PDF for invoice {invoice_id}: {s3_result['pdf_url']}")
             
             # Save to database with improved error handling
             db_entry = {
@@ -546,7 +533,7 @@ async def upload_invoice(file: UploadFile = File(...)):
                 'total_time': result.get('processing_time', 0.0)
             }
             
-            is_new, db_id, error_message = db.insert_invoice(db_entry)
+            is_new, db_id, error_message = await db.insert_invoice(db_entry)
             
             if error_message:
                 if "already exists" in error_message:
@@ -574,7 +561,7 @@ async def upload_invoice(file: UploadFile = File(...)):
                     "review_status": "needs_review",
                     "type": "low_confidence"
                 }
-                save_anomaly(anomaly_data)
+                await save_anomaly(anomaly_data)
             
             return {
                 "status": "success",
@@ -592,7 +579,7 @@ async def upload_invoice(file: UploadFile = File(...)):
                 "review_status": "needs_review",
                 "type": "processing_error"
             }
-            save_anomaly(anomaly_data)
+            await save_anomaly(anomaly_data)
             return {
                 "status": "error",
                 "detail": f"Failed to process invoice: {str(process_error)}",
@@ -607,33 +594,32 @@ async def upload_invoice(file: UploadFile = File(...)):
             "review_status": "needs_review",
             "type": "system_error"
         }
-        save_anomaly(anomaly_data)
+        await save_anomaly(anomaly_data)
         return {
             "status": "error",
             "detail": f"Error processing file: {str(e)}",
             "type": "system_error"
         }
-    finally:
-        if temp_path.exists():
-            temp_path.unlink()
 
 @app.get("/api/invoices")
 async def get_invoices(
     page: int = 1,
     per_page: int = 10,
     sort_by: str = "created_at",
-    order: str = "desc"
+    order: str = "desc",
+    cursor: Optional[str] = None
 ):
-    """Get invoices from the SQLite database with pagination."""
+    """Get invoices from the SQLite database; pass next_cursor back as cursor for keyset paging."""
     try:
         logger.info(f"Fetching invoices page {page}, {per_page} per page")
-        db = InvoiceDB()
-        total_count = db.get_invoice_count()
-        invoices = db.get_invoices_paginated(
-            page=page,
+        db = get_async_db()
+        total_count = await db.get_invoice_count(cached=True)
+        invoices, next_cursor = await db.get_invoices_page(
             per_page=per_page,
             sort_by=sort_by,
-            order=order
+            order=order,
+            cursor=cursor,
+            page=page
         )
         
         # Transform decimal/date values to be JSON serializable
@@ -649,7 +635,8 @@ async def get_invoices(
                 "current_page": page,
                 "per_page": per_page,
                 "total_items": total_count,
-                "total_pages": -(-total_count // per_page)  # Ceiling division
+                "total_pages": -(-total_count // per_page),  # Ceiling division
+                "next_cursor": next_cursor
             }
         }
     except Exception as e:
@@ -687,17 +674,17 @@ async def get_invoice_pdf(invoice_number: str):
     logger.info(f"Looking for PDF for invoice_number: {invoice_number}")
     
     try:
-        db = InvoiceDB()
+        db = get_async_db()
         invoice = None
         
         # First try the direct invoice number lookup
-        invoice_data = db.get_invoice_by_number(invoice_number)
+        invoice_data = await db.get_invoice_by_number(invoice_number)
         if invoice_data:
             invoice = invoice_data
         
         # If not found, try to query from all invoices as fallback
         if not invoice:
-            query_result = db.get_all_invoices()
+            query_result = await db.get_all_invoices()
             invoice = next((inv for inv in query_result if inv['invoice_number'] == invoice_number), None)
         
         if not invoice:
@@ -716,27 +703,27 @@ async def get_invoice_pdf(invoice_number: str):
         
         pdf_url = invoice['pdf_url']
         logger.info(f"Found PDF URL for invoice {invoice_number}: {pdf_url}")
+
+        # PDFs kept by the local or in-memory storage backend are served from it directly
+        if not pdf_url.startswith(("http://", "https://")):
+            storage = StorageConfig.storage()
+            pdf_key = StorageConfig.get_pdf_key(invoice_number)
+            if not await asyncio.to_thread(storage.exists, pdf_key):
+                raise HTTPException(
+                    status_code=404,
+                    detail=f"PDF not found in storage for invoice {invoice_number}"
+                )
+            return Response(
+                content=await asyncio.to_thread(storage.read, pdf_key),
+                media_type="application/pdf",
+                headers={"Content-Disposition": f'inline; filename="{invoice_number}.pdf"'}
+            )
         
-        # Parse S3 URL more robustly
+        s3_service = get_s3_service()
+
+        # Parse S3 URL (virtual-hosted AWS URLs, or path-style on a custom endpoint)
         try:
-            from urllib.parse import urlparse
-            parsed_url = urlparse(pdf_url)
-            
-            # Handle the bucket name extraction more robustly
-            bucket_name = None
-            if parsed_url.netloc.endswith('s3.amazonaws.com'):
-                bucket_name = parsed_url.netloc.split('.')[0]
-            else:
-                # Handle custom domain or other URL formats
-                bucket_name = parsed_url.netloc.split('.')[0]
-            
-            # Extract the key more carefully
-            path_parts = parsed_url.path.strip('/').split('/')
-            if len(path_parts) < 1:
-                raise ValueError("Invalid S3 URL path")
-            
-            s3_key = '/'.join(path_parts)
-            
+            bucket_name, s3_key = s3_service.parse_object_url(pdf_url)
             logger.info(f"Parsed S3 URL - Bucket: {bucket_name}, Key: {s3_key}")
         except Exception as e:
             logger.error(f"Failed to parse S3 URL {pdf_url}: {str(e)}")
@@ -745,19 +732,9 @@ async def get_invoice_pdf(invoice_number: str):
                 detail=f"Invalid S3 URL format: {str(e)}"
             )
         
-        # Configure boto3 with timeouts
+        # Shared client is configured with connect/read timeouts to prevent hanging requests
         try:
-            import boto3
-            from botocore.config import Config
-            
-            # Configure with explicit timeouts to prevent hanging requests
-            s3_config = Config(
-                connect_timeout=5,  # 5 seconds for connection timeout
-                read_timeout=20,    # 20 seconds for read timeout
-                retries={'max_attempts': 3}
-            )
-            
-            s3_client = boto3.client('s3', config=s3_config)
+            s3_client = s3_service.client
             
             try:
                 # Get the file metadata first to verify it exists
@@ -836,10 +813,10 @@ class InvoiceUpdate(BaseModel):
 @app.put("/api/invoices/{invoice_id}")
 async def update_invoice(invoice_id: str, update_data: InvoiceUpdate):
     try:
-        db = InvoiceDB()
+        db = get_async_db()
         
         # First check if invoice exists
-        existing_invoice = db.get_invoice_by_id(invoice_id)
+        existing_invoice = await db.get_invoice_by_id(invoice_id)
         if not existing_invoice:
             raise HTTPException(
                 status_code=404,
@@ -857,7 +834,7 @@ async def update_invoice(invoice_id: str, update_data: InvoiceUpdate):
         }
         
         # Update the database with all fields
-        success = db.update_invoice_status(invoice_id, db_entry['status'], update_data=db_entry)
+        success = await db.update_invoice_status(invoice_id, db_entry['status'], update_data=db_entry)
         if not success:
             raise HTTPException(
                 status_code=500,
@@ -865,7 +842,7 @@ async def update_invoice(invoice_id: str, update_data: InvoiceUpdate):
             )
             
         # Fetch the updated invoice
-        updated_invoice = db.get_invoice_by_id(invoice_id)
+        updated_invoice = await db.get_invoice_by_id(invoice_id)
         if not updated_invoice:
             raise HTTPException(
                 status_code=500,
@@ -891,28 +868,11 @@ async def update_invoice(invoice_id: str, update_data: InvoiceUpdate):
 async def get_metrics():
     """Get processing metrics and statistics."""
     try:
-        db = InvoiceDB()
-        total_invoices = db.get_invoice_count()
-        
-        # Get status breakdown
-        status_counts = db.get_status_counts()
-        
-        # Get confidence metrics
-        confidence_metrics = db.get_confidence_metrics()
-        
-        # Get processing time metrics
-        time_metrics = db.get_processing_time_metrics()
-        
-        # Get last 24h metrics
-        recent_metrics = db.get_recent_metrics()
-        
-        return {
-            "total_invoices": total_invoices,
-            "status_breakdown": status_counts,
-            "confidence_metrics": confidence_metrics,
-            "processing_metrics": time_metrics,
-            "recent_activity": recent_metrics
-        }
+        # One read of trigger-maintained rollups instead of five aggregate scans
+        metrics = await get_async_db().get_dashboard_metrics()
+        if metrics is None:
+            raise RuntimeError("dashboard metrics unavailable")
+        return metrics
     except Exception as e:
         logger.error(f"Error getting metrics: {str(e)}")
         return {
@@ -927,44 +887,24 @@ async def get_metrics():
 async def get_anomalies(
     page: int = 1,
     per_page: int = 10,
-    status: Optional[str] = None
+    status: Optional[str] = None,
+    cursor: Optional[str] = None
 ):
-    """Get anomalies with pagination and filtering."""
+    """Get anomalies with pagination and filtering; pass next_cursor back as cursor for keyset paging."""
     try:
-        if not StorageConfig.ANOMALIES_FILE.exists():
-            return {
-                "data": [],
-                "pagination": {
-                    "current_page": page,
-                    "per_page": per_page,
-                    "total_items": 0,
-                    "total_pages": 0
-                }
-            }
-
-        with StorageConfig.ANOMALIES_FILE.open("r") as f:
-            all_anomalies = json.load(f)
+        db = get_async_db()
+        # Filtering, newest-first ordering and paging all run in SQL on indexed columns
+        anomalies, next_cursor = await db.get_anomalies_page(status=status, per_page=per_page, page=page, cursor=cursor)
+        total_items = await db.get_anomaly_count(status)
 
-        # Filter by status if provided
-        if status:
-            all_anomalies = [a for a in all_anomalies if a.get('review_status') == status]
-
-        # Sort by timestamp descending
-        all_anomalies.sort(key=lambda x: x.get('timestamp', ''), reverse=True)
-
-        # Calculate pagination
-        total_items = len(all_anomalies)
-        total_pages = -(-total_items // per_page)  # Ceiling division
-        start_idx = (page - 1) * per_page
-        end_idx = start_idx + per_page
-        
         return {
-            "data": all_anomalies[start_idx:end_idx],
+            "data": anomalies,
             "pagination": {
                 "current_page": page,
                 "per_page": per_page,
                 "total_items": total_items,
-                "total_pages": total_pages
+                "total_pages": -(-total_items // per_page),  # Ceiling division
+                "next_cursor": next_cursor
             }
         }
     except Exception as e:
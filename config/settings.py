@@ -6,4 +6,87 @@ load_dotenv()
 
 # No longer needed for OpenAI API key (decided to run local model); kept for potential future environment variables
 # Add project-specific settings if needed (e.g., confidence thresholds)
-CONFIDENCE_THRESHOLD = float(os.getenv("CONFIDENCE_THRESHOLD", 0.8))
\ No newline at end of file
+CONFIDENCE_THRESHOLD = float(os.getenv("CONFIDENCE_THRESHOLD", 0.8))
+
+# Maximum number of invoices processed concurrently by InvoiceProcessingWorkflow.process_many
+MAX_CONCURRENT_INVOICES = int(os.getenv("MAX_CONCURRENT_INVOICES", 4))
+
+# OpenAI extraction: model, per-request timeout (seconds), concurrent request cap and HTTP connection pool size
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", 30))
+OPENAI_MAX_CONCURRENT_REQUESTS = int(os.getenv("OPENAI_MAX_CONCURRENT_REQUESTS", 8))
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", 20))
+
+# Extraction cache: SQLite file and maximum number of cached documents before LRU eviction
+EXTRACTION_CACHE_PATH = os.getenv("EXTRACTION_CACHE_PATH", "data/processed/extraction_cache.db")
+EXTRACTION_CACHE_MAX_ENTRIES = int(os.getenv("EXTRACTION_CACHE_MAX_ENTRIES", 10000))
+
+# PDF parsing: worker processes in the shared parser pool and page count above which a PDF is split across workers
+PDF_PARSER_WORKERS = int(os.getenv("PDF_PARSER_WORKERS", os.cpu_count() or 2))
+PDF_PAGE_FANOUT_THRESHOLD = int(os.getenv("PDF_PAGE_FANOUT_THRESHOLD", 8))
+
+# Directory holding the persisted RAG embeddings and document metadata
+RAG_INDEX_DIR = os.getenv("RAG_INDEX_DIR", "data/processed/rag_index")
+
+# RAG search backend: "flat" (exact), "ivf" or "hnsw" (approximate), plus their recall/speed parameters
+RAG_INDEX_BACKEND = os.getenv("RAG_INDEX_BACKEND", "flat")
+RAG_IVF_NLIST = int(os.getenv("RAG_IVF_NLIST", 1024))
+RAG_IVF_NPROBE = int(os.getenv("RAG_IVF_NPROBE", 16))
+RAG_HNSW_M = int(os.getenv("RAG_HNSW_M", 32))
+RAG_HNSW_EF_CONSTRUCTION = int(os.getenv("RAG_HNSW_EF_CONSTRUCTION", 200))
+RAG_HNSW_EF_SEARCH = int(os.getenv("RAG_HNSW_EF_SEARCH", 64))
+# Retrain the IVF index once the corpus outgrows its lists by this factor (0 disables automatic retraining)
+RAG_IVF_RETRAIN_FACTOR = float(os.getenv("RAG_IVF_RETRAIN_FACTOR", 4))
+
+# Number of texts encoded per SentenceTransformer forward pass in batched RAG calls
+RAG_EMBEDDING_BATCH_SIZE = int(os.getenv("RAG_EMBEDDING_BATCH_SIZE", 64))
+
+# PO matching: minimum vendor-name similarity (exclusive) and number of candidate POs returned
+PO_MATCH_THRESHOLD = float(os.getenv("PO_MATCH_THRESHOLD", 0.85))
+PO_MATCH_TOP_K = int(os.getenv("PO_MATCH_TOP_K", 3))
+
+# Per-vendor outlier model: samples needed before it replaces the global rule, robust z-score cutoff, incremental step size
+ANOMALY_VENDOR_MIN_SAMPLES = int(os.getenv("ANOMALY_VENDOR_MIN_SAMPLES", 5))
+ANOMALY_ROBUST_Z_THRESHOLD = float(os.getenv("ANOMALY_ROBUST_Z_THRESHOLD", 3.5))
+ANOMALY_QUANTILE_STEP = float(os.getenv("ANOMALY_QUANTILE_STEP", 1.0))
+
+# Record journals: minimum log lines before compaction (also triggered once the log holds 2x the live records)
+JOURNAL_COMPACT_MIN_LINES = int(os.getenv("JOURNAL_COMPACT_MIN_LINES", 1000))
+# Record journals: also refresh the legacy JSON snapshot after this many appends; each refresh rewrites
+# every record, so this is opt-in (0 leaves it to compaction and shutdown)
+JOURNAL_SNAPSHOT_EVERY = int(os.getenv("JOURNAL_SNAPSHOT_EVERY", 0))
+
+# SQLite connection tuning for invoices.db (per-thread pooled connections in WAL mode)
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", 5000))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", 20000))
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")
+
+# Threads in the dedicated executor that runs blocking InvoiceDB calls for async code
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", 4))
+
+# Seconds a cached invoice total count may be served before it is recounted
+DB_COUNT_CACHE_TTL = float(os.getenv("DB_COUNT_CACHE_TTL", 5))
+
+# Invoices per multi-row INSERT statement in bulk ingestion (all chunks share one transaction)
+DB_BULK_INSERT_CHUNK_SIZE = int(os.getenv("DB_BULK_INSERT_CHUNK_SIZE", 500))
+
+# Shared S3 client: HTTP connection pool size, timeouts, optional S3-compatible endpoint (e.g. MinIO or moto server)
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL") or None
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", 50))
+S3_CONNECT_TIMEOUT = float(os.getenv("S3_CONNECT_TIMEOUT", 5))
+S3_READ_TIMEOUT = float(os.getenv("S3_READ_TIMEOUT", 20))
+
+# S3 multipart transfers: size at which uploads switch to multipart, part size, parallel parts per transfer
+S3_MULTIPART_THRESHOLD_MB = int(os.getenv("S3_MULTIPART_THRESHOLD_MB", 16))
+S3_MULTIPART_CHUNKSIZE_MB = int(os.getenv("S3_MULTIPART_CHUNKSIZE_MB", 8))
+S3_MAX_TRANSFER_CONCURRENCY = int(os.getenv("S3_MAX_TRANSFER_CONCURRENCY", 10))
+
+# Background upload stage: worker threads, queued jobs before producers wait, retry attempts and base backoff (seconds)
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", 8))
+UPLOAD_QUEUE_SIZE = int(os.getenv("UPLOAD_QUEUE_SIZE", 100))
+UPLOAD_MAX_RETRIES = int(os.getenv("UPLOAD_MAX_RETRIES", 3))
+UPLOAD_RETRY_BASE_DELAY = float(os.getenv("UPLOAD_RETRY_BASE_DELAY", 1.0))
+
+# Where invoice PDFs are persisted: "s3", "local" (under LOCAL_STORAGE_DIR) or "memory" (tests)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "s3")
+LOCAL_STORAGE_DIR = os.getenv("LOCAL_STORAGE_DIR", "data/processed")
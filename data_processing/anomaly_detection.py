@@ -4,43 +4,243 @@ import sys
 import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 import logging
-from typing import List, Dict
+import heapq
+import math
+import threading
+from typing import List, Dict, Optional, Set, Any
+import numpy as np
 from config.logging_config import setup_logging
+from config.settings import ANOMALY_VENDOR_MIN_SAMPLES, ANOMALY_ROBUST_Z_THRESHOLD, ANOMALY_QUANTILE_STEP
 from models.invoice import InvoiceData
 
 logger = setup_logging()
 
-class AnomalyDetector:
+class RunningMedian:
+    """Streaming median over two heaps with O(log n) inserts and O(1) lookups."""
+
     def __init__(self):
-        self.past_invoices: List[InvoiceData] = []  # In-memory storage for simplicity; Day 8 can use a DB
+        self._lower: List[float] = []  # Max-heap (negated) of the smaller half
+        self._upper: List[float] = []  # Min-heap of the larger half, holds the extra element
+
+    def __len__(self) -> int:
+        return len(self._lower) + len(self._upper)
+
+    def add(self, value: float):
+        if self._upper and value < self._upper[0]:
+            heapq.heappush(self._lower, -value)
+        else:
+            heapq.heappush(self._upper, value)
+        # Keep len(upper) == ceil(n / 2) so upper[0] is sorted(values)[n // 2]
+        if len(self._lower) > len(self._upper):
+            heapq.heappush(self._upper, -heapq.heappop(self._lower))
+        elif len(self._upper) > len(self._lower) + 1:
+            heapq.heappush(self._lower, -heapq.heappop(self._upper))
+
+    def median(self) -> Optional[float]:
+        return self._upper[0] if self._upper else None
+
+class VendorOutlierModel:
+    """
+    Per-vendor total statistics: count, mean, variance (as Welford's m2), median, MAD and p05/p95.
+
+    rebuild() computes exact statistics for every vendor in one vectorized NumPy
+    pass over history. update() folds in one invoice in O(1): Welford's update for
+    mean and variance, stochastic-approximation steps for median, MAD and quantiles.
+    """
+
+    QUANTILES = {"p05": 0.05, "p95": 0.95}
+
+    def __init__(self):
+        self.stats: Dict[str, Dict[str, float]] = {}
+
+    @classmethod
+    def from_history(cls, vendor_names: List[str], totals: List[float]) -> "VendorOutlierModel":
+        model = cls()
+        model.rebuild(vendor_names, totals)
+        return model
+
+    def rebuild(self, vendor_names: List[str], totals: List[float]):
+        """Recompute every vendor's statistics from scratch in one pass."""
+        self.stats = {}
+        if not len(totals):
+            return
+        vendors, inverse = np.unique(np.asarray(vendor_names, dtype=object).astype(str), return_inverse=True)
+        totals = np.asarray(totals, dtype=np.float64)
+        counts = np.bincount(inverse)
+        means = np.bincount(inverse, weights=totals) / counts
+        m2 = np.bincount(inverse, weights=(totals - means[inverse]) ** 2)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+        # Group-wise order statistics: sort by (vendor, value) and index into each group's slice
+        sorted_totals = totals[np.lexsort((totals, inverse))]
+        medians = sorted_totals[starts + counts // 2]
+        deviations = np.abs(totals - medians[inverse])
+        mads = deviations[np.lexsort((deviations, inverse))][starts + counts // 2]
+        quantiles = {
+            name: sorted_totals[starts + np.floor(q * (counts - 1)).astype(np.int64)]
+            for name, q in self.QUANTILES.items()
+        }
 
-    def detect_anomalies(self, invoice_data: InvoiceData, past_invoices: List[InvoiceData] = None) -> Dict[str, str]:
-        """Detect anomalies in invoice data."""
+        for i, vendor in enumerate(vendors):
+            self.stats[vendor] = {
+                "count": int(counts[i]),
+                "mean": float(means[i]),
+                "m2": float(m2[i]),
+                "median": float(medians[i]),
+                "mad": float(mads[i]),
+                **{name: float(values[i]) for name, values in quantiles.items()}
+            }
+        logger.info(f"Rebuilt vendor outlier model for {len(vendors)} vendors from {len(totals)} invoices")
+
+    @classmethod
+    def update_state(cls, state: Optional[Dict[str, float]], total: float) -> Dict[str, float]:
+        """Return a vendor's statistics with one more invoice total folded in."""
+        if not state or not state.get("count"):
+            return {"count": 1, "mean": total, "m2": 0.0, "median": total, "mad": 0.0,
+                    **{name: total for name in cls.QUANTILES}}
+        state = dict(state)
+        count = state["count"] + 1
+        delta = total - state["mean"]
+        state["mean"] += delta / count
+        state["m2"] += delta * (total - state["mean"])
+        state["count"] = count
+
+        # Step size shrinks as 1/sqrt(n) and scales with the vendor's spread
+        scale = max(state["mad"], math.sqrt(state["m2"] / count), abs(state["median"]) * 0.01, 1e-9)
+        step = ANOMALY_QUANTILE_STEP * scale / math.sqrt(count)
+        deviation = abs(total - state["median"])
+        state["median"] += step * (0.5 - (total < state["median"]))
+        state["mad"] = max(state["mad"] + step * (0.5 - (deviation < state["mad"])), 0.0)
+        for name, q in cls.QUANTILES.items():
+            state[name] += step * (q - (total < state[name]))
+        return state
+
+    @staticmethod
+    def check_state(state: Optional[Dict[str, float]], vendor_name: str, total: float) -> Optional[str]:
+        """
+        Outlier message, "" if the total is normal for the vendor, or None when the
+        vendor has too little history and the caller should use the global rule.
+        """
+        if not state or state["count"] < ANOMALY_VENDOR_MIN_SAMPLES:
+            return None
+        median, mad = state["median"], state["mad"]
+        if mad > 0:
+            # Modified z-score (Iglewicz-Hoaglin); 0.6745 makes MAD consistent with a normal sigma
+            robust_z = 0.6745 * (total - median) / mad
+            if abs(robust_z) > ANOMALY_ROBUST_Z_THRESHOLD:
+                return f"Unusual total for {vendor_name}: {total} (vendor median: {median}, robust z: {robust_z:.1f})"
+            return ""
+        # Degenerate spread (e.g. a fixed monthly fee): apply the ratio rule to the vendor median
+        if total > 2 * median or total < 0.5 * median:
+            return f"Unusual total for {vendor_name}: {total} (vendor median: {median})"
+        return ""
+
+    def get(self, vendor_name: str) -> Optional[Dict[str, float]]:
+        return self.stats.get(vendor_name)
+
+    def update(self, vendor_name: str, total: float):
+        self.stats[vendor_name] = self.update_state(self.stats.get(vendor_name), total)
+
+class AnomalyDetector:
+    def __init__(self, store=None):
+        # Optional persistent history (InvoiceDB) shared across requests and worker processes
+        self.store = store
+        # Indexed history: constant-time duplicate lookups and a streaming median of totals
+        self.invoice_numbers: Set[str] = set()
+        self.totals = RunningMedian()
+        self.vendor_model = VendorOutlierModel()
+        self._lock = threading.Lock()
+
+    def rebuild_vendor_model(self):
+        """Recompute per-vendor statistics from the full stored history in one pass."""
+        if self.store is None:
+            return
+        history = self.store.get_anomaly_totals()
+        self.vendor_model = VendorOutlierModel.from_history(
+            [vendor for vendor, _ in history], [total for _, total in history]
+        )
+        self.store.save_vendor_stats(self.vendor_model.stats)
+
+    def _check_total(self, current_total: float, median_total: float) -> Optional[str]:
+        if current_total > 2 * median_total or current_total < 0.5 * median_total:
+            return f"Unusual total: {current_total} (median: {median_total})"
+        return None
+
+    def detect_anomalies(
+        self,
+        invoice_data: InvoiceData,
+        past_invoices: List[InvoiceData] = None,
+        run_id: Optional[str] = None
+    ) -> Dict[str, str]:
+        """Detect anomalies in invoice data. `run_id` lets the store recognise a retry within the same pipeline run."""
         logger.info(f"Detecting anomalies for invoice: {invoice_data.invoice_number}")
         anomalies = {}
-        past_invoices = past_invoices or self.past_invoices
 
-        # Check for duplicates by invoice number
-        for past in past_invoices:
-            if past.invoice_number == invoice_data.invoice_number:
+        history = None
+        if self.store is not None and not past_invoices:
+            history = self.store.check_and_record_anomaly_history(
+                invoice_data.invoice_number,
+                invoice_data.vendor_name,
+                float(invoice_data.total_amount) if invoice_data.total_amount else None,
+                vendor_update=VendorOutlierModel.update_state,
+                run_id=run_id
+            )
+            if history is None:
+                # The in-process history is not kept while a store is set, so it cannot stand in; flag the
+                # invoice for review instead of silently passing it without duplicate and outlier checks
+                logger.error(f"Shared anomaly history unavailable; checks skipped for {invoice_data.invoice_number}")
+                anomalies["history_unavailable"] = "Anomaly history unavailable: duplicate and outlier checks were skipped"
+                return anomalies
+
+        with self._lock:
+            if history is not None:
+                is_duplicate = history["duplicate"]
+                median_total = history["median_total"]
+                vendor_state = history["vendor_stats"]
+            elif past_invoices:
+                # Explicit history from the caller; scanned as before
+                is_duplicate = any(past.invoice_number == invoice_data.invoice_number for past in past_invoices)
+                priced = [p for p in past_invoices if p.total_amount]
+                totals = [float(p.total_amount) for p in priced]
+                median_total = sorted(totals)[len(totals) // 2] if totals else None
+                vendor_state = VendorOutlierModel.from_history(
+                    [p.vendor_name for p in priced], totals
+                ).get(invoice_data.vendor_name)
+            else:
+                is_duplicate = invoice_data.invoice_number in self.invoice_numbers
+                median_total = self.totals.median()
+                vendor_state = self.vendor_model.get(invoice_data.vendor_name)
+
+            # Check for duplicates by invoice number
+            if is_duplicate:
                 anomalies["duplicate"] = f"Duplicate invoice number: {invoice_data.invoice_number}"
-                break
 
-        # Check total amount outlier (simple heuristic: >2x median of past totals)
-        if past_invoices:
-            totals = [float(p.total_amount) for p in past_invoices if p.total_amount]
-            if totals:
-                median_total = sorted(totals)[len(totals) // 2]
+            # Check total amount outlier against the vendor's own history, else the global median
+            unusual = None
+            if median_total is not None:
                 current_total = float(invoice_data.total_amount)
-                if current_total > 2 * median_total or current_total < 0.5 * median_total:
-                    anomalies["total_amount"] = f"Unusual total: {current_total} (median: {median_total})"
+                unusual = VendorOutlierModel.check_state(vendor_state, invoice_data.vendor_name, current_total)
+                if unusual is None:
+                    # Simple heuristic: >2x median of past totals
+                    unusual = self._check_total(current_total, median_total)
+            if unusual:
+                anomalies["total_amount"] = unusual
+
+            # Update indexed history; with a store the shared tables are the history, so nothing accumulates in process
+            if self.store is None:
+                self.invoice_numbers.add(invoice_data.invoice_number)
+                if invoice_data.total_amount:
+                    self.totals.add(float(invoice_data.total_amount))
+                    self.vendor_model.update(invoice_data.vendor_name, float(invoice_data.total_amount))
 
-        # Update past invoices
-        self.past_invoices.append(invoice_data)
         logger.info(f"Anomaly detection result: {anomalies}")
         return anomalies
 
 if __name__ == "__main__":
+    if "--rebuild" in sys.argv:
+        from db import get_db
+        AnomalyDetector(store=get_db()).rebuild_vendor_model()
+        sys.exit(0)
     detector = AnomalyDetector()
     sample_data = InvoiceData(
         vendor_name="ABC Corp Ltd.",
@@ -1,26 +1,159 @@
 # /data_processing/document_parser.py (Updated)
 
 import pdfplumber
-from typing import Optional
+import asyncio
+import threading
+import multiprocessing
+import os
+import tempfile
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from typing import Optional, List, Tuple, Union
 import logging
 from pathlib import Path
 from config.logging_config import setup_logging
+from config.settings import PDF_PARSER_WORKERS, PDF_PAGE_FANOUT_THRESHOLD
 
 logger = setup_logging()
 
-def extract_text_from_pdf(pdf_path: str) -> str:
+# A PDF to parse: a file path, or the document's bytes (e.g. an upload that was never written to disk)
+PdfSource = Union[str, bytes]
+
+_parser_pool: Optional[ProcessPoolExecutor] = None
+_parser_pool_lock = threading.Lock()
+
+def get_parser_pool() -> ProcessPoolExecutor:
+    """Return the process-wide PDF parser pool, creating it on first use."""
+    global _parser_pool
+    if _parser_pool is None:
+        with _parser_pool_lock:
+            if _parser_pool is None:
+                # Never fork the multi-threaded parent (uvicorn, DB/upload executors, torch/faiss):
+                # workers start from a clean forkserver process, or spawn where that is unavailable
+                method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+                _parser_pool = ProcessPoolExecutor(
+                    max_workers=PDF_PARSER_WORKERS,
+                    mp_context=multiprocessing.get_context(method)
+                )
+                logger.info(f"Started PDF parser pool with {PDF_PARSER_WORKERS} workers")
+    return _parser_pool
+
+def shutdown_parser_pool():
+    """Shut down the shared parser pool; a new one is created on next use."""
+    global _parser_pool
+    with _parser_pool_lock:
+        if _parser_pool is not None:
+            _parser_pool.shutdown(wait=True)
+            _parser_pool = None
+            logger.info("PDF parser pool shut down")
+
+def _page_texts(pages) -> List[str]:
+    """Extract non-empty page texts, calling extract_text exactly once per page."""
+    texts = []
+    for page in pages:
+        text = page.extract_text()
+        if text:
+            texts.append(text)
+        page.close()  # Release cached layout objects as we go
+    return texts
+
+def _open_pdf(pdf_source: PdfSource):
+    return pdfplumber.open(BytesIO(pdf_source) if isinstance(pdf_source, bytes) else pdf_source)
+
+def _describe(pdf_source: PdfSource) -> str:
+    """Log label for a source, so document bytes never end up in log lines."""
+    return f"<{len(pdf_source)} byte PDF>" if isinstance(pdf_source, bytes) else pdf_source
+
+def _extract_pages(pdf_source: PdfSource, start: int, stop: int) -> List[str]:
+    """Extract text from pages [start, stop) of a PDF."""
+    with _open_pdf(pdf_source) as pdf:
+        return _page_texts(pdf.pages[start:stop])
+
+def _extract_or_count(pdf_source: PdfSource) -> Tuple[int, Optional[List[str]]]:
+    """Extract a short PDF in one pass; for long PDFs only return the page count so pages can be fanned out."""
+    with _open_pdf(pdf_source) as pdf:
+        page_count = len(pdf.pages)
+        if page_count and page_count >= PDF_PAGE_FANOUT_THRESHOLD:
+            return page_count, None
+        return page_count, _page_texts(pdf.pages)
+
+def _page_ranges(page_count: int, workers: int) -> List[Tuple[int, int]]:
+    """Split page_count pages into at most `workers` contiguous ranges."""
+    if page_count <= 0:
+        return []
+    chunk = -(-page_count // max(1, workers))  # Ceiling division
+    return [(start, min(start + chunk, page_count)) for start in range(0, page_count, chunk)]
+
+@contextmanager
+def _fanout_source(pdf_source: PdfSource):
+    """Path for page fan-out workers; bytes are written to one temp file instead of being pickled per task."""
+    if not isinstance(pdf_source, bytes):
+        yield pdf_source
+        return
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
+        tmp.write(pdf_source)
+    try:
+        yield tmp.name
+    finally:
+        os.unlink(tmp.name)
+
+def _check_path(pdf_path: PdfSource):
+    if isinstance(pdf_path, bytes):
+        return
+    if not Path(pdf_path).exists():
+        logger.error(f"PDF file not found: {pdf_path}")
+        raise FileNotFoundError(f"PDF file not found: {pdf_path}")
+
+def _join_pages(pdf_path: PdfSource, page_texts: List[str]) -> str:
+    text = "\n".join(page_texts)
+    if not text:
+        logger.warning(f"No text content extracted from {_describe(pdf_path)}")
+        raise ValueError(f"No text extracted from PDF: {_describe(pdf_path)}")
+    logger.info(f"Successfully extracted text from {_describe(pdf_path)}")
+    return text
+
+def extract_text_from_pdf(pdf_path: PdfSource) -> str:
+    """Extract text in the calling process; long PDFs fan their pages out to the parser pool."""
+    try:
+        _check_path(pdf_path)
+        logger.info(f"Extracting text from PDF: {_describe(pdf_path)}")
+        page_count, page_texts = _extract_or_count(pdf_path)
+        if page_texts is not None:
+            return _join_pages(pdf_path, page_texts)
+        pool = get_parser_pool()
+        with _fanout_source(pdf_path) as source:
+            futures = [pool.submit(_extract_pages, source, start, stop)
+                       for start, stop in _page_ranges(page_count, PDF_PARSER_WORKERS)]
+            page_texts = [text for future in futures for text in future.result()]
+        return _join_pages(pdf_path, page_texts)
+    except Exception as e:
+        logger.error(f"Error extracting text from PDF {_describe(pdf_path)}: {str(e)}")
+        raise RuntimeError(f"Failed to parse PDF {_describe(pdf_path)}: {str(e)}")
+
+async def extract_text_from_pdf_async(pdf_path: PdfSource) -> str:
+    """Extract text in the parser pool without blocking the event loop."""
+    loop = asyncio.get_running_loop()
     try:
-        if not Path(pdf_path).exists():
-            logger.error(f"PDF file not found: {pdf_path}")
-            raise FileNotFoundError(f"PDF file not found: {pdf_path}")
-        logger.info(f"Extracting text from PDF: {pdf_path}")
-        with pdfplumber.open(pdf_path) as pdf:
-            text = "\n".join(page.extract_text() for page in pdf.pages if page.extract_text())
-        if not text:
-            logger.warning(f"No text content extracted from {pdf_path}")
-            raise ValueError(f"No text extracted from PDF: {pdf_path}")
-        logger.info(f"Successfully extracted text from {pdf_path}")
-        return text
+        _check_path(pdf_path)
+        logger.info(f"Extracting text from PDF in parser pool: {_describe(pdf_path)}")
+        pool = get_parser_pool()
+        try:
+            page_count, page_texts = await loop.run_in_executor(pool, _extract_or_count, pdf_path)
+            if page_texts is not None:
+                chunks = [page_texts]
+            else:
+                with _fanout_source(pdf_path) as source:
+                    chunks = await asyncio.gather(*[
+                        loop.run_in_executor(pool, _extract_pages, source, start, stop)
+                        for start, stop in _page_ranges(page_count, PDF_PARSER_WORKERS)
+                    ])
+        except BrokenProcessPool:
+            logger.warning("PDF parser pool is broken, restarting it and parsing in a thread")
+            shutdown_parser_pool()
+            chunks = [await asyncio.to_thread(_extract_pages, pdf_path, 0, None)]
+        return _join_pages(pdf_path, [text for chunk in chunks for text in chunk])
     except Exception as e:
-        logger.error(f"Error extracting text from PDF {pdf_path}: {str(e)}")
-        raise RuntimeError(f"Failed to parse PDF {pdf_path}: {str(e)}")
\ No newline at end of file
+        logger.error(f"Error extracting text from PDF {_describe(pdf_path)}: {str(e)}")
+        raise RuntimeError(f"Failed to parse PDF {_describe(pdf_path)}: {str(e)}")
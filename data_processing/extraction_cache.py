@@ -0,0 +1,164 @@
+# /data_processing/extraction_cache.py
+
+import hashlib
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional, Dict, Union
+from config.logging_config import setup_logging
+from config.settings import EXTRACTION_CACHE_PATH, EXTRACTION_CACHE_MAX_ENTRIES
+
+logger = setup_logging()
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def hash_document(document_path: Union[str, bytes], chunk_size: int = 1 << 20) -> str:
+    """Return the SHA-256 hex digest of a document's bytes, given a file path or the bytes themselves."""
+    if isinstance(document_path, bytes):
+        return hashlib.sha256(document_path).hexdigest()
+    sha = hashlib.sha256()
+    with open(document_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def make_cache_key(document_hash: str, version: str) -> str:
+    """Combine a document hash with the prompt/model version it was extracted with."""
+    return f"{document_hash}:{version}"
+
+class ExtractionCache:
+    """Persistent, size-bounded LRU cache of parsed text and structured invoice data."""
+
+    def __init__(self, db_path: str = EXTRACTION_CACHE_PATH, max_entries: int = EXTRACTION_CACHE_MAX_ENTRIES):
+        self.db_path = Path(db_path)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            # Schema and the entry counter are created in one write transaction so a
+            # concurrent writer cannot insert between seeding the count and adding its triggers
+            conn.executescript("""
+                BEGIN IMMEDIATE;
+                CREATE TABLE IF NOT EXISTS extraction_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    invoice_text TEXT,
+                    invoice_json TEXT,
+                    created_at REAL NOT NULL,
+                    last_accessed REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_extraction_cache_last_accessed ON extraction_cache (last_accessed);
+                CREATE TABLE IF NOT EXISTS extraction_cache_size (
+                    id INTEGER PRIMARY KEY CHECK (id = 0),
+                    entries INTEGER NOT NULL
+                );
+                INSERT OR IGNORE INTO extraction_cache_size (id, entries) SELECT 0, COUNT(*) FROM extraction_cache;
+                CREATE TRIGGER IF NOT EXISTS extraction_cache_count_insert AFTER INSERT ON extraction_cache BEGIN
+                    UPDATE extraction_cache_size SET entries = entries + 1 WHERE id = 0;
+                END;
+                CREATE TRIGGER IF NOT EXISTS extraction_cache_count_delete AFTER DELETE ON extraction_cache BEGIN
+                    UPDATE extraction_cache_size SET entries = entries - 1 WHERE id = 0;
+                END;
+                COMMIT;
+            """)
+        logger.debug(f"Extraction cache ready at {self.db_path} (max {max_entries} entries)")
+
+    @contextmanager
+    def _connect(self):
+        """Short-lived connection that commits on success and always closes."""
+        conn = sqlite3.connect(str(self.db_path), timeout=10)
+        try:
+            yield conn
+            conn.commit()
+        finally:
+            conn.close()
+
+    def get(self, cache_key: str, record_stats: bool = True) -> Optional[Dict[str, Optional[str]]]:
+        """Return the cached entry for a key, counting a hit only if structured data is present."""
+        try:
+            with self._connect() as conn:
+                row = conn.execute(
+                    "SELECT invoice_text, invoice_json FROM extraction_cache WHERE cache_key = ?",
+                    (cache_key,)
+                ).fetchone()
+                if row:
+                    conn.execute(
+                        "UPDATE extraction_cache SET last_accessed = ? WHERE cache_key = ?",
+                        (time.time(), cache_key)
+                    )
+        except sqlite3.Error as e:
+            logger.error(f"Extraction cache lookup failed: {e}")
+            row = None
+        if record_stats:
+            self._record(bool(row and row[1]))
+        if not row:
+            return None
+        return {"invoice_text": row[0], "invoice_json": row[1]}
+
+    def _record(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def put(self, cache_key: str, invoice_text: Optional[str] = None, invoice_json: Optional[str] = None):
+        """Store parsed text and/or structured data, keeping fields that are already cached."""
+        now = time.time()
+        try:
+            with self._connect() as conn:
+                conn.execute("""
+                    INSERT INTO extraction_cache (cache_key, invoice_text, invoice_json, created_at, last_accessed)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT(cache_key) DO UPDATE SET
+                        invoice_text = COALESCE(excluded.invoice_text, invoice_text),
+                        invoice_json = COALESCE(excluded.invoice_json, invoice_json),
+                        last_accessed = excluded.last_accessed
+                """, (cache_key, invoice_text, invoice_json, now, now))
+                self._evict(conn)
+        except sqlite3.Error as e:
+            logger.error(f"Extraction cache write failed: {e}")
+
+    def _evict(self, conn: sqlite3.Connection):
+        """Drop least recently used entries beyond max_entries, reading the trigger-maintained count."""
+        count = self._entries(conn)
+        overflow = count - self.max_entries
+        if overflow > 0:
+            conn.execute("""
+                DELETE FROM extraction_cache WHERE cache_key IN (
+                    SELECT cache_key FROM extraction_cache ORDER BY last_accessed ASC LIMIT ?
+                )
+            """, (overflow,))
+            logger.info(f"Evicted {overflow} entries from extraction cache")
+
+    def _entries(self, conn: sqlite3.Connection) -> int:
+        """Number of cached documents, without scanning the table."""
+        return conn.execute("SELECT entries FROM extraction_cache_size WHERE id = 0").fetchone()[0]
+
+    def stats(self) -> Dict[str, float]:
+        """Hit/miss counters for this process plus the current number of cached documents."""
+        try:
+            with self._connect() as conn:
+                entries = self._entries(conn)
+        except sqlite3.Error:
+            entries = 0
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries
+        }
+
+def get_extraction_cache() -> ExtractionCache:
+    """Return the process-wide extraction cache, creating it on first use."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ExtractionCache()
+    return _cache
@@ -2,23 +2,189 @@ from sentence_transformers import SentenceTransformer
 import faiss
 import numpy as np
 import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import List, Optional, Tuple
 from config.logging_config import logger
+from config.settings import (
+    RAG_INDEX_DIR,
+    RAG_INDEX_BACKEND,
+    RAG_IVF_NLIST,
+    RAG_IVF_NPROBE,
+    RAG_IVF_RETRAIN_FACTOR,
+    RAG_HNSW_M,
+    RAG_HNSW_EF_CONSTRUCTION,
+    RAG_HNSW_EF_SEARCH,
+    RAG_EMBEDDING_BATCH_SIZE
+)
 from data_processing.document_parser import extract_text_from_pdf
 
-model = SentenceTransformer('all-MiniLM-L6-v2')
+_model = None
+_model_lock = threading.Lock()
+_rag_index = None
+_rag_index_lock = threading.Lock()
+
+try:
+    import fcntl  # Cross-process append lock; unavailable on Windows
+except ImportError:
+    fcntl = None
+
+SEARCH_CHUNK_ROWS = 65536  # Vectors scanned per faiss.knn call
+ANN_BACKENDS = ("ivf", "hnsw")
+IVF_MIN_POINTS_PER_LIST = 39  # FAISS warns when k-means has fewer training points per centroid
+IVF_TRAINING_POINTS_PER_LIST = 256
+
+def get_embedding_model() -> SentenceTransformer:
+    """Load the SentenceTransformer once per process, on first use."""
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                logger.info("Loading SentenceTransformer model all-MiniLM-L6-v2")
+                _model = SentenceTransformer('all-MiniLM-L6-v2')
+    return _model
 
 def compute_embedding(text: str, dim: int = 384) -> np.ndarray:
     """Compute embedding for a given text using SentenceTransformer."""
-    embedding = model.encode(text)
+    embedding = get_embedding_model().encode(text)
     return np.array(embedding, dtype=np.float32)
 
+def compute_embeddings(texts: List[str], dim: int = 384, batch_size: int = RAG_EMBEDDING_BATCH_SIZE) -> np.ndarray:
+    """Compute embeddings for many texts in a single batched encode call."""
+    if not texts:
+        return np.empty((0, dim), dtype=np.float32)
+    embeddings = get_embedding_model().encode(list(texts), batch_size=batch_size, convert_to_numpy=True)
+    return np.asarray(embeddings, dtype=np.float32).reshape(len(texts), dim)
+
 class InvoiceRAGIndex:
-    def __init__(self, dim: int = 384):
+    """
+    Flat L2 index over embeddings persisted in an append-only file.
+
+    Vectors live in `embeddings.f32` (raw float32 rows) and are memory-mapped
+    on load, so startup cost and resident memory do not grow with the corpus.
+    `documents.jsonl` holds one metadata line per row. New invoices are
+    appended to both files without rebuilding anything.
+
+    With an "ivf" or "hnsw" backend, queries go to an approximate FAISS index
+    built by `train_ann_index()` and persisted next to the vectors. Rows
+    appended after training, by this or another process, are added to it
+    incrementally; an IVF index is retrained in a background thread once the
+    corpus outgrows its lists by RAG_IVF_RETRAIN_FACTOR.
+    """
+
+    def __init__(self, dim: int = 384, index_dir: str = RAG_INDEX_DIR, backend: str = RAG_INDEX_BACKEND):
+        if backend not in ("flat",) + ANN_BACKENDS:
+            raise ValueError(f"Unknown RAG index backend: {backend}")
         self.dim = dim
-        self.index = faiss.IndexFlatL2(dim)
-        self.documents = []  # List of dicts with invoice details
-        logger.debug(f"Initialized FAISS index with dimension {dim}")
-        self.load_test_samples()
+        self.backend = backend
+        self.index_dir = Path(index_dir)
+        self.vectors_path = self.index_dir / "embeddings.f32"
+        self.documents_path = self.index_dir / "documents.jsonl"
+        self.lock_path = self.index_dir / ".lock"
+        self.ann_path = self.index_dir / f"ann_{backend}.faiss"
+        self._ann = None  # Approximate index covering the first ntotal rows
+        self.nprobe = RAG_IVF_NPROBE
+        self.ef_search = RAG_HNSW_EF_SEARCH
+        self.documents = []  # List of dicts with invoice details, one per stored vector
+        self._documents_offset = 0  # Bytes of documents.jsonl already loaded
+        self._vectors = np.empty((0, dim), dtype=np.float32)
+        self._lock = threading.RLock()  # Guards the mapped vectors and documents for shared use across threads
+        self._retraining = False  # Set while a background IVF retrain is running
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        with self._file_lock():
+            self._refresh()
+            self._repair()
+        logger.debug(f"Loaded RAG index from {self.index_dir} with {len(self.documents)} documents (dimension {dim})")
+        if not self.documents:
+            self.load_test_samples()
+        if backend in ANN_BACKENDS:
+            self._load_ann_index()
+
+    @contextmanager
+    def _file_lock(self):
+        """Serialize appends with other processes sharing the index directory."""
+        with self._lock, open(self.lock_path, "a") as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _refresh(self):
+        """Pick up document lines appended since the last refresh and re-map the vector file."""
+        if self.documents_path.exists():
+            with open(self.documents_path, "rb") as f:
+                f.seek(self._documents_offset)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break  # Partially written line; picked up on a later refresh
+                    self._documents_offset += len(line)
+                    self.documents.append(json.loads(line))
+        rows = self.vectors_path.stat().st_size // (self.dim * 4) if self.vectors_path.exists() else 0
+        count = min(rows, len(self.documents))
+        if count:
+            self._vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(count, self.dim))
+        else:
+            self._vectors = np.empty((0, self.dim), dtype=np.float32)
+
+    def _repair(self):
+        """Drop trailing vectors or document lines left unpaired by an interrupted append."""
+        count = len(self._vectors)
+        if len(self.documents) > count:
+            logger.warning(f"Truncating {len(self.documents) - count} unpaired documents from RAG index")
+            self.documents = self.documents[:count]
+            with open(self.documents_path, "wb") as f:
+                for doc in self.documents:
+                    f.write(json.dumps(doc).encode() + b"\n")
+            self._documents_offset = self.documents_path.stat().st_size
+        if self.vectors_path.exists() and self.vectors_path.stat().st_size != count * self.dim * 4:
+            logger.warning("Truncating unpaired vectors from RAG index")
+            self._vectors = np.empty((0, self.dim), dtype=np.float32)  # Release the mapping before resizing
+            os.truncate(self.vectors_path, count * self.dim * 4)
+            self._refresh()
+
+    def _append(self, embeddings: np.ndarray, documents: List[dict]):
+        """Append vectors and their metadata to disk, then map the new rows."""
+        with self._file_lock():
+            self._refresh()
+            self._repair()
+            with open(self.vectors_path, "ab") as f:
+                f.write(np.ascontiguousarray(embeddings, dtype=np.float32).tobytes())
+            with open(self.documents_path, "ab") as f:
+                f.write(b"".join(json.dumps(doc).encode() + b"\n" for doc in documents))
+            self._refresh()
+        self._schedule_retrain()
+
+    def _refresh_if_grown(self):
+        """Map rows appended by other processes; a stat call when nothing changed."""
+        size = self.vectors_path.stat().st_size if self.vectors_path.exists() else 0
+        if size <= len(self._vectors) * self.dim * 4:
+            return
+        with self._file_lock():
+            self._refresh()
+        self._schedule_retrain()
+
+    def _schedule_retrain(self):
+        """Retrain an outgrown IVF index in a background thread, keeping appends and searches on the current one."""
+        with self._lock:
+            if self._retraining or not self._needs_retrain():
+                return
+            self._retraining = True
+        threading.Thread(target=self._retrain_in_background, name="rag-ivf-retrain", daemon=True).start()
+
+    def _retrain_in_background(self):
+        try:
+            self.train_ann_index()
+        except Exception as e:
+            logger.error(f"Background IVF retrain failed: {str(e)}")
+        finally:
+            with self._lock:
+                self._retraining = False
 
     def load_test_samples(self):
         """Load test sample invoices into the FAISS index."""
@@ -30,29 +196,166 @@ class InvoiceRAGIndex:
             "invoice_price_variance_example.pdf",
             "invoice_standard_example.pdf"
         ]
+        samples = []
         for sample in sample_files:
             path = os.path.join(test_dir, sample)
             if os.path.exists(path):
                 text = extract_text_from_pdf(path)
                 if text:
-                    self.add_invoice(sample, text)
+                    samples.append((sample, text))
                 else:
                     logger.warning(f"No text extracted from {sample}")
             else:
                 logger.warning(f"Sample file not found: {path}")
+        self.add_invoices_batch(samples)
 
     def add_invoice(self, invoice_id: str, invoice_text: str):
         embedding = compute_embedding(invoice_text, self.dim)
-        self.index.add(np.expand_dims(embedding, axis=0))
-        self.documents.append({'invoice_id': invoice_id, 'invoice_text': invoice_text})
+        self._append(np.expand_dims(embedding, axis=0), [{'invoice_id': invoice_id}])
         logger.info(f"Added invoice {invoice_id} to FAISS index")
 
+    def add_invoices_batch(self, invoices: List[Tuple[str, str]], batch_size: int = RAG_EMBEDDING_BATCH_SIZE):
+        """Embed and append many (invoice_id, invoice_text) pairs with one encode call and one append."""
+        if not invoices:
+            return
+        embeddings = compute_embeddings([text for _, text in invoices], self.dim, batch_size)
+        self._append(embeddings, [{'invoice_id': invoice_id} for invoice_id, _ in invoices])
+        logger.info(f"Added {len(invoices)} invoices to FAISS index")
+
+    def _load_ann_index(self):
+        """Load the persisted approximate index, training one if none exists yet."""
+        if self.ann_path.exists():
+            with self._lock:
+                self._ann = faiss.read_index(str(self.ann_path))
+                self._apply_search_params()
+            logger.info(f"Loaded {self.backend} index with {self._ann.ntotal} vectors from {self.ann_path}")
+            if self._needs_retrain():
+                self.train_ann_index()
+        else:
+            self.train_ann_index()
+
+    def _needs_retrain(self) -> bool:
+        """Whether the IVF index was trained on a corpus too small for the number of vectors now stored."""
+        with self._lock:
+            if not isinstance(self._ann, faiss.IndexIVF) or RAG_IVF_RETRAIN_FACTOR <= 0:
+                return False
+            nlist = self._ann.nlist
+            count = len(self._vectors)
+        if nlist >= RAG_IVF_NLIST:
+            return False
+        return count >= nlist * IVF_MIN_POINTS_PER_LIST * RAG_IVF_RETRAIN_FACTOR
+
+    def _apply_search_params(self):
+        if isinstance(self._ann, faiss.IndexIVF):
+            self._ann.nprobe = self.nprobe
+        elif isinstance(self._ann, faiss.IndexHNSW):
+            self._ann.hnsw.efSearch = self.ef_search
+
+    def set_search_params(self, nprobe: Optional[int] = None, ef_search: Optional[int] = None):
+        """Trade recall for speed: IVF lists probed per query, or HNSW search breadth."""
+        with self._lock:
+            self.nprobe = nprobe or self.nprobe
+            self.ef_search = ef_search or self.ef_search
+            self._apply_search_params()
+
+    def train_ann_index(self):
+        """Build the approximate index from all stored vectors and persist it."""
+        with self._lock:
+            vectors = self._vectors
+        count = len(vectors)
+        if self.backend == "ivf":
+            nlist = max(1, min(RAG_IVF_NLIST, count // IVF_MIN_POINTS_PER_LIST))
+            index = faiss.IndexIVFFlat(faiss.IndexFlatL2(self.dim), self.dim, nlist)
+            if count:
+                rng = np.random.default_rng(0)
+                sample_size = min(count, nlist * IVF_TRAINING_POINTS_PER_LIST)
+                sample = np.sort(rng.choice(count, size=sample_size, replace=False))
+                index.train(np.ascontiguousarray(vectors[sample]))
+            logger.info(f"Trained IVF index with {nlist} lists on {count} vectors")
+        else:
+            index = faiss.IndexHNSWFlat(self.dim, RAG_HNSW_M)
+            index.hnsw.efConstruction = RAG_HNSW_EF_CONSTRUCTION
+        if index.is_trained:
+            for start in range(0, count, SEARCH_CHUNK_ROWS):
+                index.add(np.ascontiguousarray(vectors[start:start + SEARCH_CHUNK_ROWS]))
+        with self._lock:
+            self._ann = index if index.is_trained else None
+            self._apply_search_params()
+        if self._ann is not None:
+            self.save_ann_index()
+
+    def save_ann_index(self):
+        """Persist the approximate index atomically."""
+        with self._lock:
+            if self._ann is None:
+                return
+            tmp_path = self.ann_path.with_suffix(".tmp")
+            faiss.write_index(self._ann, str(tmp_path))
+            os.replace(tmp_path, self.ann_path)
+        logger.info(f"Saved {self.backend} index with {self._ann.ntotal} vectors to {self.ann_path}")
+
+    def _flat_search(self, vectors: np.ndarray, queries: np.ndarray, k: int, offset: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+        """Exact L2 search over vectors, one chunk at a time to bound memory."""
+        distances = np.full((len(queries), 0), np.inf, dtype=np.float32)
+        ids = np.empty((len(queries), 0), dtype=np.int64)
+        for start in range(0, len(vectors), SEARCH_CHUNK_ROWS):
+            chunk = vectors[start:start + SEARCH_CHUNK_ROWS]
+            D, I = faiss.knn(queries, np.ascontiguousarray(chunk), min(k, len(chunk)))
+            distances, ids = _merge_results(distances, ids, D, np.where(I >= 0, I + start + offset, -1), k)
+        return distances, ids
+
+    def _search(self, queries: np.ndarray, k: int):
+        """Search the approximate index when one is trained, otherwise scan exactly."""
+        self._refresh_if_grown()
+        with self._lock:
+            vectors = self._vectors
+            if self._ann is None:
+                ann_results = None
+            else:
+                if self._ann.ntotal < len(vectors):
+                    # Rows appended since training, by this or another process
+                    self._ann.add(np.ascontiguousarray(vectors[self._ann.ntotal:]))
+                ann_results = self._ann.search(queries, k)
+        if ann_results is None:
+            return self._flat_search(vectors, queries, k)
+        return ann_results
+
+    def benchmark_recall(self, num_queries: int = 100, k: int = 10, seed: int = 0) -> dict:
+        """Measure recall@k and latency of the approximate index against the exact flat scan."""
+        with self._lock:
+            vectors = self._vectors
+        if self._ann is None or not len(vectors):
+            raise RuntimeError("Benchmark needs a trained approximate index and stored vectors")
+        rng = np.random.default_rng(seed)
+        rows = np.sort(rng.choice(len(vectors), size=min(num_queries, len(vectors)), replace=False))
+        queries = np.ascontiguousarray(vectors[rows])
+        queries += rng.normal(scale=0.01, size=queries.shape).astype(np.float32)  # Avoid trivial self-matches
+        start = time.perf_counter()
+        _, exact_ids = self._flat_search(vectors, queries, k)
+        flat_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        _, ann_ids = self._search(queries, k)
+        ann_seconds = time.perf_counter() - start
+        hits = sum(len(set(a[a >= 0]) & set(e[e >= 0])) for a, e in zip(ann_ids, exact_ids))
+        expected = sum(int((e >= 0).sum()) for e in exact_ids)
+        result = {
+            "backend": self.backend,
+            "vectors": len(vectors),
+            "queries": len(queries),
+            "k": k,
+            "recall": hits / expected if expected else 1.0,
+            "flat_ms_per_query": 1000 * flat_seconds / len(queries),
+            "ann_ms_per_query": 1000 * ann_seconds / len(queries)
+        }
+        logger.info(f"RAG recall benchmark: {result}")
+        return result
+
     def query_invoice(self, invoice_text: str, k: int = 1):
         embedding = compute_embedding(invoice_text, self.dim)
-        D, I = self.index.search(np.expand_dims(embedding, axis=0), k)
+        D, I = self._search(np.expand_dims(embedding, axis=0), k)
         results = []
         for idx, distance in zip(I[0], D[0]):
-            if idx < len(self.documents):
+            if 0 <= idx < len(self.documents):
                 doc = self.documents[idx]
                 results.append({
                     'invoice_id': doc['invoice_id'],
@@ -61,8 +364,28 @@ class InvoiceRAGIndex:
         logger.debug(f"Query results: {results}")
         return results
 
+    def query_batch(self, invoice_texts: List[str], k: int = 1, batch_size: int = RAG_EMBEDDING_BATCH_SIZE) -> List[List[dict]]:
+        """Query many invoices at once: one encode call and one index search."""
+        if not invoice_texts:
+            return []
+        D, I = self._search(compute_embeddings(invoice_texts, self.dim, batch_size), k)
+        return [
+            [
+                {'invoice_id': self.documents[idx]['invoice_id'], 'distance': float(distance)}
+                for idx, distance in zip(ids, distances)
+                if 0 <= idx < len(self.documents)
+            ]
+            for ids, distances in zip(I, D)
+        ]
+
     def classify_invoice(self, invoice_text: str, threshold: float = 0.1) -> dict:
-        results = self.query_invoice(invoice_text, k=1)
+        return self._classify(self.query_invoice(invoice_text, k=1), threshold)
+
+    def classify_batch(self, invoice_texts: List[str], threshold: float = 0.1, batch_size: int = RAG_EMBEDDING_BATCH_SIZE) -> List[dict]:
+        """Classify many invoices with a single batched embedding pass."""
+        return [self._classify(results, threshold) for results in self.query_batch(invoice_texts, 1, batch_size)]
+
+    def _classify(self, results: List[dict], threshold: float) -> dict:
         if results and results[0]['distance'] < threshold:
             classification = {
                 'status': 'similar_error',
@@ -75,8 +398,32 @@ class InvoiceRAGIndex:
             logger.info("Invoice classified as novel")
         return classification
 
+def _merge_results(D1: np.ndarray, I1: np.ndarray, D2: np.ndarray, I2: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Keep the k nearest of two per-query result sets."""
+    distances = np.hstack([D1, D2])
+    ids = np.hstack([I1, I2])
+    order = np.argsort(distances, axis=1)[:, :k]
+    return np.take_along_axis(distances, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+def get_rag_index() -> InvoiceRAGIndex:
+    """Return the process-wide RAG index, building it once on first use."""
+    global _rag_index
+    if _rag_index is None:
+        with _rag_index_lock:
+            if _rag_index is None:
+                _rag_index = InvoiceRAGIndex()
+    return _rag_index
+
 if __name__ == "__main__":
-    rag = InvoiceRAGIndex()
+    import sys
+    rag = get_rag_index()
+    if "--retrain" in sys.argv:
+        if rag.backend not in ANN_BACKENDS:
+            print(f"Nothing to retrain: RAG_INDEX_BACKEND is {rag.backend!r}")
+        else:
+            rag.train_ann_index()
+    if "--benchmark" in sys.argv:
+        print(rag.benchmark_recall())
     new_invoice_text = "This invoice content seems to lack a product code."
     classification = rag.classify_invoice(new_invoice_text, threshold=0.5)
     print(classification)
\ No newline at end of file
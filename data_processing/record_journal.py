@@ -0,0 +1,224 @@
+# Append-only JSONL journal for processed invoice and anomaly records
+
+import os
+import json
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+from config.logging_config import logger
+from config.settings import JOURNAL_COMPACT_MIN_LINES, JOURNAL_SNAPSHOT_EVERY
+
+try:
+    import fcntl  # Cross-process append lock; unavailable on Windows
+except ImportError:
+    fcntl = None
+
+_journals: Dict[Path, "RecordJournal"] = {}
+_journals_lock = threading.Lock()
+
+class RecordJournal:
+    """
+    Keyed records persisted as an append-only JSONL log.
+
+    Each upsert appends one {"slot", "record"} line instead of rewriting the
+    whole file; replaying the log in order (last write per slot wins) rebuilds
+    the records. In-memory indexes on `index_fields` make lookups O(1). The log
+    is compacted once it holds more than twice as many lines as live records.
+    The legacy JSON array snapshot is rewritten on compaction and by
+    snapshot() (called at shutdown); setting `snapshot_every` additionally
+    refreshes it every that many appends from this process, at the cost of
+    rewriting every record each time.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        index_fields: Tuple[str, ...],
+        legacy_path: Optional[Path] = None,
+        compact_min_lines: int = JOURNAL_COMPACT_MIN_LINES,
+        snapshot_every: int = JOURNAL_SNAPSHOT_EVERY
+    ):
+        self.path = Path(path)
+        self.lock_path = self.path.with_suffix(self.path.suffix + ".lock")
+        self.index_fields = index_fields
+        self.legacy_path = Path(legacy_path) if legacy_path else None
+        self.compact_min_lines = compact_min_lines
+        self.snapshot_every = snapshot_every
+        self._unsnapshotted = 0  # Appends by this process since the legacy snapshot was last written
+        self._lock = threading.RLock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._file_lock():
+            if not self.path.exists():
+                self._import_legacy()
+            self._reload()
+        logger.debug(f"Opened journal {self.path} with {len(self.records)} records")
+
+    @contextmanager
+    def _file_lock(self):
+        """Serialize appends and compaction with other processes sharing the journal."""
+        with self._lock, open(self.lock_path, "a") as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _import_legacy(self):
+        """Seed a new journal from the legacy JSON array file, if one exists."""
+        records = []
+        if self.legacy_path and self.legacy_path.exists():
+            try:
+                with open(self.legacy_path, "r") as f:
+                    records = json.load(f)
+                logger.info(f"Importing {len(records)} records from {self.legacy_path} into {self.path}")
+            except json.JSONDecodeError as e:
+                logger.error(f"Could not import {self.legacy_path}: {e}")
+        self._write_compacted(records)
+
+    def _reload(self):
+        self.records: Dict[int, dict] = {}
+        self.index: Dict[str, Dict[Any, Set[int]]] = {field: {} for field in self.index_fields}
+        self._offset = 0
+        self._lines = 0
+        self._inode = os.stat(self.path).st_ino
+        self._refresh()
+
+    def _refresh(self):
+        """Replay lines appended since the last refresh; reload if another process compacted."""
+        stat = os.stat(self.path)
+        if stat.st_ino != self._inode or stat.st_size < self._offset:
+            self._reload()
+            return
+        with open(self.path, "rb") as f:
+            f.seek(self._offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # Only reachable under the file lock, so this is a torn write from a crash
+                    logger.warning(f"Truncating partial trailing line in {self.path}")
+                    os.truncate(self.path, self._offset)
+                    break
+                self._offset += len(line)
+                self._lines += 1
+                entry = json.loads(line)
+                self._set(entry["slot"], entry["record"])
+
+    def _keys(self, record: dict) -> Iterable[Tuple[str, Any]]:
+        for field in self.index_fields:
+            value = record.get(field)
+            if isinstance(value, (str, int, float, type(None))):
+                yield field, value
+
+    def _set(self, slot: int, record: dict):
+        old = self.records.get(slot)
+        if old is not None:
+            for field, value in self._keys(old):
+                self.index[field][value].discard(slot)
+        self.records[slot] = record
+        for field, value in self._keys(record):
+            self.index[field].setdefault(value, set()).add(slot)
+
+    def _find(self, record: dict, match_on: Iterable[str]) -> Optional[int]:
+        """Earliest slot matching the record on any of the given fields, like a front-to-back scan."""
+        slots = set()
+        for field in match_on:
+            slots |= self.index[field].get(record.get(field), set())
+        return min(slots) if slots else None
+
+    def upsert(self, record: dict, match_on: Iterable[str]):
+        """Replace the first record matching on any `match_on` field, or append a new one."""
+        with self._file_lock():
+            self._refresh()
+            slot = self._find(record, match_on)
+            if slot is None:
+                slot = max(self.records, default=-1) + 1
+            line = (json.dumps({"slot": slot, "record": record}, default=str) + "\n").encode()
+            with open(self.path, "ab") as f:
+                f.write(line)
+            self._offset += len(line)
+            self._lines += 1
+            self._set(slot, record)
+            self._unsnapshotted += 1
+            if self._lines >= max(self.compact_min_lines, 2 * len(self.records)):
+                self._compact()
+            elif self.snapshot_every and self._unsnapshotted >= self.snapshot_every:
+                self._write_snapshot()
+
+    def get(self, field: str, value: Any) -> Optional[dict]:
+        with self._file_lock():
+            self._refresh()
+            slots = self.index[field].get(value)
+            return self.records[min(slots)] if slots else None
+
+    def all(self) -> List[dict]:
+        """Live records in insertion order."""
+        with self._file_lock():
+            self._refresh()
+            return [self.records[slot] for slot in sorted(self.records)]
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def compact(self):
+        """Rewrite the journal with one line per live record and refresh the legacy snapshot."""
+        with self._file_lock():
+            self._refresh()
+            self._compact()
+
+    def snapshot(self):
+        """Rewrite the legacy JSON array snapshot from the current records."""
+        with self._file_lock():
+            self._refresh()
+            self._write_snapshot()
+
+    def _compact(self):
+        # Caller holds the file lock; flock is per open file, so it must not be re-acquired here
+        records = [self.records[slot] for slot in sorted(self.records)]
+        self._write_compacted(records)
+        self._write_snapshot(records)
+        self._reload()
+        logger.info(f"Compacted {self.path} to {len(records)} records")
+
+    def _write_snapshot(self, records: Optional[List[dict]] = None):
+        # Caller holds the file lock
+        if self.legacy_path:
+            if records is None:
+                records = [self.records[slot] for slot in sorted(self.records)]
+            self._write_atomic(self.legacy_path, json.dumps(records, indent=4, default=str).encode())
+            logger.debug(f"Wrote snapshot of {len(records)} records to {self.legacy_path}")
+        self._unsnapshotted = 0
+
+    def _write_compacted(self, records: List[dict]):
+        self._write_atomic(self.path, b"".join(
+            (json.dumps({"slot": slot, "record": record}, default=str) + "\n").encode()
+            for slot, record in enumerate(records)
+        ))
+
+    @staticmethod
+    def _write_atomic(path: Path, data: bytes):
+        tmp_path = path.with_suffix(path.suffix + ".tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+def snapshot_journals():
+    """Refresh the legacy snapshot of every journal opened by this process, e.g. at shutdown."""
+    with _journals_lock:
+        journals = list(_journals.values())
+    for journal in journals:
+        journal.snapshot()
+
+def get_journal(path: Path, index_fields: Tuple[str, ...], legacy_path: Optional[Path] = None) -> RecordJournal:
+    """Return the process-wide journal for a path, opening it once on first use."""
+    key = Path(path).resolve()
+    journal = _journals.get(key)
+    if journal is None:
+        with _journals_lock:
+            journal = _journals.get(key)
+            if journal is None:
+                journal = _journals[key] = RecordJournal(path, index_fields, legacy_path)
+    return journal
@@ -0,0 +1,61 @@
+# /data_processing/vendor_index.py
+
+from collections import Counter, defaultdict
+from typing import Dict, List
+import numpy as np
+from config.logging_config import setup_logging
+
+logger = setup_logging()
+
+def sort_tokens(name: str) -> str:
+    """Token-sorted form of a normalized name, as compared by token_sort_ratio."""
+    return " ".join(sorted(name.split()))
+
+def _ngrams(text: str, n: int) -> Counter:
+    return Counter(text[i:i + n] for i in range(len(text) - n + 1))
+
+class VendorBlockingIndex:
+    """
+    Character n-gram inverted index that shortlists vendors for fuzzy scoring.
+
+    token_sort_ratio is a normalized InDel similarity on the token-sorted
+    strings, so a score above `threshold` bounds the InDel distance d by
+    (1 - threshold) * (len_a + len_b). Each insertion or deletion destroys at
+    most n of a string's n-grams, so a true match shares at least
+    max(len_a, len_b) - n + 1 - n * d n-grams with the query and differs in
+    length by at most d. Candidates failing either bound cannot reach the
+    threshold, which keeps results identical to scoring every vendor.
+    Bigrams are the default: at a 0.85 threshold the trigram bound is
+    vacuous for names shorter than about 25 characters.
+    """
+
+    def __init__(self, normalized_names: List[str], threshold: float, ngram_size: int = 2):
+        self.threshold = threshold
+        self.n = ngram_size
+        keys = [sort_tokens(name) for name in normalized_names]
+        self.lengths = np.array([len(key) for key in keys], dtype=np.int32)
+        postings: Dict[str, List[tuple]] = defaultdict(list)
+        for row, key in enumerate(keys):
+            for gram, count in _ngrams(key, self.n).items():
+                postings[gram].append((row, count))
+        self.postings = {
+            gram: (np.array([row for row, _ in entries], dtype=np.int32),
+                   np.array([count for _, count in entries], dtype=np.int32))
+            for gram, entries in postings.items()
+        }
+        logger.info(f"Built vendor blocking index over {len(keys)} vendors with {len(self.postings)} {self.n}-grams")
+
+    def candidates(self, normalized_name: str) -> np.ndarray:
+        """Rows that can score above the threshold against a normalized name, in ascending order."""
+        key = sort_tokens(normalized_name)
+        query_length = len(key)
+        shared = np.zeros(len(self.lengths), dtype=np.int32)
+        for gram, query_count in _ngrams(key, self.n).items():
+            if gram in self.postings:
+                rows, counts = self.postings[gram]
+                shared[rows] += np.minimum(counts, query_count)
+        # Small epsilon keeps the bound conservative against float rounding
+        max_distance = np.floor((1 - self.threshold) * (query_length + self.lengths) + 1e-9)
+        min_shared = np.maximum(query_length, self.lengths) - self.n + 1 - self.n * max_distance
+        mask = (np.abs(query_length - self.lengths) <= max_distance) & (shared >= min_shared)
+        return np.flatnonzero(mask)
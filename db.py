@@ -1,11 +1,44 @@
 import sqlite3
 from pathlib import Path
-from typing import Dict, Any, List, Optional, Tuple
+from typing import Dict, Any, List, Optional, Tuple, Callable
 from contextlib import contextmanager
+import os
 import time
-from functools import wraps
+import math
+import json
+import base64
+import threading
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps, partial
 import logging
 from config.logging_config import logger
+from config.settings import (
+    DB_BUSY_TIMEOUT_MS, DB_CACHE_SIZE_KB, DB_SYNCHRONOUS, DB_EXECUTOR_WORKERS, DB_COUNT_CACHE_TTL,
+    DB_BULK_INSERT_CHUNK_SIZE
+)
+
+DEFAULT_DB_PATH = Path(__file__).parent / "invoices.db"
+
+# Per-thread connections keyed by database path, and paths whose schema is already initialized
+_local = threading.local()
+_schema_ready = set()
+_schema_lock = threading.Lock()
+_db = None
+_async_db = None
+# Cached invoice totals per database path: (count, expires_at)
+_count_cache: Dict[str, Tuple[int, float]] = {}
+
+# Columns written by invoice inserts, in placeholder order; the first six are required
+INVOICE_INSERT_COLUMNS = (
+    'invoice_number', 'vendor_name', 'invoice_date',
+    'total_amount', 'status', 'pdf_url', 'confidence', 'total_time'
+)
+INVOICE_REQUIRED_FIELDS = set(INVOICE_INSERT_COLUMNS[:6])
+
+# Sortable invoice columns; each has a (column, id) index backing keyset pagination
+INVOICE_SORT_FIELDS = ('created_at', 'invoice_number', 'vendor_name', 'invoice_date', 'total_amount', 'status')
+_db_lock = threading.Lock()
 
 def retry_on_error(max_attempts: int = 3, delay: float = 0.1):
     def decorator(func):
@@ -26,54 +59,448 @@ def retry_on_error(max_attempts: int = 3, delay: float = 0.1):
         return wrapper
     return decorator
 
+# Log-spaced buckets (5% wide) for the anomaly total histogram; non-positive totals share the lowest bucket.
+# Each bucket is split into fine sub-buckets (about 0.05% wide) so a median lookup never scans a whole bucket
+TOTAL_BUCKET_BASE = 1.05
+FINE_BUCKETS_PER_BUCKET = 100
+NON_POSITIVE_BUCKET = -(2 ** 31)
+
+# Per-vendor outlier model state persisted alongside the running sums in anomaly_vendor_stats
+VENDOR_MODEL_COLUMNS = ("mean", "m2", "median", "mad", "p05", "p95")
+
+def fine_total_bucket(total: float) -> int:
+    """Fine histogram bucket of an invoice total, monotonic in the total."""
+    if total <= 0:
+        return NON_POSITIVE_BUCKET * FINE_BUCKETS_PER_BUCKET
+    return math.floor(math.log(total) / math.log(TOTAL_BUCKET_BASE) * FINE_BUCKETS_PER_BUCKET)
+
+def total_bucket(total: float) -> int:
+    """Histogram bucket of an invoice total, monotonic in the total; the bucket containing its fine bucket."""
+    return fine_total_bucket(total) // FINE_BUCKETS_PER_BUCKET
+
+def _select_rank(rows, key: str, rank: int) -> Optional[Tuple[Any, int]]:
+    """Walk (key, count) rows in order to the one holding the rank-th item; returns (key, rank within it)."""
+    for row in rows:
+        if rank < row['count']:
+            return row[key], rank
+        rank -= row['count']
+    return None
+
+def _execute_script(cursor, script: str):
+    """Run a multi-statement script inside the current transaction (executescript would commit first)."""
+    statement = ""
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            cursor.execute(statement)
+            statement = ""
+
+def _migrate_baseline(cursor):
+    """Schema as it stood before versioning; idempotent so existing databases adopt it safely."""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS invoice_metadata (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            invoice_number TEXT UNIQUE NOT NULL,
+            vendor_name TEXT NOT NULL,
+            invoice_date TEXT NOT NULL,
+            total_amount REAL NOT NULL,
+            status TEXT NOT NULL,
+            pdf_url TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            confidence REAL DEFAULT 0.0,
+            total_time REAL DEFAULT 0.0
+        )
+    """)
+
+    # Add new columns if they don't exist
+    try:
+        cursor.execute("ALTER TABLE invoice_metadata ADD COLUMN confidence REAL DEFAULT 0.0")
+    except sqlite3.OperationalError:
+        logger.debug("confidence column already exists")
+
+    try:
+        cursor.execute("ALTER TABLE invoice_metadata ADD COLUMN total_time REAL DEFAULT 0.0")
+    except sqlite3.OperationalError:
+        logger.debug("total_time column already exists")
+
+    # Anomaly detection history shared by every worker process
+    _execute_script(cursor, """
+        CREATE TABLE IF NOT EXISTS anomaly_invoice_index (
+            invoice_number TEXT PRIMARY KEY,
+            vendor_name TEXT,
+            first_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE TABLE IF NOT EXISTS anomaly_totals (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            bucket INTEGER NOT NULL,
+            total_amount REAL NOT NULL,
+            vendor_name TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_anomaly_totals_bucket
+            ON anomaly_totals (bucket, total_amount);
+        CREATE TABLE IF NOT EXISTS anomaly_total_histogram (
+            bucket INTEGER PRIMARY KEY,
+            count INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS anomaly_vendor_stats (
+            vendor_name TEXT PRIMARY KEY,
+            invoice_count INTEGER NOT NULL,
+            total_sum REAL NOT NULL,
+            total_sum_sq REAL NOT NULL,
+            mean REAL DEFAULT 0.0,
+            m2 REAL DEFAULT 0.0,
+            median REAL DEFAULT 0.0,
+            mad REAL DEFAULT 0.0,
+            p05 REAL DEFAULT 0.0,
+            p95 REAL DEFAULT 0.0
+        );
+    """)
+
+    # Add per-vendor outlier model columns if they don't exist
+    try:
+        cursor.execute("ALTER TABLE anomaly_totals ADD COLUMN vendor_name TEXT")
+    except sqlite3.OperationalError:
+        logger.debug("anomaly_totals.vendor_name column already exists")
+
+    for column in VENDOR_MODEL_COLUMNS:
+        try:
+            cursor.execute(f"ALTER TABLE anomaly_vendor_stats ADD COLUMN {column} REAL DEFAULT 0.0")
+        except sqlite3.OperationalError:
+            logger.debug(f"anomaly_vendor_stats.{column} column already exists")
+
+    # Anomalies flagged for review; the full record is kept as JSON in `data`
+    _execute_script(cursor, """
+        CREATE TABLE IF NOT EXISTS anomalies (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            file_name TEXT,
+            invoice_number TEXT,
+            vendor_name TEXT,
+            type TEXT,
+            reason TEXT,
+            confidence REAL DEFAULT 0.0,
+            review_status TEXT NOT NULL DEFAULT 'needs_review',
+            timestamp TEXT NOT NULL DEFAULT '',
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_anomalies_review_status ON anomalies (review_status, timestamp, id);
+        CREATE INDEX IF NOT EXISTS idx_anomalies_timestamp ON anomalies (timestamp, id);
+        CREATE INDEX IF NOT EXISTS idx_anomalies_file_name ON anomalies (file_name);
+        CREATE INDEX IF NOT EXISTS idx_anomalies_invoice_number ON anomalies (invoice_number);
+    """)
+
+def _migrate_hot_query_indexes(cursor):
+    # (column, id) indexes serve keyset pagination, the created_at window in
+    # get_recent_metrics and the GROUP BY in get_status_counts
+    for field in INVOICE_SORT_FIELDS:
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_invoice_{field}_id ON invoice_metadata ({field}, id)")
+
+# Hot queries, shared with verify_hot_query_plans so the plan check covers the exact SQL
+STATUS_COUNTS_SQL = """
+    SELECT status, invoice_count as count
+    FROM invoice_status_rollup
+    WHERE invoice_count > 0
+"""
+# Whole hourly buckets after the boundary hour come from the rollup; the
+# partial boundary hour is counted exactly through the created_at index
+RECENT_BUCKETS_SQL = """
+    SELECT 
+        COALESCE(SUM(invoice_count), 0) as total_count,
+        COALESCE(SUM(low_confidence_count), 0) as low_confidence_count,
+        COALESCE(SUM(valid_count), 0) as valid_count,
+        COALESCE(SUM(review_count), 0) as review_count,
+        COALESCE(SUM(total_time_sum), 0) as total_time_sum,
+        COALESCE(SUM(total_time_count), 0) as total_time_count
+    FROM invoice_hourly_rollup
+    WHERE hour > substr(:boundary, 1, 13)
+"""
+RECENT_METRICS_SQL = """
+    SELECT 
+        COUNT(*) as total_count,
+        COUNT(CASE WHEN confidence < 0.7 THEN 1 END) as low_confidence_count,
+        COUNT(CASE WHEN status = 'valid' THEN 1 END) as valid_count,
+        COUNT(CASE WHEN status = 'needs_review' THEN 1 END) as review_count,
+        COALESCE(SUM(total_time), 0) as total_time_sum,
+        COUNT(total_time) as total_time_count
+    FROM invoice_metadata
+    WHERE created_at >= :boundary
+      AND created_at < datetime(substr(:boundary, 1, 13) || ':00:00', '+1 hour')
+"""
+# MIN/MAX are answered from the confidence and total_time indexes
+EXTREMES_SQL = """
+    SELECT
+        (SELECT MIN(confidence) FROM invoice_metadata) as min_confidence,
+        (SELECT MAX(confidence) FROM invoice_metadata) as max_confidence,
+        (SELECT MIN(total_time) FROM invoice_metadata WHERE total_time > 0) as min_time,
+        (SELECT MAX(total_time) FROM invoice_metadata WHERE total_time > 0) as max_time
+"""
+
+def invoices_page_sql(sort_by: str, order: str, keyset: bool) -> str:
+    """Page query ordered on (sort_by, id); keyset pages take (value, id, limit), others (limit, offset)."""
+    where = f"WHERE ({sort_by}, id) {'<' if order == 'desc' else '>'} (?, ?)" if keyset else ""
+    return f"""
+        SELECT 
+            id, invoice_number, vendor_name, invoice_date,
+            total_amount, status, pdf_url, created_at,
+            confidence, total_time
+        FROM invoice_metadata
+        {where}
+        ORDER BY {sort_by} {order}, id {order}
+        LIMIT ? {'' if keyset else 'OFFSET ?'}
+    """
+
+def _rollup_delta(row: str, sign: str) -> str:
+    """Trigger body adding (sign '+') or removing (sign '-') one invoice row (NEW or OLD) from the rollups."""
+    return f"""
+        UPDATE invoice_rollup SET
+            invoice_count = invoice_count {sign} 1,
+            confidence_count = confidence_count {sign} ({row}.confidence IS NOT NULL),
+            confidence_sum = confidence_sum {sign} COALESCE({row}.confidence, 0),
+            low_confidence_count = low_confidence_count {sign} COALESCE({row}.confidence < 0.7, 0),
+            timed_count = timed_count {sign} COALESCE({row}.total_time > 0, 0),
+            timed_sum = timed_sum {sign} (CASE WHEN {row}.total_time > 0 THEN {row}.total_time ELSE 0 END)
+        WHERE id = 1;
+        INSERT INTO invoice_status_rollup (status, invoice_count) VALUES ({row}.status, {sign}1)
+            ON CONFLICT(status) DO UPDATE SET invoice_count = invoice_count + excluded.invoice_count;
+        INSERT INTO invoice_hourly_rollup (
+            hour, invoice_count, low_confidence_count, valid_count, review_count, total_time_sum, total_time_count
+        ) VALUES (
+            COALESCE(substr({row}.created_at, 1, 13), ''),
+            {sign}1,
+            {sign}COALESCE({row}.confidence < 0.7, 0),
+            {sign}({row}.status = 'valid'),
+            {sign}({row}.status = 'needs_review'),
+            {sign}COALESCE({row}.total_time, 0),
+            {sign}({row}.total_time IS NOT NULL)
+        ) ON CONFLICT(hour) DO UPDATE SET
+            invoice_count = invoice_count + excluded.invoice_count,
+            low_confidence_count = low_confidence_count + excluded.low_confidence_count,
+            valid_count = valid_count + excluded.valid_count,
+            review_count = review_count + excluded.review_count,
+            total_time_sum = total_time_sum + excluded.total_time_sum,
+            total_time_count = total_time_count + excluded.total_time_count;
+    """
+
+def _migrate_metric_rollups(cursor):
+    """Counters, per-status counts and hourly buckets kept current by triggers, backfilled from existing rows."""
+    _execute_script(cursor, f"""
+        CREATE TABLE IF NOT EXISTS invoice_rollup (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            invoice_count INTEGER NOT NULL DEFAULT 0,
+            confidence_count INTEGER NOT NULL DEFAULT 0,
+            confidence_sum REAL NOT NULL DEFAULT 0,
+            low_confidence_count INTEGER NOT NULL DEFAULT 0,
+            timed_count INTEGER NOT NULL DEFAULT 0,
+            timed_sum REAL NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS invoice_status_rollup (
+            status TEXT PRIMARY KEY,
+            invoice_count INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS invoice_hourly_rollup (
+            hour TEXT PRIMARY KEY,
+            invoice_count INTEGER NOT NULL DEFAULT 0,
+            low_confidence_count INTEGER NOT NULL DEFAULT 0,
+            valid_count INTEGER NOT NULL DEFAULT 0,
+            review_count INTEGER NOT NULL DEFAULT 0,
+            total_time_sum REAL NOT NULL DEFAULT 0,
+            total_time_count INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS idx_invoice_confidence ON invoice_metadata (confidence);
+        CREATE INDEX IF NOT EXISTS idx_invoice_total_time ON invoice_metadata (total_time);
+
+        DELETE FROM invoice_rollup;
+        INSERT INTO invoice_rollup (
+            id, invoice_count, confidence_count, confidence_sum, low_confidence_count, timed_count, timed_sum
+        )
+        SELECT
+            1, COUNT(*), COUNT(confidence), COALESCE(SUM(confidence), 0),
+            COUNT(CASE WHEN confidence < 0.7 THEN 1 END),
+            COUNT(CASE WHEN total_time > 0 THEN 1 END),
+            COALESCE(SUM(CASE WHEN total_time > 0 THEN total_time ELSE 0 END), 0)
+        FROM invoice_metadata;
+        DELETE FROM invoice_status_rollup;
+        INSERT INTO invoice_status_rollup (status, invoice_count)
+        SELECT status, COUNT(*) FROM invoice_metadata GROUP BY status;
+        DELETE FROM invoice_hourly_rollup;
+        INSERT INTO invoice_hourly_rollup (
+            hour, invoice_count, low_confidence_count, valid_count, review_count, total_time_sum, total_time_count
+        )
+        SELECT
+            COALESCE(substr(created_at, 1, 13), ''), COUNT(*),
+            COUNT(CASE WHEN confidence < 0.7 THEN 1 END),
+            COUNT(CASE WHEN status = 'valid' THEN 1 END),
+            COUNT(CASE WHEN status = 'needs_review' THEN 1 END),
+            COALESCE(SUM(total_time), 0), COUNT(total_time)
+        FROM invoice_metadata
+        GROUP BY 1;
+
+        CREATE TRIGGER IF NOT EXISTS trg_invoice_rollup_insert AFTER INSERT ON invoice_metadata
+        BEGIN
+            {_rollup_delta("NEW", "+")}
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_invoice_rollup_delete AFTER DELETE ON invoice_metadata
+        BEGIN
+            {_rollup_delta("OLD", "-")}
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_invoice_rollup_update
+        AFTER UPDATE OF status, confidence, total_time, created_at ON invoice_metadata
+        BEGIN
+            {_rollup_delta("OLD", "-")}
+            {_rollup_delta("NEW", "+")}
+        END;
+    """)
+
+def _migrate_anomaly_document_hash(cursor):
+    # Lets a re-run of the same document be told apart from a second document reusing its invoice number
+    try:
+        cursor.execute("ALTER TABLE anomaly_invoice_index ADD COLUMN document_hash TEXT")
+    except sqlite3.OperationalError:
+        logger.debug("anomaly_invoice_index.document_hash column already exists")
+
+def _migrate_anomaly_total_order_statistics(cursor):
+    """Fine histogram and per-value counts under the bucket histogram, backfilled from the recorded totals."""
+    _execute_script(cursor, """
+        CREATE TABLE IF NOT EXISTS anomaly_total_fine_histogram (
+            fine_bucket INTEGER PRIMARY KEY,
+            count INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS anomaly_total_values (
+            fine_bucket INTEGER NOT NULL,
+            total_amount REAL NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (fine_bucket, total_amount)
+        ) WITHOUT ROWID;
+        DELETE FROM anomaly_total_histogram;
+        DELETE FROM anomaly_total_fine_histogram;
+        DELETE FROM anomaly_total_values;
+    """)
+    values = cursor.execute("SELECT total_amount, COUNT(*) FROM anomaly_totals GROUP BY total_amount").fetchall()
+    rows = [(fine_total_bucket(total), total, count) for total, count in values]
+    cursor.executemany("INSERT INTO anomaly_total_values (fine_bucket, total_amount, count) VALUES (?, ?, ?)", rows)
+    cursor.execute("""
+        INSERT INTO anomaly_total_fine_histogram (fine_bucket, count)
+        SELECT fine_bucket, SUM(count) FROM anomaly_total_values GROUP BY fine_bucket
+    """)
+    cursor.execute(f"""
+        INSERT INTO anomaly_total_histogram (bucket, count)
+        SELECT fine_bucket / {FINE_BUCKETS_PER_BUCKET} - (fine_bucket % {FINE_BUCKETS_PER_BUCKET} < 0), SUM(count)
+        FROM anomaly_total_fine_histogram GROUP BY 1
+    """)
+
+def _migrate_anomaly_run_id(cursor):
+    # Identifies the pipeline run that recorded an invoice, so that run's own retries are not duplicates;
+    # supersedes document_hash, which also hid genuine resubmissions of an identical PDF
+    try:
+        cursor.execute("ALTER TABLE anomaly_invoice_index ADD COLUMN run_id TEXT")
+    except sqlite3.OperationalError:
+        logger.debug("anomaly_invoice_index.run_id column already exists")
+
+def _migrate_anomaly_status_rollup(cursor):
+    """Per-review-status anomaly counts kept current by triggers, so page totals never scan the table."""
+    _execute_script(cursor, """
+        CREATE TABLE IF NOT EXISTS anomaly_status_rollup (
+            review_status TEXT PRIMARY KEY,
+            anomaly_count INTEGER NOT NULL DEFAULT 0
+        );
+        DELETE FROM anomaly_status_rollup;
+        INSERT INTO anomaly_status_rollup (review_status, anomaly_count)
+        SELECT review_status, COUNT(*) FROM anomalies GROUP BY review_status;
+
+        CREATE TRIGGER IF NOT EXISTS trg_anomaly_rollup_insert AFTER INSERT ON anomalies
+        BEGIN
+            INSERT INTO anomaly_status_rollup (review_status, anomaly_count) VALUES (NEW.review_status, 1)
+                ON CONFLICT(review_status) DO UPDATE SET anomaly_count = anomaly_count + 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_anomaly_rollup_delete AFTER DELETE ON anomalies
+        BEGIN
+            UPDATE anomaly_status_rollup SET anomaly_count = anomaly_count - 1 WHERE review_status = OLD.review_status;
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_anomaly_rollup_update AFTER UPDATE OF review_status ON anomalies
+        BEGIN
+            UPDATE anomaly_status_rollup SET anomaly_count = anomaly_count - 1 WHERE review_status = OLD.review_status;
+            INSERT INTO anomaly_status_rollup (review_status, anomaly_count) VALUES (NEW.review_status, 1)
+                ON CONFLICT(review_status) DO UPDATE SET anomaly_count = anomaly_count + 1;
+        END;
+    """)
+
+# Ordered schema migrations; PRAGMA user_version records the last one applied
+MIGRATIONS = [
+    (1, "baseline invoice, anomaly history and anomalies tables", _migrate_baseline),
+    (2, "indexes for pagination, status counts and recent metrics", _migrate_hot_query_indexes),
+    (3, "trigger-maintained rollups for dashboard metrics", _migrate_metric_rollups),
+    (4, "document hash on the anomaly invoice index", _migrate_anomaly_document_hash),
+    (5, "order statistics for the anomaly total median", _migrate_anomaly_total_order_statistics),
+    (6, "pipeline run id on the anomaly invoice index", _migrate_anomaly_run_id),
+    (7, "trigger-maintained anomaly counts per review status", _migrate_anomaly_status_rollup),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
 class InvoiceDB:
-    def __init__(self):
-        self.db_path = Path(__file__).parent / "invoices.db"
-        self._init_db()
+    def __init__(self, db_path: Optional[Path] = None):
+        self.db_path = Path(db_path or DEFAULT_DB_PATH)
+        # Schema setup runs once per database file per process, not per instance
+        key = str(self.db_path.resolve())
+        if key not in _schema_ready:
+            with _schema_lock:
+                if key not in _schema_ready:
+                    self._init_db()
+                    _schema_ready.add(key)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(str(self.db_path), timeout=DB_BUSY_TIMEOUT_MS / 1000)
+        conn.row_factory = sqlite3.Row
+        # WAL lets readers proceed while a writer commits; NORMAL sync is durable across app crashes in WAL mode
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+        logger.debug(f"Opened pooled connection to {self.db_path} in thread {threading.get_ident()}")
+        return conn
 
     @contextmanager
     def get_connection(self):
-        """Context manager for database connections."""
-        conn = sqlite3.connect(str(self.db_path))
-        conn.row_factory = sqlite3.Row
+        """Context manager yielding this thread's pooled connection to the database."""
+        connections = getattr(_local, "connections", None)
+        if connections is None or getattr(_local, "pid", None) != os.getpid():
+            # Never reuse connections inherited across fork
+            connections = _local.connections = {}
+            _local.pid = os.getpid()
+        key = str(self.db_path)
+        conn = connections.get(key)
+        if conn is None:
+            conn = connections[key] = self._connect()
         try:
             yield conn
         finally:
+            # Don't leave a half-finished transaction holding locks on the shared connection
+            if conn.in_transaction:
+                conn.rollback()
+
+    def close(self):
+        """Close this thread's pooled connection, if any."""
+        connections = getattr(_local, "connections", {})
+        conn = connections.pop(str(self.db_path), None)
+        if conn is not None:
             conn.close()
 
     def _init_db(self):
-        """Initialize the database and create tables if they don't exist."""
+        """Bring the database schema up to SCHEMA_VERSION by applying pending migrations."""
         logger.debug(f"Attempting to connect to {self.db_path}")
         try:
             with self.get_connection() as conn:
                 logger.debug("Connected to database")
                 cursor = conn.cursor()
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS invoice_metadata (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        invoice_number TEXT UNIQUE NOT NULL,
-                        vendor_name TEXT NOT NULL,
-                        invoice_date TEXT NOT NULL,
-                        total_amount REAL NOT NULL,
-                        status TEXT NOT NULL,
-                        pdf_url TEXT NOT NULL,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        confidence REAL DEFAULT 0.0,
-                        total_time REAL DEFAULT 0.0
-                    )
-                """)
-
-                # Add new columns if they don't exist
-                try:
-                    cursor.execute("ALTER TABLE invoice_metadata ADD COLUMN confidence REAL DEFAULT 0.0")
-                except sqlite3.OperationalError:
-                    logger.debug("confidence column already exists")
-
-                try:
-                    cursor.execute("ALTER TABLE invoice_metadata ADD COLUMN total_time REAL DEFAULT 0.0")
-                except sqlite3.OperationalError:
-                    logger.debug("total_time column already exists")
-
+                if cursor.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+                    logger.debug(f"Database schema is at version {SCHEMA_VERSION}")
+                    return
+                cursor.execute("BEGIN IMMEDIATE")
+                # Re-read under the write lock in case another process migrated meanwhile
+                current = cursor.execute("PRAGMA user_version").fetchone()[0]
+                for version, description, migrate in MIGRATIONS:
+                    if version > current:
+                        logger.info(f"Applying schema migration {version}: {description}")
+                        migrate(cursor)
+                        cursor.execute(f"PRAGMA user_version = {version}")
                 conn.commit()
                 logger.info("Database initialized successfully")
         except sqlite3.Error as e:
@@ -152,6 +579,7 @@ class InvoiceDB:
                     invoice_data.get('total_time', 0.0)
                 ))
                 conn.commit()
+                self._invalidate_count()
                 logger.info(f"Invoice {invoice_data['invoice_number']} inserted successfully")
                 return True, cursor.lastrowid, None
         except sqlite3.IntegrityError as e:
@@ -269,6 +697,7 @@ class InvoiceDB:
                 cursor = conn.cursor()
                 cursor.execute("DELETE FROM invoice_metadata WHERE id = ?", (invoice_id,))
                 conn.commit()
+                self._invalidate_count()
                 return cursor.rowcount > 0
         except sqlite3.Error as e:
             logger.error(f"Failed to delete invoice {invoice_id}: {e}")
@@ -295,53 +724,118 @@ class InvoiceDB:
             logger.error(f"Failed to check duplicates: {e}")
             return {num: False for num in invoice_numbers}
 
-    @retry_on_error()
     def batch_insert_invoices(self, invoices: List[Dict[str, Any]]) -> List[Tuple[bool, int, Optional[str]]]:
         """
         Insert multiple invoices efficiently.
         Returns a list of (is_new, invoice_id, error_message) tuples.
         """
-        logger.debug(f"Attempting batch insert of {len(invoices)} invoices")
-        results = []
-        
+        return self.bulk_insert_invoices(invoices)
+
+    @retry_on_error()
+    def bulk_insert_invoices(
+        self,
+        invoices: List[Dict[str, Any]],
+        chunk_size: int = DB_BULK_INSERT_CHUNK_SIZE,
+        update_existing: bool = False
+    ) -> List[Tuple[bool, int, Optional[str]]]:
+        """
+        Insert many invoices in one transaction with multi-row INSERT statements.
+
+        Each chunk is a single `INSERT ... ON CONFLICT(invoice_number) DO NOTHING
+        RETURNING` statement, so duplicates are reported from the conflict result
+        instead of per-row exceptions. Returns (is_new, invoice_id, error_message)
+        per input invoice, in order; duplicates of stored invoices (or of an
+        earlier invoice in the same call) carry the existing ID.
+
+        With `update_existing`, the last occurrence of each invoice number wins
+        instead: stored rows are overwritten (an empty pdf_url keeps the stored
+        one) and reported as (False, id, None).
+        """
+        logger.debug(f"Bulk inserting {len(invoices)} invoices in chunks of {chunk_size}")
+        results: List[Optional[Tuple[bool, int, Optional[str]]]] = [None] * len(invoices)
+        first_index: Dict[str, int] = {}
+        rows = []
+        for index, invoice in enumerate(invoices):
+            missing = {field for field in INVOICE_REQUIRED_FIELDS if invoice.get(field) is None}
+            if missing:
+                results[index] = (False, -1, f"Missing required fields: {missing}")
+            elif invoice['invoice_number'] in first_index and not update_existing:
+                continue  # Resolved to the first occurrence's ID below
+            else:
+                first_index[invoice['invoice_number']] = index  # With update_existing, the last occurrence
+        for index in first_index.values():
+            invoice = invoices[index]
+            rows.append(tuple(
+                invoice.get(column, 0.0) if column in ('confidence', 'total_time') else invoice[column]
+                for column in INVOICE_INSERT_COLUMNS
+            ))
+        if update_existing:
+            updates = ', '.join(
+                f"{column} = excluded.{column}" for column in INVOICE_INSERT_COLUMNS[1:] if column != 'pdf_url'
+            )
+            conflict_sql = f"""DO UPDATE SET {updates},
+                pdf_url = CASE WHEN excluded.pdf_url != '' THEN excluded.pdf_url ELSE invoice_metadata.pdf_url END"""
+        else:
+            conflict_sql = "DO NOTHING"
+
+        # SQLite caps bound parameters per statement (32766 since 3.32)
+        chunk_size = max(1, min(chunk_size, 32766 // len(INVOICE_INSERT_COLUMNS)))
+        row_sql = f"({', '.join('?' * len(INVOICE_INSERT_COLUMNS))})"
+        inserted: Dict[str, int] = {}
         try:
             with self.get_connection() as conn:
                 cursor = conn.cursor()
-                for invoice in invoices:
-                    try:
-                        cursor.execute("""
-                            INSERT INTO invoice_metadata (
-                                invoice_number, vendor_name, invoice_date,
-                                total_amount, status, pdf_url, confidence, total_time
-                            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                        """, (
-                            invoice['invoice_number'],
-                            invoice['vendor_name'],
-                            invoice['invoice_date'],
-                            invoice['total_amount'],
-                            invoice['status'],
-                            invoice['pdf_url'],
-                            invoice.get('confidence', 0.0),
-                            invoice.get('total_time', 0.0)
-                        ))
-                        results.append((True, cursor.lastrowid, None))
-                    except sqlite3.IntegrityError as e:
-                        if "UNIQUE constraint failed" in str(e):
-                            results.append((False, -1, f"Invoice {invoice['invoice_number']} already exists"))
-                        else:
-                            results.append((False, -1, str(e)))
-                    except Exception as e:
-                        results.append((False, -1, str(e)))
-                
+                existing: Dict[str, int] = {}
+
+                def find_existing(numbers: List[str]):
+                    for start in range(0, len(numbers), chunk_size):
+                        chunk = numbers[start:start + chunk_size]
+                        cursor.execute(f"""
+                            SELECT invoice_number, id FROM invoice_metadata
+                            WHERE invoice_number IN ({', '.join('?' * len(chunk))})
+                        """, chunk)
+                        existing.update(cursor.fetchall())
+
+                if update_existing:
+                    cursor.execute("BEGIN IMMEDIATE")  # Rows that already exist must not change before the upsert
+                    find_existing(list(first_index))
+                for start in range(0, len(rows), chunk_size):
+                    chunk = rows[start:start + chunk_size]
+                    cursor.execute(f"""
+                        INSERT INTO invoice_metadata ({', '.join(INVOICE_INSERT_COLUMNS)})
+                        VALUES {', '.join([row_sql] * len(chunk))}
+                        ON CONFLICT(invoice_number) {conflict_sql}
+                        RETURNING invoice_number, id
+                    """, [value for row in chunk for value in row])
+                    inserted.update(
+                        (number, row_id) for number, row_id in cursor.fetchall() if number not in existing
+                    )
+
+                # Look up the IDs of invoices that already existed
+                if not update_existing:
+                    find_existing([number for number in first_index if number not in inserted])
                 conn.commit()
-                return results
-                
+            if inserted:
+                self._invalidate_count()
         except sqlite3.Error as e:
-            logger.error(f"Batch insert failed: {e}")
-            # Return failure for all remaining invoices
-            remaining = len(invoices) - len(results)
-            results.extend([(False, -1, str(e))] * remaining)
-            return results
+            if "database is locked" in str(e):
+                raise  # Transaction was rolled back; let retry_on_error back off and retry
+            logger.error(f"Bulk insert failed: {e}")
+            return [result or (False, -1, str(e)) for result in results]
+
+        for index, invoice in enumerate(invoices):
+            if results[index] is not None:
+                continue
+            number = invoice['invoice_number']
+            if first_index[number] == index and number in inserted:
+                results[index] = (True, inserted[number], None)
+            elif update_existing:
+                results[index] = (False, inserted.get(number, existing.get(number, -1)), None)
+            else:
+                results[index] = (False, inserted.get(number, existing.get(number, -1)), f"Invoice {number} already exists")
+        outcome = "updated, superseded or rejected" if update_existing else "duplicate or rejected"
+        logger.info(f"Bulk insert: {len(inserted)} new, {len(invoices) - len(inserted)} {outcome}")
+        return results
 
     @retry_on_error()
     def update_batch_status(self, invoice_ids: List[int], new_status: str) -> bool:
@@ -362,18 +856,27 @@ class InvoiceDB:
             return False
 
     @retry_on_error()
-    def get_invoice_count(self) -> int:
-        """Get total count of invoices in database."""
+    def get_invoice_count(self, cached: bool = False) -> int:
+        """Get total count of invoices in database; cached=True may be up to DB_COUNT_CACHE_TTL seconds stale."""
+        key = str(self.db_path)
+        if cached:
+            count, expires_at = _count_cache.get(key, (0, 0.0))
+            if time.monotonic() < expires_at:
+                return count
         try:
             with self.get_connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute("SELECT COUNT(*) FROM invoice_metadata")
-                return cursor.fetchone()[0]
+                count = cursor.fetchone()[0]
+                _count_cache[key] = (count, time.monotonic() + DB_COUNT_CACHE_TTL)
+                return count
         except sqlite3.Error as e:
             logger.error(f"Failed to get invoice count: {e}")
             return 0
 
-    @retry_on_error()
+    def _invalidate_count(self):
+        _count_cache.pop(str(self.db_path), None)
+
     def get_invoices_paginated(
         self, 
         page: int = 1, 
@@ -382,56 +885,103 @@ class InvoiceDB:
         order: str = "desc"
     ) -> List[Dict[str, Any]]:
         """Get paginated invoices with sorting."""
+        invoices, _ = self.get_invoices_page(page=page, per_page=per_page, sort_by=sort_by, order=order)
+        return invoices
+
+    @retry_on_error()
+    def get_invoices_page(
+        self,
+        per_page: int = 10,
+        sort_by: str = "created_at",
+        order: str = "desc",
+        cursor: Optional[str] = None,
+        page: int = 1
+    ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """
+        Get one page of invoices sorted on (sort_by, id), plus the cursor for the next page.
+
+        With a cursor this seeks through the (sort_by, id) index, so latency does
+        not depend on page depth; without one it falls back to OFFSET paging.
+        """
+        # Validate sort_by field to prevent SQL injection
+        if sort_by not in INVOICE_SORT_FIELDS:
+            sort_by = 'created_at'
+
+        # Validate order
+        order = order.lower()
+        if order not in ('asc', 'desc'):
+            order = 'desc'
+
+        if cursor:
+            params = [*self.decode_cursor(cursor), per_page]
+        else:
+            params = [per_page, max(page - 1, 0) * per_page]
+
         try:
             with self.get_connection() as conn:
-                cursor = conn.cursor()
-                
-                # Validate sort_by field to prevent SQL injection
-                allowed_fields = {
-                    'created_at', 'invoice_number', 'vendor_name', 
-                    'invoice_date', 'total_amount', 'status'
-                }
-                if sort_by not in allowed_fields:
-                    sort_by = 'created_at'
-                
-                # Validate order
-                order = order.lower()
-                if order not in ('asc', 'desc'):
-                    order = 'desc'
-                
-                offset = (page - 1) * per_page
-                
-                cursor.execute(f"""
-                    SELECT 
-                        id, invoice_number, vendor_name, invoice_date,
-                        total_amount, status, pdf_url, created_at,
-                        confidence, total_time
-                    FROM invoice_metadata
-                    ORDER BY {sort_by} {order}
-                    LIMIT ? OFFSET ?
-                """, (per_page, offset))
-                
-                rows = cursor.fetchall()
+                rows = conn.execute(invoices_page_sql(sort_by, order, keyset=bool(cursor)), params).fetchall()
                 invoices = [dict(row) for row in rows] if rows else []
+                next_cursor = None
+                if len(invoices) == per_page:
+                    next_cursor = self.encode_cursor(invoices[-1][sort_by], invoices[-1]['id'])
                 logger.info(f"Retrieved {len(invoices)} invoices for page {page}")
-                return invoices
-                
+                return invoices, next_cursor
+
         except sqlite3.Error as e:
             logger.error(f"Failed to fetch paginated invoices: {e}")
-            return []
+            return [], None
+
+    @staticmethod
+    def _status_counts(conn) -> dict:
+        return {row['status']: row['count'] for row in conn.execute(STATUS_COUNTS_SQL)}
+
+    @staticmethod
+    def _rollup_metrics(conn) -> Tuple[dict, dict]:
+        """Confidence and processing-time metrics from the rollup row plus indexed MIN/MAX lookups."""
+        totals = conn.execute("SELECT * FROM invoice_rollup WHERE id = 1").fetchone()
+        extremes = conn.execute(EXTREMES_SQL).fetchone()
+        if not totals:
+            return (
+                {"average": 0, "minimum": 0, "maximum": 0, "low_confidence_rate": 0},
+                {"average_seconds": 0, "minimum_seconds": 0, "maximum_seconds": 0, "total_processed": 0}
+            )
+        confidence = {
+            "average": totals['confidence_sum'] / totals['confidence_count'] if totals['confidence_count'] else 0.0,
+            "minimum": float(extremes['min_confidence'] or 0),
+            "maximum": float(extremes['max_confidence'] or 0),
+            "low_confidence_rate": float(totals['low_confidence_count']) / float(totals['invoice_count'] or 1)
+        }
+        processing = {
+            "average_seconds": totals['timed_sum'] / totals['timed_count'] if totals['timed_count'] else 0.0,
+            "minimum_seconds": float(extremes['min_time'] or 0),
+            "maximum_seconds": float(extremes['max_time'] or 0),
+            "total_processed": totals['timed_count']
+        }
+        return confidence, processing
+
+    @staticmethod
+    def _recent_metrics(conn) -> dict:
+        """Last-24h metrics: whole hourly buckets from the rollup plus the partial boundary hour."""
+        boundary = {"boundary": conn.execute("SELECT datetime('now', '-1 day')").fetchone()[0]}
+        buckets = conn.execute(RECENT_BUCKETS_SQL, boundary).fetchone()
+        partial = conn.execute(RECENT_METRICS_SQL, boundary).fetchone()
+        total_time_count = buckets['total_time_count'] + partial['total_time_count']
+        return {
+            "processed_24h": buckets['total_count'] + partial['total_count'],
+            "low_confidence_24h": buckets['low_confidence_count'] + partial['low_confidence_count'],
+            "valid_24h": buckets['valid_count'] + partial['valid_count'],
+            "needs_review_24h": buckets['review_count'] + partial['review_count'],
+            "avg_processing_time_24h": float(
+                (buckets['total_time_sum'] + partial['total_time_sum']) / total_time_count
+            ) if total_time_count else 0.0
+        }
 
     @retry_on_error()
     def get_status_counts(self) -> dict:
         """Get counts of invoices by status."""
         try:
             with self.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    SELECT status, COUNT(*) as count
-                    FROM invoice_metadata
-                    GROUP BY status
-                """)
-                return {row['status']: row['count'] for row in cursor.fetchall()}
+                return self._status_counts(conn)
         except sqlite3.Error as e:
             logger.error(f"Failed to get status counts: {e}")
             return {}
@@ -441,25 +991,7 @@ class InvoiceDB:
         """Get confidence score metrics."""
         try:
             with self.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    SELECT 
-                        AVG(confidence) as avg_confidence,
-                        MIN(confidence) as min_confidence,
-                        MAX(confidence) as max_confidence,
-                        COUNT(CASE WHEN confidence < 0.7 THEN 1 END) as low_confidence_count,
-                        COUNT(*) as total_count
-                    FROM invoice_metadata
-                """)
-                row = cursor.fetchone()
-                if row:
-                    return {
-                        "average": float(row['avg_confidence'] or 0),
-                        "minimum": float(row['min_confidence'] or 0),
-                        "maximum": float(row['max_confidence'] or 0),
-                        "low_confidence_rate": float(row['low_confidence_count'] or 0) / float(row['total_count'] or 1)
-                    }
-                return {"average": 0, "minimum": 0, "maximum": 0, "low_confidence_rate": 0}
+                return self._rollup_metrics(conn)[0]
         except sqlite3.Error as e:
             logger.error(f"Failed to get confidence metrics: {e}")
             return {"average": 0, "minimum": 0, "maximum": 0, "low_confidence_rate": 0}
@@ -469,30 +1001,7 @@ class InvoiceDB:
         """Get processing time metrics."""
         try:
             with self.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    SELECT 
-                        AVG(total_time) as avg_time,
-                        MIN(total_time) as min_time,
-                        MAX(total_time) as max_time,
-                        COUNT(*) as total_count
-                    FROM invoice_metadata
-                    WHERE total_time > 0
-                """)
-                row = cursor.fetchone()
-                if row:
-                    return {
-                        "average_seconds": float(row['avg_time'] or 0),
-                        "minimum_seconds": float(row['min_time'] or 0),
-                        "maximum_seconds": float(row['max_time'] or 0),
-                        "total_processed": row['total_count']
-                    }
-                return {
-                    "average_seconds": 0,
-                    "minimum_seconds": 0,
-                    "maximum_seconds": 0,
-                    "total_processed": 0
-                }
+                return self._rollup_metrics(conn)[1]
         except sqlite3.Error as e:
             logger.error(f"Failed to get processing time metrics: {e}")
             return {
@@ -507,33 +1016,7 @@ class InvoiceDB:
         """Get metrics for invoices processed in the last 24 hours."""
         try:
             with self.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    SELECT 
-                        COUNT(*) as total_count,
-                        COUNT(CASE WHEN confidence < 0.7 THEN 1 END) as low_confidence_count,
-                        COUNT(CASE WHEN status = 'valid' THEN 1 END) as valid_count,
-                        COUNT(CASE WHEN status = 'needs_review' THEN 1 END) as review_count,
-                        AVG(total_time) as avg_processing_time
-                    FROM invoice_metadata
-                    WHERE created_at >= datetime('now', '-1 day')
-                """)
-                row = cursor.fetchone()
-                if row:
-                    return {
-                        "processed_24h": row['total_count'],
-                        "low_confidence_24h": row['low_confidence_count'],
-                        "valid_24h": row['valid_count'],
-                        "needs_review_24h": row['review_count'],
-                        "avg_processing_time_24h": float(row['avg_processing_time'] or 0)
-                    }
-                return {
-                    "processed_24h": 0,
-                    "low_confidence_24h": 0,
-                    "valid_24h": 0,
-                    "needs_review_24h": 0,
-                    "avg_processing_time_24h": 0
-                }
+                return self._recent_metrics(conn)
         except sqlite3.Error as e:
             logger.error(f"Failed to get recent metrics: {e}")
             return {
@@ -544,11 +1027,430 @@ class InvoiceDB:
                 "avg_processing_time_24h": 0
             }
 
-    def __del__(self):
-        """Ensure proper cleanup of database connections."""
-        logger.info("Cleaning up database connections")
+    @retry_on_error()
+    def get_dashboard_metrics(self) -> Optional[dict]:
+        """All dashboard metrics from precomputed rollups, read from one consistent snapshot."""
+        try:
+            with self.get_connection() as conn:
+                conn.execute("BEGIN")  # Snapshot isolation for the reads below; rolled back on exit
+                totals = conn.execute("SELECT invoice_count FROM invoice_rollup WHERE id = 1").fetchone()
+                confidence, processing = self._rollup_metrics(conn)
+                return {
+                    "total_invoices": totals['invoice_count'] if totals else 0,
+                    "status_breakdown": self._status_counts(conn),
+                    "confidence_metrics": confidence,
+                    "processing_metrics": processing,
+                    "recent_activity": self._recent_metrics(conn)
+                }
+        except sqlite3.Error as e:
+            logger.error(f"Failed to get dashboard metrics: {e}")
+            return None
+
+    def _median_total(self, cursor) -> Optional[float]:
+        """
+        Exact median (sorted[n // 2]) of recorded totals, found by walking three
+        levels of counts rather than the rows themselves: the 5% buckets, the
+        FINE_BUCKETS_PER_BUCKET sub-buckets of one bucket, then the distinct
+        amounts of one sub-bucket. Cost is O(non-empty buckets + 100 + distinct
+        amounts within a ~0.05% band), independent of how many invoices share it.
+        """
+        cursor.execute("SELECT bucket, count FROM anomaly_total_histogram ORDER BY bucket")
+        buckets = cursor.fetchall()
+        rank = sum(row['count'] for row in buckets) // 2
+        bucket = _select_rank(buckets, 'bucket', rank)
+        if bucket is None:
+            return None
+        bucket, rank = bucket
+        cursor.execute("""
+            SELECT fine_bucket, count FROM anomaly_total_fine_histogram
+            WHERE fine_bucket >= ? AND fine_bucket < ?
+            ORDER BY fine_bucket
+        """, (bucket * FINE_BUCKETS_PER_BUCKET, (bucket + 1) * FINE_BUCKETS_PER_BUCKET))
+        fine_bucket, rank = _select_rank(cursor.fetchall(), 'fine_bucket', rank)
+        cursor.execute(
+            "SELECT total_amount, count FROM anomaly_total_values WHERE fine_bucket = ? ORDER BY total_amount",
+            (fine_bucket,)
+        )
+        return _select_rank(cursor.fetchall(), 'total_amount', rank)[0]
+
+    @retry_on_error()
+    def check_and_record_anomaly_history(
+        self,
+        invoice_number: str,
+        vendor_name: Optional[str],
+        total_amount: Optional[float],
+        vendor_update: Optional[Callable[[Optional[Dict[str, float]], float], Dict[str, float]]] = None,
+        run_id: Optional[str] = None
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Check an invoice against the shared anomaly history and record it, atomically.
+
+        Returns a dict with 'duplicate', 'median_total' (median of totals seen
+        before this invoice, None if there are none) and 'vendor_stats' (the
+        vendor's model state before this invoice), or None on database error.
+        vendor_update(state, total) computes the vendor's new model state.
+        When the invoice number was first recorded by the same run_id (a retried
+        stage within one pipeline run), it is neither a duplicate nor recorded
+        again; any other occurrence, even of an identical PDF, is a duplicate.
+        """
+        logger.debug(f"Checking anomaly history for invoice: {invoice_number}")
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                # Take the write lock up front so concurrent workers serialize check-and-record
+                cursor.execute("BEGIN IMMEDIATE")
+                cursor.execute("""
+                    INSERT OR IGNORE INTO anomaly_invoice_index (invoice_number, vendor_name, run_id)
+                    VALUES (?, ?, ?)
+                """, (invoice_number, vendor_name, run_id))
+                seen_before = cursor.rowcount == 0
+                rerun = False
+                if seen_before and run_id is not None:
+                    cursor.execute(
+                        "SELECT run_id FROM anomaly_invoice_index WHERE invoice_number = ?", (invoice_number,)
+                    )
+                    rerun = cursor.fetchone()['run_id'] == run_id
+                duplicate = seen_before and not rerun
+                median_total = self._median_total(cursor)
+                vendor_stats = self._vendor_stats(cursor, vendor_name or "")
+
+                if total_amount is not None and not rerun:
+                    fine_bucket = fine_total_bucket(total_amount)
+                    bucket = fine_bucket // FINE_BUCKETS_PER_BUCKET
+                    cursor.execute(
+                        "INSERT INTO anomaly_totals (bucket, total_amount, vendor_name) VALUES (?, ?, ?)",
+                        (bucket, total_amount, vendor_name or "")
+                    )
+                    cursor.execute("""
+                        INSERT INTO anomaly_total_histogram (bucket, count) VALUES (?, 1)
+                        ON CONFLICT(bucket) DO UPDATE SET count = count + 1
+                    """, (bucket,))
+                    cursor.execute("""
+                        INSERT INTO anomaly_total_fine_histogram (fine_bucket, count) VALUES (?, 1)
+                        ON CONFLICT(fine_bucket) DO UPDATE SET count = count + 1
+                    """, (fine_bucket,))
+                    cursor.execute("""
+                        INSERT INTO anomaly_total_values (fine_bucket, total_amount, count) VALUES (?, ?, 1)
+                        ON CONFLICT(fine_bucket, total_amount) DO UPDATE SET count = count + 1
+                    """, (fine_bucket, total_amount))
+                    cursor.execute("""
+                        INSERT INTO anomaly_vendor_stats (vendor_name, invoice_count, total_sum, total_sum_sq)
+                        VALUES (?, 1, ?, ?)
+                        ON CONFLICT(vendor_name) DO UPDATE SET
+                            invoice_count = invoice_count + 1,
+                            total_sum = total_sum + excluded.total_sum,
+                            total_sum_sq = total_sum_sq + excluded.total_sum_sq
+                    """, (vendor_name or "", total_amount, total_amount * total_amount))
+                    if vendor_update is not None:
+                        self._write_vendor_model(cursor, vendor_name or "", vendor_update(vendor_stats, total_amount))
+
+                conn.commit()
+                return {"duplicate": duplicate, "median_total": median_total, "vendor_stats": vendor_stats}
+        except sqlite3.Error as e:
+            if "database is locked" in str(e):
+                raise  # Let retry_on_error back off and retry
+            logger.error(f"Failed to check anomaly history for {invoice_number}: {e}")
+            return None
+
+    def _vendor_stats(self, cursor, vendor_name: str) -> Optional[Dict[str, float]]:
+        cursor.execute(f"""
+            SELECT invoice_count AS count, {', '.join(VENDOR_MODEL_COLUMNS)}
+            FROM anomaly_vendor_stats
+            WHERE vendor_name = ?
+        """, (vendor_name,))
+        row = cursor.fetchone()
+        return dict(row) if row else None
+
+    def _write_vendor_model(self, cursor, vendor_name: str, state: Dict[str, float]):
+        cursor.execute(f"""
+            UPDATE anomaly_vendor_stats
+            SET {', '.join(f"{column} = ?" for column in VENDOR_MODEL_COLUMNS)}
+            WHERE vendor_name = ?
+        """, [state[column] for column in VENDOR_MODEL_COLUMNS] + [vendor_name])
+
+    @retry_on_error()
+    def get_vendor_stats(self, vendor_name: str) -> Optional[Dict[str, float]]:
+        """Per-vendor outlier model state: count, mean, m2, median, mad, p05 and p95."""
+        try:
+            with self.get_connection() as conn:
+                return self._vendor_stats(conn.cursor(), vendor_name)
+        except sqlite3.Error as e:
+            logger.error(f"Failed to get vendor stats for {vendor_name}: {e}")
+            return None
+
+    @retry_on_error()
+    def get_anomaly_totals(self) -> List[Tuple[str, float]]:
+        """All recorded (vendor_name, total_amount) pairs, for bulk model rebuilds."""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT vendor_name, total_amount FROM anomaly_totals")
+                return [(row['vendor_name'] or "", row['total_amount']) for row in cursor.fetchall()]
+        except sqlite3.Error as e:
+            logger.error(f"Failed to fetch anomaly totals: {e}")
+            return []
+
+    @retry_on_error()
+    def save_vendor_stats(self, stats: Dict[str, Dict[str, float]]) -> bool:
+        """Replace the per-vendor outlier model with freshly rebuilt statistics."""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.executemany(f"""
+                    INSERT INTO anomaly_vendor_stats (
+                        vendor_name, invoice_count, total_sum, total_sum_sq, {', '.join(VENDOR_MODEL_COLUMNS)}
+                    ) VALUES (?, ?, ?, ?, {', '.join('?' * len(VENDOR_MODEL_COLUMNS))})
+                    ON CONFLICT(vendor_name) DO UPDATE SET
+                        invoice_count = excluded.invoice_count,
+                        total_sum = excluded.total_sum,
+                        total_sum_sq = excluded.total_sum_sq,
+                        {', '.join(f"{column} = excluded.{column}" for column in VENDOR_MODEL_COLUMNS)}
+                """, [
+                    (
+                        vendor, state["count"], state["mean"] * state["count"],
+                        state["m2"] + state["count"] * state["mean"] ** 2,
+                        *[state[column] for column in VENDOR_MODEL_COLUMNS]
+                    )
+                    for vendor, state in stats.items()
+                ])
+                conn.commit()
+                logger.info(f"Saved outlier statistics for {len(stats)} vendors")
+                return True
+        except sqlite3.Error as e:
+            logger.error(f"Failed to save vendor stats: {e}")
+            return False
+
+    @staticmethod
+    def _anomaly_row(anomaly: Dict[str, Any]) -> Tuple:
+        return (
+            anomaly.get('file_name'),
+            anomaly.get('invoice_number'),
+            anomaly.get('vendor_name'),
+            anomaly.get('type'),
+            anomaly.get('reason'),
+            anomaly.get('confidence') or 0.0,
+            anomaly.get('review_status') or 'needs_review',
+            anomaly.get('timestamp') or '',
+            json.dumps(anomaly, default=str)
+        )
+
+    @retry_on_error()
+    def upsert_anomaly(self, anomaly: Dict[str, Any], match_on: Tuple[str, ...] = ("file_name",)) -> Optional[int]:
+        """Replace the earliest anomaly matching on any `match_on` field, or insert a new one."""
+        logger.debug(f"Saving anomaly: {anomaly.get('file_name')}")
+        match_on = [field for field in match_on if field in ('file_name', 'invoice_number') and anomaly.get(field)]
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("BEGIN IMMEDIATE")
+                existing = None
+                if match_on:
+                    cursor.execute(f"""
+                        SELECT MIN(id) FROM anomalies
+                        WHERE {' OR '.join(f"{field} = ?" for field in match_on)}
+                    """, [anomaly[field] for field in match_on])
+                    existing = cursor.fetchone()[0]
+                if existing is None:
+                    cursor.execute("""
+                        INSERT INTO anomalies (
+                            file_name, invoice_number, vendor_name, type, reason,
+                            confidence, review_status, timestamp, data
+                        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    """, self._anomaly_row(anomaly))
+                    existing = cursor.lastrowid
+                else:
+                    cursor.execute("""
+                        UPDATE anomalies SET
+                            file_name = ?, invoice_number = ?, vendor_name = ?, type = ?, reason = ?,
+                            confidence = ?, review_status = ?, timestamp = ?, data = ?
+                        WHERE id = ?
+                    """, self._anomaly_row(anomaly) + (existing,))
+                conn.commit()
+                return existing
+        except sqlite3.Error as e:
+            if "database is locked" in str(e):
+                raise
+            logger.error(f"Failed to save anomaly {anomaly.get('file_name')}: {e}")
+            return None
+
+    @retry_on_error()
+    def import_anomalies(self, anomalies: List[Dict[str, Any]]) -> int:
+        """Insert many anomalies in one transaction, e.g. when migrating legacy JSON."""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.executemany("""
+                    INSERT INTO anomalies (
+                        file_name, invoice_number, vendor_name, type, reason,
+                        confidence, review_status, timestamp, data
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, [self._anomaly_row(anomaly) for anomaly in anomalies])
+                conn.commit()
+                return cursor.rowcount
+        except sqlite3.Error as e:
+            logger.error(f"Failed to import anomalies: {e}")
+            raise
+
+    @staticmethod
+    def encode_cursor(sort_value: Any, row_id: int) -> str:
+        """Opaque keyset cursor for the last row of a page."""
+        return base64.urlsafe_b64encode(json.dumps([sort_value, row_id]).encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor: str) -> Tuple[Any, int]:
+        sort_value, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return sort_value, int(row_id)
+
+    @retry_on_error()
+    def get_anomalies_page(
+        self,
+        status: Optional[str] = None,
+        per_page: int = 10,
+        page: int = 1,
+        cursor: Optional[str] = None
+    ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """
+        Newest anomalies first, optionally filtered by review_status.
+
+        With a cursor (from the previous page) this is a keyset seek on
+        (timestamp, id); without one it falls back to page-based OFFSET.
+        Returns (anomalies, next_cursor).
+        """
+        where, params = [], []
+        if status:
+            where.append("review_status = ?")
+            params.append(status)
+        if cursor:
+            timestamp, row_id = self.decode_cursor(cursor)
+            where.append("(timestamp, id) < (?, ?)")
+            params.extend([timestamp, row_id])
+        query = f"""
+            SELECT id, timestamp, data FROM anomalies
+            {'WHERE ' + ' AND '.join(where) if where else ''}
+            ORDER BY timestamp DESC, id DESC
+            LIMIT ?
+        """
+        params.append(per_page)
+        if not cursor:
+            query += " OFFSET ?"
+            params.append(max(page - 1, 0) * per_page)
+        try:
+            with self.get_connection() as conn:
+                rows = conn.execute(query, params).fetchall()
+                anomalies = [json.loads(row['data']) for row in rows]
+                next_cursor = self.encode_cursor(rows[-1]['timestamp'], rows[-1]['id']) if len(rows) == per_page else None
+                return anomalies, next_cursor
+        except sqlite3.Error as e:
+            logger.error(f"Failed to fetch anomalies: {e}")
+            return [], None
+
+    @retry_on_error()
+    def get_anomaly_count(self, status: Optional[str] = None) -> int:
+        """Count anomalies, optionally filtered by review_status, from the trigger-maintained rollup."""
+        try:
+            with self.get_connection() as conn:
+                if status:
+                    row = conn.execute(
+                        "SELECT COALESCE(SUM(anomaly_count), 0) FROM anomaly_status_rollup WHERE review_status = ?",
+                        (status,)
+                    ).fetchone()
+                else:
+                    row = conn.execute("SELECT COALESCE(SUM(anomaly_count), 0) FROM anomaly_status_rollup").fetchone()
+                return row[0]
+        except sqlite3.Error as e:
+            logger.error(f"Failed to count anomalies: {e}")
+            return 0
+
+def get_db() -> InvoiceDB:
+    """Return the process-wide InvoiceDB for the default database."""
+    global _db
+    if _db is None:
+        with _db_lock:
+            if _db is None:
+                _db = InvoiceDB()
+    return _db
+
+class AsyncInvoiceDB:
+    """
+    Awaitable facade over InvoiceDB for async code.
+
+    Every public InvoiceDB method is exposed as a coroutine that runs on a
+    dedicated thread pool, so slow queries and retry_on_error back-off sleeps
+    never block the event loop. Each executor thread keeps its own pooled
+    connection.
+    """
+
+    def __init__(self, db: Optional[InvoiceDB] = None, max_workers: int = DB_EXECUTOR_WORKERS):
+        self.db = db or get_db()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="invoice-db")
+
+    def __getattr__(self, name: str):
+        method = getattr(self.db, name)
+        if name.startswith("_") or not callable(method):
+            return method
+
+        @wraps(method)
+        async def run_in_executor(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, partial(method, *args, **kwargs))
+        return run_in_executor
+
+    def shutdown(self):
+        """Stop the executor threads; pending queries finish first."""
+        self.executor.shutdown(wait=True)
+
+def get_async_db() -> AsyncInvoiceDB:
+    """Return the process-wide async facade over get_db()."""
+    global _async_db
+    if _async_db is None:
+        db = get_db()
+        with _db_lock:
+            if _async_db is None:
+                _async_db = AsyncInvoiceDB(db)
+    return _async_db
+
+def verify_hot_query_plans(db: InvoiceDB) -> Dict[str, Tuple[bool, List[str]]]:
+    """
+    Run EXPLAIN QUERY PLAN on each hot query and report whether it avoids a full table scan.
+
+    Returns {query_name: (uses_index, plan_details)}.
+    """
+    boundary = {"boundary": "2000-01-01 00:00:00"}
+    queries = {
+        "status_counts": (STATUS_COUNTS_SQL, ()),
+        "recent_buckets": (RECENT_BUCKETS_SQL, boundary),
+        "recent_metrics": (RECENT_METRICS_SQL, boundary),
+        "extremes": (EXTREMES_SQL, ()),
+        "invoice_by_number": ("SELECT id FROM invoice_metadata WHERE invoice_number = ?", ("",)),
+    }
+    for field in INVOICE_SORT_FIELDS:
+        for order in ("asc", "desc"):
+            queries[f"page_{field}_{order}"] = (invoices_page_sql(field, order, keyset=True), ("", 0, 10))
+    results = {}
+    with db.get_connection() as conn:
+        for name, (sql, params) in queries.items():
+            details = [row['detail'] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+            # Scanning a large table without an index, or sorting in a temp B-tree, defeats the index;
+            # the small rollup tables (one row per status) may be scanned
+            full_scan = any(
+                (detail.startswith(("SCAN invoice_metadata", "SCAN anomalies")) and "INDEX" not in detail)
+                or "TEMP B-TREE" in detail
+                for detail in details
+            )
+            results[name] = (not full_scan, details)
+    return results
 
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Invoice database utilities")
+    parser.add_argument("--check-plans", action="store_true", help="verify hot queries use indexes and exit")
+    args = parser.parse_args()
+    if args.check_plans:
+        failures = 0
+        for name, (uses_index, details) in verify_hot_query_plans(InvoiceDB()).items():
+            failures += not uses_index
+            print(f"{'ok  ' if uses_index else 'FAIL'} {name}: {'; '.join(details)}")
+        exit(1 if failures else 0)
     try:
         db = InvoiceDB()
         test_data = {
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+import json
+from pathlib import Path
+from typing import Dict, Any, List
+import logging
+from config.logging_config import logger
+from db import InvoiceDB
+
+PROCESSED_DIR = Path("data/processed")
+ANOMALIES_FILE = PROCESSED_DIR / "anomalies.json"
+ANOMALIES_JOURNAL = PROCESSED_DIR / "anomalies.jsonl"
+
+def load_legacy_anomalies() -> List[Dict[str, Any]]:
+    """Read anomalies from the JSONL journal if present, else from the legacy JSON array."""
+    if ANOMALIES_JOURNAL.exists():
+        # Replay the journal: last write per slot wins, in slot order
+        records = {}
+        with open(ANOMALIES_JOURNAL, 'r') as f:
+            for line in f:
+                if line.endswith("\n"):
+                    entry = json.loads(line)
+                    records[entry["slot"]] = entry["record"]
+        return [records[slot] for slot in sorted(records)]
+    if ANOMALIES_FILE.exists():
+        try:
+            with open(ANOMALIES_FILE, 'r') as f:
+                anomalies = json.load(f)
+        except json.JSONDecodeError:
+            logger.warning(f"{ANOMALIES_FILE} is empty or invalid, nothing to migrate")
+            return []
+        if not isinstance(anomalies, list):
+            raise ValueError("Invalid JSON structure: expected a list of anomalies")
+        return anomalies
+    logger.error(f"No anomalies file found: {ANOMALIES_FILE}")
+    return []
+
+def migrate_anomalies() -> bool:
+    """One-shot import of legacy anomalies into the anomalies table."""
+    try:
+        anomalies = load_legacy_anomalies()
+        logger.info(f"Found {len(anomalies)} anomalies to migrate")
+        db = InvoiceDB()
+        if db.get_anomaly_count():
+            logger.error("anomalies table is not empty; refusing to import twice")
+            return False
+        imported = db.import_anomalies(anomalies) if anomalies else 0
+        logger.info(f"Migration completed: {imported} anomalies imported")
+        return db.get_anomaly_count() == len(anomalies)
+    except Exception as e:
+        logger.error(f"Migration failed: {str(e)}")
+        return False
+
+if __name__ == "__main__":
+    exit(0 if migrate_anomalies() else 1)
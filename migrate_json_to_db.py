@@ -1,161 +1,364 @@
 #!/usr/bin/env python3
+import os
 import json
-import asyncio
+import time
+import codecs
+import argparse
 from pathlib import Path
-from typing import Dict, Any, List
+from typing import Dict, Any, Iterator, List, Optional, Tuple
 import logging
 from config.logging_config import logger
 from db import InvoiceDB
-from setup_s3 import upload_to_s3, BUCKET_NAME
-import boto3
-from botocore.exceptions import ClientError
+from setup_s3 import upload_to_s3, get_s3_service, S3StorageService
 
 PROCESSED_DIR = Path("data/processed")
 RAW_DIR = Path("data/raw/invoices")
 INVOICES_FILE = PROCESSED_DIR / "structured_invoices.json"
+# Append-only journal the pipeline writes; INVOICES_FILE is only a snapshot of it taken on compaction and shutdown
+INVOICES_JOURNAL = PROCESSED_DIR / "structured_invoices.jsonl"
+CHECKPOINT_FILE = PROCESSED_DIR / "migration_checkpoint.json"
+DEFAULT_BATCH_SIZE = 1000
+READ_CHUNK_BYTES = 1 << 20
 
-async def migrate_invoices():
-    """Migrate invoices from JSON to SQLite and upload PDFs to S3."""
+def iter_json_array(path: Path, start_offset: int = 0) -> Iterator[Tuple[Any, int]]:
+    """
+    Stream the elements of a top-level JSON array without loading the file.
+
+    Yields (element, end_offset) where end_offset is the byte offset just past
+    the element; passing it back as `start_offset` resumes after that element.
+    Memory use is bounded by the largest single element.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    with open(path, "rb") as f:
+        f.seek(start_offset)
+        buffer, pos, offset, eof = "", 0, start_offset, False
+        read_size = READ_CHUNK_BYTES
+        expect_value = start_offset == 0  # Resumed offsets always point just after an element
+        started = start_offset != 0
+
+        def fill() -> bool:
+            """Append the next chunk to the buffer; False at end of file."""
+            nonlocal buffer, pos, eof
+            if eof:
+                return False
+            chunk = f.read(read_size)
+            eof = not chunk
+            buffer = buffer[pos:] + utf8.decode(chunk, final=eof)
+            pos = 0
+            return bool(chunk)
+
+        def skip_whitespace():
+            nonlocal pos, offset
+            while True:
+                start = pos
+                while pos < len(buffer) and buffer[pos] in " \t\r\n":
+                    pos += 1
+                offset += pos - start  # JSON whitespace is single-byte
+                if pos < len(buffer) or not fill():
+                    return
+
+        while True:
+            skip_whitespace()
+            if pos >= len(buffer):
+                raise ValueError(f"Unexpected end of file at byte {offset}")
+            char = buffer[pos]
+            if not started:
+                if char != "[":
+                    raise ValueError("Invalid JSON structure: expected a list of invoices")
+                started = True
+                pos += 1
+                offset += 1
+                skip_whitespace()
+                if buffer[pos:pos + 1] == "]":
+                    return
+                continue
+            if not expect_value:
+                if char == "]":
+                    return
+                if char != ",":
+                    raise ValueError(f"Expected ',' or ']' at byte {offset}")
+                pos += 1
+                offset += 1
+                expect_value = True
+                continue
+            try:
+                element, end = decoder.raw_decode(buffer, pos)
+                if end == len(buffer) and not eof:
+                    raise json.JSONDecodeError("Element may continue past the buffer", buffer, end)
+            except json.JSONDecodeError:
+                if not fill():
+                    raise
+                read_size *= 2  # Element spans chunks; read bigger ones until it fits
+                continue
+            read_size = READ_CHUNK_BYTES
+            offset += len(buffer[pos:end].encode("utf-8"))
+            pos = end
+            expect_value = False
+            yield element, offset
+
+def is_journal(path: Path) -> bool:
+    return path.suffix == ".jsonl"
+
+def resolve_source(path: Path) -> Path:
+    """The journal, or the legacy JSON array when the pipeline has not created a journal yet."""
+    if is_journal(path) and not path.exists() and INVOICES_FILE.exists():
+        logger.info(f"{path} not found; streaming {INVOICES_FILE} instead")
+        return INVOICES_FILE
+    return path
+
+def iter_journal(path: Path, start_offset: int = 0) -> Iterator[Tuple[Any, int]]:
+    """
+    Stream the records of a JSONL journal line by line, without loading or compacting it.
+
+    Yields (record, end_offset) like iter_json_array. A record may appear on
+    several lines (each upsert appends one); the migration resolves them by
+    upserting in file order, so the last write per invoice wins. A trailing
+    line still being written is left for the next run.
+    """
+    with open(path, "rb") as f:
+        f.seek(start_offset)
+        offset = start_offset
+        for line in f:
+            if not line.endswith(b"\n"):
+                return
+            offset += len(line)
+            if line.strip():
+                yield json.loads(line)["record"], offset
+
+def iter_invoices(path: Path, start_offset: int = 0) -> Iterator[Tuple[Any, int]]:
+    """Invoices from a journal or a JSON array, resuming at a checkpoint offset."""
+    if is_journal(path):
+        return iter_journal(path, start_offset)
+    return iter_json_array(path, start_offset)
+
+def load_checkpoint(checkpoint_path: Path, input_path: Path) -> Dict[str, Any]:
+    """Resume state for this input file, or a fresh one."""
+    stat = input_path.stat()
+    fresh = {
+        "source": str(input_path.resolve()), "inode": stat.st_ino, "offset": 0, "records": 0,
+        "migrated": 0, "updated": 0, "skipped": 0, "errors": 0
+    }
+    if not checkpoint_path.exists():
+        return fresh
+    with open(checkpoint_path, "r") as f:
+        checkpoint = {**fresh, **json.load(f)}
+    if checkpoint["source"] != fresh["source"]:
+        raise ValueError(f"Checkpoint {checkpoint_path} belongs to {checkpoint['source']}; use --reset to start over")
+    if is_journal(input_path) and (checkpoint["inode"] != stat.st_ino or checkpoint["offset"] > stat.st_size):
+        # Compaction replaced the journal, so byte offsets no longer line up; upserts make a replay safe
+        logger.warning(f"{input_path} was compacted since the checkpoint; replaying it from the start")
+        return fresh
+    if checkpoint["offset"] > stat.st_size:
+        raise ValueError(f"{input_path} is shorter than the checkpoint offset; use --reset to start over")
+    logger.info(f"Resuming from byte {checkpoint['offset']} after {checkpoint['records']} records")
+    return checkpoint
+
+def save_checkpoint(checkpoint_path: Path, checkpoint: Dict[str, Any]):
+    tmp_path = checkpoint_path.with_suffix(checkpoint_path.suffix + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, checkpoint_path)
+
+def resolve_pdf_url(invoice: Dict[str, Any], s3_service: S3StorageService) -> str:
+    """Upload the invoice PDF to S3 unless it is already there; fall back to the recorded URL."""
+    # Try multiple locations for the PDF
+    pdf_paths = [
+        PROCESSED_DIR / f"{invoice['invoice_number']}.pdf",
+        RAW_DIR / invoice.get('file_name', ''),
+        RAW_DIR / f"{invoice['invoice_number']}.pdf"
+    ]
+    pdf_path = next((path for path in pdf_paths if path.is_file()), None)
+    if not pdf_path:
+        logger.warning(f"PDF file not found for invoice {invoice['invoice_number']}")
+        return invoice.get('pdf_url', '')
     try:
-        if not INVOICES_FILE.exists():
-            logger.error(f"Invoice file not found: {INVOICES_FILE}")
-            return False
-            
-        with open(INVOICES_FILE, 'r') as f:
-            invoices = json.load(f)
-            
-        if not isinstance(invoices, list):
-            logger.error("Invalid JSON structure: expected a list of invoices")
+        s3_key = f"invoices/{invoice['invoice_number']}.pdf"
+        if s3_service.exists(s3_key):
+            pdf_url = s3_service.object_url(s3_key)
+            logger.info(f"PDF already exists in S3: {pdf_url}")
+        else:
+            pdf_url = upload_to_s3(str(pdf_path))
+            logger.info(f"Uploaded PDF to S3: {pdf_url}")
+        return pdf_url
+    except Exception as s3_error:
+        logger.error(f"S3 error for invoice {invoice['invoice_number']}: {str(s3_error)}")
+        return ''  # Fallback to empty string if S3 fails
+
+def migrate_batch(
+    db: InvoiceDB, s3_service, batch: List[Dict[str, Any]], checkpoint: Dict[str, Any], upsert: bool = False
+):
+    """
+    Insert one batch with a single bulk insert; PDFs are only uploaded for invoices not yet stored.
+
+    With `upsert` (journal input), stored invoices are overwritten with the
+    batch's last record for them instead of skipped, so later journal lines win.
+    """
+    keyed = [(index, invoice['invoice_number']) for index, invoice in enumerate(batch)
+             if isinstance(invoice, dict) and invoice.get('invoice_number')]
+    existing = db.batch_check_duplicates([number for _, number in keyed]) if keyed else {}
+    if upsert:
+        # Earlier lines for an invoice are superseded by its last one in the batch
+        last = {number: index for index, number in keyed}
+        superseded = {index for index, number in keyed if last[number] != index}
+        checkpoint["skipped"] += len(superseded)
+        batch = [invoice for index, invoice in enumerate(batch) if index not in superseded]
+    entries = []
+    for invoice in batch:
+        try:
+            if existing.get(invoice['invoice_number']) and not upsert:
+                checkpoint["skipped"] += 1
+                continue
+            entries.append({
+                'invoice_number': invoice['invoice_number'],
+                'vendor_name': invoice['vendor_name'],
+                'invoice_date': invoice['invoice_date'],
+                'total_amount': float(invoice['total_amount']),
+                'status': invoice.get('validation_status', 'valid'),
+                # Stored invoices already have their PDF; an empty URL keeps the stored one on upsert
+                'pdf_url': invoice.get('pdf_url', '') if existing.get(invoice['invoice_number']) else resolve_pdf_url(invoice, s3_service),
+                'confidence': invoice.get('confidence', 0.95),
+                'total_time': invoice.get('total_time', 0.0)
+            })
+        except Exception as e:
+            number = invoice.get('invoice_number', 'unknown') if isinstance(invoice, dict) else 'unknown'
+            logger.error(f"Error migrating invoice {number}: {str(e)}")
+            checkpoint["errors"] += 1
+    results = db.bulk_insert_invoices(entries, update_existing=upsert) if entries else []
+    for entry, (is_new, _, error) in zip(entries, results):
+        if is_new:
+            checkpoint["migrated"] += 1
+        elif upsert and error is None:
+            checkpoint["updated"] += 1
+        elif error and "already exists" in error:
+            checkpoint["skipped"] += 1
+        else:
+            logger.error(f"Error migrating invoice {entry['invoice_number']}: {error}")
+            checkpoint["errors"] += 1
+
+def migrate_invoices(
+    input_path: Path = INVOICES_JOURNAL,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    checkpoint_path: Path = CHECKPOINT_FILE,
+    reset: bool = False
+) -> bool:
+    """Stream invoices from the journal or a JSON array into SQLite in batches, checkpointing after each committed batch."""
+    try:
+        input_path = resolve_source(input_path)
+        if not input_path.exists():
+            logger.error(f"Invoice file not found: {input_path}")
             return False
-            
-        logger.info(f"Found {len(invoices)} invoices to migrate")
-        
+        if reset and checkpoint_path.exists():
+            checkpoint_path.unlink()
+        checkpoint = load_checkpoint(checkpoint_path, input_path)
+
         db = InvoiceDB()
-        s3_client = boto3.client("s3")
-        migrated = 0
-        errors = 0
-        skipped = 0
-        
-        for invoice in invoices:
-            try:
-                # Check if invoice already exists in database
-                try:
-                    existing = db.get_invoice_by_id(invoice['invoice_number'])
-                    if existing:
-                        logger.info(f"Invoice {invoice['invoice_number']} already exists in database, skipping")
-                        skipped += 1
-                        continue
-                except:
-                    pass  # If get_invoice_by_id fails, we'll try to insert
-                
-                # Try multiple locations for the PDF
-                pdf_paths = [
-                    PROCESSED_DIR / f"{invoice['invoice_number']}.pdf",
-                    RAW_DIR / invoice.get('file_name', ''),
-                    RAW_DIR / f"{invoice['invoice_number']}.pdf"
-                ]
-                
-                pdf_path = None
-                for path in pdf_paths:
-                    if path.exists():
-                        pdf_path = path
-                        break
-                
-                if pdf_path:
-                    try:
-                        s3_key = f"invoices/{invoice['invoice_number']}.pdf"
-                        try:
-                            s3_client.head_object(Bucket=BUCKET_NAME, Key=s3_key)
-                            pdf_url = f"https://{BUCKET_NAME}.s3.amazonaws.com/{s3_key}"
-                            logger.info(f"PDF already exists in S3: {pdf_url}")
-                        except ClientError as e:
-                            if e.response['Error']['Code'] == '404':
-                                pdf_url = upload_to_s3(str(pdf_path))
-                                logger.info(f"Uploaded PDF to S3: {pdf_url}")
-                            else:
-                                raise
-                    except Exception as s3_error:
-                        logger.error(f"S3 error for invoice {invoice['invoice_number']}: {str(s3_error)}")
-                        pdf_url = ''  # Fallback to empty string if S3 fails
-                else:
-                    logger.warning(f"PDF file not found for invoice {invoice['invoice_number']}")
-                    pdf_url = invoice.get('pdf_url', '')
-                
-                db_entry = {
-                    'invoice_number': invoice['invoice_number'],
-                    'vendor_name': invoice['vendor_name'],
-                    'invoice_date': invoice['invoice_date'],
-                    'total_amount': float(invoice['total_amount']),
-                    'status': invoice.get('validation_status', 'valid'),
-                    'pdf_url': pdf_url,
-                    'confidence': invoice.get('confidence', 0.95),
-                    'total_time': invoice.get('total_time', 0.0)
-                }
-                
-                db.insert_invoice(db_entry)
-                migrated += 1
-                logger.info(f"Successfully migrated invoice {invoice['invoice_number']}")
-                
-            except Exception as e:
-                logger.error(f"Error migrating invoice {invoice.get('invoice_number', 'unknown')}: {str(e)}")
-                errors += 1
-                
-        logger.info(f"Migration completed: {migrated} migrated, {errors} errors, {skipped} skipped")
-        return migrated > 0 and errors == 0
-        
+        s3_service = get_s3_service()
+        invoices = iter_invoices(input_path, checkpoint["offset"])
+        total_bytes = input_path.stat().st_size
+        batch_size = max(1, min(batch_size, 32766))  # batch_check_duplicates binds one parameter per invoice
+        started = time.monotonic()
+        resumed_records = checkpoint["records"]
+        batch: List[Dict[str, Any]] = []
+
+        def commit_batch(end_offset: int):
+            migrate_batch(db, s3_service, batch, checkpoint, upsert=is_journal(input_path))
+            checkpoint["records"] += len(batch)
+            checkpoint["offset"] = end_offset
+            save_checkpoint(checkpoint_path, checkpoint)
+            batch.clear()
+            elapsed = max(time.monotonic() - started, 1e-9)
+            logger.info(
+                f"Progress: {checkpoint['records']} records ({100.0 * end_offset / max(total_bytes, 1):.1f}% of file), "
+                f"{checkpoint['migrated']} migrated, {checkpoint['updated']} updated, {checkpoint['skipped']} skipped, "
+                f"{checkpoint['errors']} errors, "
+                f"{(checkpoint['records'] - resumed_records) / elapsed:.0f} records/s"
+            )
+
+        end_offset = checkpoint["offset"]
+        for invoice, end_offset in invoices:
+            batch.append(invoice)
+            if len(batch) >= batch_size:
+                commit_batch(end_offset)
+        if batch:
+            commit_batch(end_offset)
+
+        logger.info(
+            f"Migration completed: {checkpoint['migrated']} migrated, {checkpoint['updated']} updated, {checkpoint['errors']} errors, "
+            f"{checkpoint['skipped']} skipped in {time.monotonic() - started:.1f}s"
+        )
+        return checkpoint["errors"] == 0
+
     except Exception as e:
         logger.error(f"Migration failed: {str(e)}")
         return False
 
-def verify_migration():
-    """Verify the migration by comparing JSON and database records."""
+def verify_migration(input_path: Path = INVOICES_JOURNAL, batch_size: int = DEFAULT_BATCH_SIZE) -> bool:
+    """Verify the migration by streaming the source again and checking each batch of invoice numbers against the database."""
     try:
-        with open(INVOICES_FILE, 'r') as f:
-            json_invoices = json.load(f)
-            
+        input_path = resolve_source(input_path)
         db = InvoiceDB()
-        db_invoices = db.get_all_invoices()
-        
-        json_count = len(json_invoices)
-        db_count = len(db_invoices)
-        
-        logger.info(f"JSON records: {json_count}, Database records: {db_count}")
-        
-        # Create sets of invoice numbers for comparison
-        json_numbers = {inv['invoice_number'] for inv in json_invoices}
-        db_numbers = {inv['invoice_number'] for inv in db_invoices}
-        
-        missing = json_numbers - db_numbers
-        if missing:
-            logger.error(f"Missing invoices in database: {missing}")
-            return False
-            
-        extra = db_numbers - json_numbers
-        if extra:
-            logger.warning(f"Extra invoices in database: {extra}")
-            
-        return len(missing) == 0
-        
+        batch_size = max(1, min(batch_size, 32766))
+        json_count = 0
+        missing_count = 0
+        batch: List[str] = []
+
+        def check_batch():
+            nonlocal missing_count
+            existing = db.batch_check_duplicates(batch)
+            missing = [number for number in batch if not existing.get(number)]
+            if missing:
+                missing_count += len(missing)
+                logger.error(f"Missing invoices in database: {missing}")
+            batch.clear()
+
+        for invoice, _ in iter_invoices(input_path):
+            json_count += 1
+            if not isinstance(invoice, dict) or not invoice.get('invoice_number'):
+                continue  # Reported as an error during migration
+            batch.append(invoice['invoice_number'])
+            if len(batch) >= batch_size:
+                check_batch()
+        if batch:
+            check_batch()
+
+        db_count = db.get_invoice_count()
+        logger.info(f"Source records: {json_count}, Database records: {db_count}")
+        # A journal repeats an invoice on every update, so only a JSON array's count bounds the database
+        if not is_journal(input_path) and db_count > json_count - missing_count:
+            logger.warning(f"Database holds {db_count - (json_count - missing_count)} or more invoices not in {input_path}")
+        return missing_count == 0
+
     except Exception as e:
         logger.error(f"Verification failed: {str(e)}")
         return False
 
-async def main():
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Stream structured invoices from the journal or JSON into SQLite, resumably.")
+    parser.add_argument(
+        "--input", type=Path, default=INVOICES_JOURNAL,
+        help="Invoice journal (.jsonl, latest record per invoice wins) or JSON array of invoices to migrate"
+    )
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Invoices per bulk insert and checkpoint")
+    parser.add_argument("--checkpoint", type=Path, default=CHECKPOINT_FILE, help="Resume state file")
+    parser.add_argument("--reset", action="store_true", help="Ignore any existing checkpoint and start from the beginning")
+    parser.add_argument("--skip-verify", action="store_true", help="Do not re-read the input to verify the migration")
+    args = parser.parse_args()
+
     logger.info("Starting invoice migration")
-    success = await migrate_invoices()
-    
-    if success:
-        logger.info("Migration successful, verifying...")
-        if verify_migration():
-            logger.info("Verification successful")
-            return 0
-        else:
-            logger.error("Verification failed")
-            return 1
-    else:
+    if not migrate_invoices(args.input, args.batch_size, args.checkpoint, args.reset):
         logger.error("Migration failed")
         return 1
+    if args.skip_verify:
+        return 0
+    logger.info("Migration successful, verifying...")
+    if verify_migration(args.input, args.batch_size):
+        logger.info("Verification successful")
+        return 0
+    logger.error("Verification failed")
+    return 1
 
 if __name__ == "__main__":
-    exit_code = asyncio.run(main())
-    exit(exit_code)
\ No newline at end of file
+    exit(main())
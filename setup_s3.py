@@ -2,121 +2,246 @@
 import os
 import json
 import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
 from botocore.config import Config
+from io import BytesIO
 from pathlib import Path
+from typing import BinaryIO, Optional, Tuple
+from urllib.parse import urlparse
 from config.logging_config import logger
+from config.settings import (
+    S3_ENDPOINT_URL, S3_MAX_POOL_CONNECTIONS, S3_CONNECT_TIMEOUT, S3_READ_TIMEOUT,
+    S3_MULTIPART_THRESHOLD_MB, S3_MULTIPART_CHUNKSIZE_MB, S3_MAX_TRANSFER_CONCURRENCY
+)
 from dotenv import load_dotenv
+import threading
 import time
 
 # Load environment variables
 load_dotenv()
 
-# Configure S3 client with retries
+# Configure S3 client with retries, timeouts and a connection pool sized for concurrent uploads
 config = Config(
     retries = dict(
         max_attempts = 3,
         mode = 'adaptive'
-    )
+    ),
+    max_pool_connections = S3_MAX_POOL_CONNECTIONS,
+    connect_timeout = S3_CONNECT_TIMEOUT,
+    read_timeout = S3_READ_TIMEOUT
+)
+
+# Multipart settings shared by every upload and download
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold = S3_MULTIPART_THRESHOLD_MB * 1024 * 1024,
+    multipart_chunksize = S3_MULTIPART_CHUNKSIZE_MB * 1024 * 1024,
+    max_concurrency = S3_MAX_TRANSFER_CONCURRENCY
 )
 
 BUCKET_NAME = os.getenv('S3_BUCKET_NAME', 'yan-brim-invoice-nextjs-2025')
 AWS_REGION = os.getenv('AWS_DEFAULT_REGION', 'us-east-1')
 
-def get_s3_client():
-    """Get an S3 client with proper configuration."""
-    return boto3.client(
-        's3',
-        region_name=AWS_REGION,
-        config=config
-    )
+class S3StorageService:
+    """
+    Process-wide S3 access: one client (thread-safe, with a pooled HTTP
+    connection per worker), shared multipart settings, and a bucket check
+    that runs once instead of before every upload. Point `endpoint_url` at
+    an S3-compatible server (MinIO, moto) to run against a local stand-in.
+    """
 
-def ensure_bucket_exists():
-    """Ensure S3 bucket exists and has proper configuration."""
-    s3_client = get_s3_client()
-    
-    try:
-        s3_client.head_bucket(Bucket=BUCKET_NAME)
-        logger.info(f"Bucket {BUCKET_NAME} already exists")
-    except ClientError as e:
-        error_code = int(e.response['Error']['Code'])
-        if error_code == 404:
-            try:
-                # Create bucket in the specified region
-                if AWS_REGION == 'us-east-1':
-                    s3_client.create_bucket(Bucket=BUCKET_NAME)
-                else:
-                    s3_client.create_bucket(
-                        Bucket=BUCKET_NAME,
-                        CreateBucketConfiguration={'LocationConstraint': AWS_REGION}
+    def __init__(self, bucket: str = None, region: str = None, endpoint_url: Optional[str] = None):
+        self.bucket = bucket or BUCKET_NAME
+        self.region = region or AWS_REGION
+        self.endpoint_url = endpoint_url
+        self._client = None
+        self._client_pid = None
+        self._bucket_ready = False
+        self._lock = threading.RLock()  # ensure_bucket holds it while the client is first built
+
+    @property
+    def client(self):
+        """Shared boto3 client, rebuilt in forked children (clients must not cross a fork)."""
+        if self._client is None or self._client_pid != os.getpid():
+            with self._lock:
+                if self._client is None or self._client_pid != os.getpid():
+                    self._client = boto3.client(
+                        's3',
+                        region_name=self.region,
+                        endpoint_url=self.endpoint_url,
+                        config=config
                     )
-                logger.info(f"Created bucket {BUCKET_NAME}")
+                    self._client_pid = os.getpid()
+        return self._client
+
+    def object_url(self, key: str) -> str:
+        """Public URL of an object; path-style when a custom endpoint is configured."""
+        if self.endpoint_url:
+            return f"{self.endpoint_url.rstrip('/')}/{self.bucket}/{key}"
+        return f"https://{self.bucket}.s3.amazonaws.com/{key}"
+
+    def parse_object_url(self, url: str) -> Tuple[str, str]:
+        """(bucket, key) of a URL produced by object_url."""
+        parsed = urlparse(url)
+        path_parts = [part for part in parsed.path.split('/') if part]
+        if self.endpoint_url and url.startswith(self.endpoint_url.rstrip('/') + '/'):
+            if len(path_parts) < 2:
+                raise ValueError("Invalid S3 URL path")
+            return path_parts[0], '/'.join(path_parts[1:])
+        if not path_parts:
+            raise ValueError("Invalid S3 URL path")
+        return parsed.netloc.split('.')[0], '/'.join(path_parts)
+
+    def ensure_bucket(self, force: bool = False):
+        """Ensure the bucket exists and has proper configuration; checked once per process unless forced."""
+        if self._bucket_ready and not force:
+            return
+        with self._lock:
+            if self._bucket_ready and not force:
+                return
+            self._create_bucket_if_missing()
+            self._bucket_ready = True
+
+    def _create_bucket_if_missing(self):
+        try:
+            self.client.head_bucket(Bucket=self.bucket)
+            logger.info(f"Bucket {self.bucket} already exists")
+        except ClientError as e:
+            error_code = int(e.response['Error']['Code'])
+            if error_code == 404:
+                try:
+                    # Create bucket in the specified region
+                    if self.region == 'us-east-1':
+                        self.client.create_bucket(Bucket=self.bucket)
+                    else:
+                        self.client.create_bucket(
+                            Bucket=self.bucket,
+                            CreateBucketConfiguration={'LocationConstraint': self.region}
+                        )
+                    logger.info(f"Created bucket {self.bucket}")
                 
-                # Wait for bucket to exist
-                waiter = s3_client.get_waiter('bucket_exists')
-                waiter.wait(Bucket=BUCKET_NAME)
+                    # Wait for bucket to exist
+                    waiter = self.client.get_waiter('bucket_exists')
+                    waiter.wait(Bucket=self.bucket)
                 
-                # Make bucket public
-                s3_client.put_public_access_block(
-                    Bucket=BUCKET_NAME,
-                    PublicAccessBlockConfiguration={
-                        'BlockPublicAcls': False,
-                        'IgnorePublicAcls': False,
-                        'BlockPublicPolicy': False,
-                        'RestrictPublicBuckets': False
-                    }
-                )
-
-                # Configure bucket policy for public read access
-                bucket_policy = {
-                    "Version": "2012-10-17",
-                    "Statement": [
-                        {
-                            "Sid": "PublicReadGetObject",
-                            "Effect": "Allow",
-                            "Principal": "*",
-                            "Action": ["s3:GetObject"],
-                            "Resource": [f"arn:aws:s3:::{BUCKET_NAME}/*"]
+                    # Make bucket public
+                    self.client.put_public_access_block(
+                        Bucket=self.bucket,
+                        PublicAccessBlockConfiguration={
+                            'BlockPublicAcls': False,
+                            'IgnorePublicAcls': False,
+                            'BlockPublicPolicy': False,
+                            'RestrictPublicBuckets': False
                         }
-                    ]
-                }
+                    )
+
+                    # Configure bucket policy for public read access
+                    bucket_policy = {
+                        "Version": "2012-10-17",
+                        "Statement": [
+                            {
+                                "Sid": "PublicReadGetObject",
+                                "Effect": "Allow",
+                                "Principal": "*",
+                                "Action": ["s3:GetObject"],
+                                "Resource": [f"arn:aws:s3:::{self.bucket}/*"]
+                            }
+                        ]
+                    }
                 
-                # Set the policy
-                s3_client.put_bucket_policy(
-                    Bucket=BUCKET_NAME,
-                    Policy=json.dumps(bucket_policy)
-                )
-                logger.info("Set bucket policy for public read access")
+                    # Set the policy
+                    self.client.put_bucket_policy(
+                        Bucket=self.bucket,
+                        Policy=json.dumps(bucket_policy)
+                    )
+                    logger.info("Set bucket policy for public read access")
                 
-                # Enable CORS for web access
-                cors_configuration = {
-                    'CORSRules': [{
-                        'AllowedHeaders': ['*'],
-                        'AllowedMethods': ['GET', 'HEAD'],
-                        'AllowedOrigins': ['*'],
-                        'ExposeHeaders': ['ETag'],
-                        'MaxAgeSeconds': 3000
-                    }]
-                }
-                s3_client.put_bucket_cors(
-                    Bucket=BUCKET_NAME,
-                    CORSConfiguration=cors_configuration
-                )
-                logger.info("Set bucket CORS policy")
+                    # Enable CORS for web access
+                    cors_configuration = {
+                        'CORSRules': [{
+                            'AllowedHeaders': ['*'],
+                            'AllowedMethods': ['GET', 'HEAD'],
+                            'AllowedOrigins': ['*'],
+                            'ExposeHeaders': ['ETag'],
+                            'MaxAgeSeconds': 3000
+                        }]
+                    }
+                    self.client.put_bucket_cors(
+                        Bucket=self.bucket,
+                        CORSConfiguration=cors_configuration
+                    )
+                    logger.info("Set bucket CORS policy")
                 
-            except ClientError as create_error:
-                logger.error(f"Failed to create bucket: {create_error}")
+                except ClientError as create_error:
+                    logger.error(f"Failed to create bucket: {create_error}")
+                    raise
+            elif error_code == 403:
+                logger.error("Access denied. Please check your AWS credentials and permissions.")
                 raise
-        elif error_code == 403:
-            logger.error("Access denied. Please check your AWS credentials and permissions.")
-            raise
-        else:
-            logger.error(f"Error checking bucket: {e}")
+            else:
+                logger.error(f"Error checking bucket: {e}")
+                raise
+
+    def upload_file(self, file_path: str, key: str, content_type: str = 'application/pdf') -> str:
+        """Upload a local file (multipart above the threshold) and return its public URL."""
+        self.ensure_bucket()
+        self.client.upload_file(
+            file_path,
+            self.bucket,
+            key,
+            ExtraArgs={'ContentType': content_type},
+            Config=TRANSFER_CONFIG
+        )
+        return self.object_url(key)
+
+    def upload_bytes(self, data: bytes, key: str, content_type: str = 'application/pdf') -> str:
+        """Upload in-memory content and return its public URL."""
+        return self.upload_fileobj(BytesIO(data), key, content_type)
+
+    def upload_fileobj(self, fileobj: BinaryIO, key: str, content_type: str = 'application/pdf') -> str:
+        """Stream a readable binary file object (e.g. a request body) and return its public URL."""
+        self.ensure_bucket()
+        self.client.upload_fileobj(
+            fileobj,
+            self.bucket,
+            key,
+            ExtraArgs={'ContentType': content_type},
+            Config=TRANSFER_CONFIG
+        )
+        return self.object_url(key)
+
+    def exists(self, key: str) -> bool:
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return False
             raise
 
+_s3_service = None
+_s3_service_lock = threading.Lock()
+
+def get_s3_service() -> S3StorageService:
+    """Return the process-wide S3 service, creating it on first use."""
+    global _s3_service
+    if _s3_service is None:
+        with _s3_service_lock:
+            if _s3_service is None:
+                _s3_service = S3StorageService(BUCKET_NAME, AWS_REGION, S3_ENDPOINT_URL)
+    return _s3_service
+
+def get_s3_client():
+    """Get the shared, pooled S3 client."""
+    return get_s3_service().client
+
+def ensure_bucket_exists():
+    """Ensure S3 bucket exists and has proper configuration."""
+    get_s3_service().ensure_bucket()
+
 def upload_to_s3(file_path: str, max_retries: int = 3) -> str:
     """Upload a file to S3 and return its public URL."""
-    s3_client = get_s3_client()
+    s3_service = get_s3_service()
     file_name = Path(file_path).name
     s3_key = f"invoices/{file_name}"
     
@@ -125,23 +250,8 @@ def upload_to_s3(file_path: str, max_retries: int = 3) -> str:
             if not Path(file_path).exists():
                 raise FileNotFoundError(f"File not found: {file_path}")
                 
-            # Ensure the bucket exists before upload
-            ensure_bucket_exists()
-            
-            # Upload file with content-type set for PDFs
-            extra_args = {
-                'ContentType': 'application/pdf'
-                # ACL removed as bucket policy handles public access
-            }
-            
-            s3_client.upload_file(
-                file_path, 
-                BUCKET_NAME,
-                s3_key,
-                ExtraArgs=extra_args
-            )
-            
-            pdf_url = f"https://{BUCKET_NAME}.s3.amazonaws.com/{s3_key}"
+            # Bucket check is memoized; content-type set for PDFs, ACL handled by bucket policy
+            pdf_url = s3_service.upload_file(file_path, s3_key, content_type='application/pdf')
             logger.info(f"Successfully uploaded {file_name} to S3: {pdf_url}")
             return pdf_url
             
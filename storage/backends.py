@@ -0,0 +1,172 @@
+# Pluggable persistence for invoice PDFs: S3, local filesystem, or in-memory
+
+import os
+import shutil
+import threading
+import uuid
+from abc import ABC, abstractmethod
+from io import BytesIO
+from pathlib import Path
+from typing import BinaryIO, Dict, Optional, Union
+from config.logging_config import logger
+from config.settings import STORAGE_BACKEND, LOCAL_STORAGE_DIR
+
+# What save() accepts: raw bytes, or a readable binary stream such as an open file or request body
+StorageData = Union[bytes, BinaryIO]
+
+_backend = None
+_backend_lock = threading.Lock()
+
+def invoice_pdf_key(invoice_number: str) -> str:
+    """Storage key of an invoice's PDF."""
+    return f"{invoice_number}.pdf"
+
+class StorageBackend(ABC):
+    """Where a processed invoice PDF is written, exactly once, and read back from."""
+
+    @abstractmethod
+    def save(self, key: str, data: StorageData, content_type: str = "application/pdf") -> str:
+        """Persist `data` under `key` and return the URL recorded for it. Streams are consumed, not buffered."""
+
+    @abstractmethod
+    def open(self, key: str) -> BinaryIO:
+        """Readable binary stream of a stored object; the caller closes it."""
+
+    @abstractmethod
+    def exists(self, key: str) -> bool:
+        ...
+
+    @abstractmethod
+    def delete(self, key: str):
+        ...
+
+    @abstractmethod
+    def url(self, key: str) -> str:
+        ...
+
+    def read(self, key: str) -> bytes:
+        stream = self.open(key)
+        try:
+            return stream.read()
+        finally:
+            stream.close()
+
+class LocalStorageBackend(StorageBackend):
+    """Files under a root directory, written atomically (temp file + rename)."""
+
+    def __init__(self, root: Union[str, Path] = LOCAL_STORAGE_DIR):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key: str) -> Path:
+        path = (self.root / key).resolve()
+        if self.root.resolve() not in path.parents:
+            raise ValueError(f"Storage key escapes the storage root: {key}")
+        return path
+
+    def save(self, key: str, data: StorageData, content_type: str = "application/pdf") -> str:
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+        try:
+            with open(tmp_path, "wb") as f:
+                if isinstance(data, (bytes, bytearray, memoryview)):
+                    f.write(data)
+                else:
+                    shutil.copyfileobj(data, f)
+            os.replace(tmp_path, path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+        logger.info(f"Saved {key} to {path}")
+        return self.url(key)
+
+    def open(self, key: str) -> BinaryIO:
+        return open(self._path(key), "rb")
+
+    def exists(self, key: str) -> bool:
+        return self._path(key).is_file()
+
+    def delete(self, key: str):
+        self._path(key).unlink(missing_ok=True)
+
+    def url(self, key: str) -> str:
+        return str(self._path(key))
+
+class S3StorageBackend(StorageBackend):
+    """Objects in the configured S3 bucket under `prefix`, through the shared pooled client."""
+
+    def __init__(self, service=None, prefix: str = "invoices/"):
+        from setup_s3 import get_s3_service  # boto3 is only needed when S3 storage is selected
+        self.service = service or get_s3_service()
+        self.prefix = prefix
+
+    def save(self, key: str, data: StorageData, content_type: str = "application/pdf") -> str:
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            data = BytesIO(data)
+        pdf_url = self.service.upload_fileobj(data, self.prefix + key, content_type)
+        logger.info(f"Uploaded {key} to S3: {pdf_url}")
+        return pdf_url
+
+    def open(self, key: str) -> BinaryIO:
+        return self.service.client.get_object(Bucket=self.service.bucket, Key=self.prefix + key)["Body"]
+
+    def exists(self, key: str) -> bool:
+        return self.service.exists(self.prefix + key)
+
+    def delete(self, key: str):
+        self.service.client.delete_object(Bucket=self.service.bucket, Key=self.prefix + key)
+
+    def url(self, key: str) -> str:
+        return self.service.object_url(self.prefix + key)
+
+class InMemoryStorageBackend(StorageBackend):
+    """Process-local dict of objects, for tests and dry runs."""
+
+    def __init__(self):
+        self.objects: Dict[str, bytes] = {}
+        self._lock = threading.Lock()
+
+    def save(self, key: str, data: StorageData, content_type: str = "application/pdf") -> str:
+        content = bytes(data) if isinstance(data, (bytes, bytearray, memoryview)) else data.read()
+        with self._lock:
+            self.objects[key] = content
+        return self.url(key)
+
+    def open(self, key: str) -> BinaryIO:
+        with self._lock:
+            if key not in self.objects:
+                raise FileNotFoundError(f"No stored object: {key}")
+            return BytesIO(self.objects[key])
+
+    def exists(self, key: str) -> bool:
+        with self._lock:
+            return key in self.objects
+
+    def delete(self, key: str):
+        with self._lock:
+            self.objects.pop(key, None)
+
+    def url(self, key: str) -> str:
+        return f"memory://{key}"
+
+def create_storage_backend(kind: str = STORAGE_BACKEND) -> StorageBackend:
+    backends = {"s3": S3StorageBackend, "local": LocalStorageBackend, "memory": InMemoryStorageBackend}
+    if kind not in backends:
+        raise ValueError(f"Unknown storage backend {kind!r}; expected one of {sorted(backends)}")
+    return backends[kind]()
+
+def get_storage_backend() -> StorageBackend:
+    """Return the process-wide storage backend selected by STORAGE_BACKEND, creating it on first use."""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = create_storage_backend()
+                logger.info(f"Using {type(_backend).__name__} for invoice PDFs")
+    return _backend
+
+def set_storage_backend(backend: Optional[StorageBackend]):
+    """Replace the process-wide backend (e.g. with an InMemoryStorageBackend in tests); None resets it."""
+    global _backend
+    with _backend_lock:
+        _backend = backend
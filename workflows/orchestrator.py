@@ -4,35 +4,42 @@ from pathlib import Path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 import logging
 import asyncio
-import json
-import shutil
 import uuid
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
 from config.logging_config import logger  # Import singleton logger
 from config.monitoring import Monitoring  # Import Monitoring class
+from config.settings import MAX_CONCURRENT_INVOICES, DB_BULK_INSERT_CHUNK_SIZE
 from agents.extractor_agent import InvoiceExtractionAgent
 from agents.validator_agent import InvoiceValidationAgent
-from agents.matching_agent import PurchaseOrderMatchingAgent
+from agents.matching_agent import get_matching_agent
 from agents.human_review_agent import HumanReviewAgent
-from db import InvoiceDB  # Import the InvoiceDB class
-from setup_s3 import upload_to_s3  # Import the S3 upload function
+from db import get_async_db  # Shared pooled database access, awaitable
+from data_processing.record_journal import get_journal
+from data_processing.document_parser import PdfSource
+from storage.backends import get_storage_backend, invoice_pdf_key  # Where processed PDFs are persisted
 
 # Constants
 PROCESSED_DIR = Path("data/processed")
-TEMP_DIR = Path("data/temp")
 INVOICES_FILE = PROCESSED_DIR / "structured_invoices.json"
-ANOMALIES_FILE = PROCESSED_DIR / "anomalies.json"
+# Append-only journal; the JSON file above is refreshed as a snapshot on compaction
+INVOICES_JOURNAL = PROCESSED_DIR / "structured_invoices.jsonl"
+# "queued" counts invoices waiting on the process_many semaphore
+PIPELINE_STAGES = ("queued", "extraction", "validation", "matching", "review")
 
 class InvoiceProcessingWorkflow:
     def __init__(self):
         logger.debug("Initializing workflow agents")
         self.extraction_agent = InvoiceExtractionAgent()
         self.validation_agent = InvoiceValidationAgent()
-        self.matching_agent = PurchaseOrderMatchingAgent()
+        self.matching_agent = get_matching_agent()  # Shared PO list and vendor index, built once per process
         self.review_agent = HumanReviewAgent()
-        self.db = InvoiceDB()  # Initialize database connection
+        self.db = get_async_db()  # Process-wide database handle; queries run off the event loop
+        self.stage_depth: Dict[str, int] = {stage: 0 for stage in PIPELINE_STAGES}
+        self.pending_db_entries: List[dict] = []  # Invoice rows deferred for the next bulk insert
+        self.storage = get_storage_backend()
         # Create necessary directories
         PROCESSED_DIR.mkdir(parents=True, exist_ok=True)
-        TEMP_DIR.mkdir(parents=True, exist_ok=True)
+        self.invoice_journal = get_journal(INVOICES_JOURNAL, ("invoice_number", "file_name"), legacy_path=INVOICES_FILE)
 
     async def _retry_with_backoff(self, func, max_retries=3, base_delay=1):
         logger.debug(f"Starting retry mechanism with max_retries={max_retries}, base_delay={base_delay}")
@@ -49,15 +56,108 @@ class InvoiceProcessingWorkflow:
                 logger.warning(f"Attempt {attempt + 1} failed: {str(e)}. Retrying in {delay}s...")
                 await asyncio.sleep(delay)
 
-    async def process_invoice(self, document_path: str, save_pdf: bool = True) -> dict:
-        logger.info(f"Starting invoice processing for: {document_path}")
-        logger.debug(f"Processing pipeline initiated for document: {document_path}")
+    async def _run_stage(self, stage: str, func):
+        """Run a pipeline stage with retries while tracking how many invoices are in it."""
+        self.stage_depth[stage] += 1
+        try:
+            return await self._retry_with_backoff(func)
+        finally:
+            self.stage_depth[stage] -= 1
+
+    def stage_queue_depth(self) -> Dict[str, int]:
+        """Snapshot of the number of invoices currently queued or inside each stage."""
+        return dict(self.stage_depth)
+
+    async def flush_db_entries(self) -> List[Tuple[bool, int, Optional[str]]]:
+        """Write all deferred invoice rows with one bulk insert."""
+        entries, self.pending_db_entries = self.pending_db_entries, []
+        if not entries:
+            return []
+        try:
+            results = await self.db.bulk_insert_invoices(entries)
+        except Exception as db_error:
+            logger.error(f"Failed to bulk insert {len(entries)} invoices into database: {str(db_error)}")
+            return []
+        for entry, (is_new, invoice_id, error) in zip(entries, results):
+            if not is_new:
+                logger.warning(f"Invoice {entry['invoice_number']} not inserted (ID {invoice_id}): {error}")
+        logger.info(f"Bulk inserted {sum(is_new for is_new, _, _ in results)}/{len(entries)} invoices into database")
+        return results
+
+    async def process_many(
+        self,
+        document_paths: Iterable[str],
+        concurrency: int = MAX_CONCURRENT_INVOICES,
+        save_pdf: bool = True,
+        on_result: Optional[Callable[[str, dict], Awaitable[None]]] = None,
+        rag_results: Optional[Dict[str, dict]] = None
+    ) -> List[Tuple[str, dict]]:
+        """
+        Process many invoices concurrently with at most `concurrency` in flight.
+
+        Returns (document_path, result) pairs in completion order. If given,
+        `on_result` is awaited for each invoice as soon as it finishes.
+        `rag_results` holds RAG classifications already computed in a batch,
+        keyed by document path. Database rows are deferred and written with
+        bulk inserts of up to DB_BULK_INSERT_CHUNK_SIZE invoices.
+        """
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+
+        async def _worker(document_path: str) -> Tuple[str, dict]:
+            self.stage_depth["queued"] += 1
+            queued = True
+            try:
+                async with semaphore:
+                    self.stage_depth["queued"] -= 1
+                    queued = False
+                    result = await self.process_invoice(
+                        document_path,
+                        save_pdf=save_pdf,
+                        rag_result=(rag_results or {}).get(document_path),
+                        defer_db_insert=True
+                    )
+            except Exception as e:
+                logger.error(f"Failed to process {document_path}: {str(e)}")
+                result = {"status": "error", "message": str(e)}
+            finally:
+                if queued:
+                    self.stage_depth["queued"] -= 1
+            return document_path, result
 
-        # Save a copy of the original PDF if it's not already in temp
-        if not str(document_path).startswith(str(TEMP_DIR)):
-            temp_pdf = TEMP_DIR / f"{uuid.uuid4()}.pdf"
-            shutil.copy2(document_path, temp_pdf)
-            document_path = str(temp_pdf)
+        tasks = [asyncio.create_task(_worker(str(path))) for path in document_paths]
+        logger.info(f"Processing {len(tasks)} invoices with concurrency {concurrency}")
+        results = []
+        try:
+            for finished in asyncio.as_completed(tasks):
+                document_path, result = await finished
+                results.append((document_path, result))
+                logger.info(f"Completed {len(results)}/{len(tasks)}: {document_path}, stage queue depth: {self.stage_queue_depth()}")
+                if len(self.pending_db_entries) >= DB_BULK_INSERT_CHUNK_SIZE:
+                    await self.flush_db_entries()
+                if on_result:
+                    await on_result(document_path, result)
+        finally:
+            await self.flush_db_entries()
+        return results
+
+    async def process_invoice(
+        self,
+        document_path: PdfSource,
+        save_pdf: bool = True,
+        rag_result: Optional[dict] = None,
+        defer_db_insert: bool = False,
+        file_name: Optional[str] = None
+    ) -> dict:
+        """
+        Run one invoice through the pipeline. `document_path` is read in place
+        (no temp copy); it may also be the PDF's bytes, with `file_name` naming
+        the original upload. With `save_pdf`, the PDF is persisted once to the
+        storage backend and the invoice row is written to the database.
+        """
+        if file_name is None:
+            file_name = os.path.basename(document_path) if isinstance(document_path, str) else "upload.pdf"
+        logger.info(f"Starting invoice processing for: {file_name}")
+        logger.debug(f"Processing pipeline initiated for document: {file_name}")
 
         monitoring = Monitoring()
         extraction_time = None
@@ -68,7 +168,7 @@ class InvoiceProcessingWorkflow:
 
         try:
             monitoring.start_timer("extraction")
-            extracted_data = await self._retry_with_backoff(lambda: self.extraction_agent.run(document_path))
+            extracted_data = await self._run_stage("extraction", lambda: self.extraction_agent.run(document_path, rag_result))
             extraction_time = monitoring.stop_timer("extraction")
             logger.info(f"Extraction completed: {extracted_data}")
             
@@ -99,13 +199,17 @@ class InvoiceProcessingWorkflow:
                 "review_time": 0,
                 "total_time": extraction_time
             }
-            self._save_invoice_entry(invoice_entry)
+            await self._save_invoice_entry(invoice_entry)
             return invoice_entry
 
         # Validation
         try:
             monitoring.start_timer("validation")
-            validation_result = await self._retry_with_backoff(lambda: self.validation_agent.run(extracted_data))
+            # Identifies this run to the anomaly history, so its own validation retries are not flagged as duplicates
+            run_id = uuid.uuid4().hex
+            validation_result = await self._run_stage(
+                "validation", lambda: self.validation_agent.run(extracted_data, run_id)
+            )
             validation_time = monitoring.stop_timer("validation")
             logger.info(f"Validation completed: {validation_result}")
             
@@ -116,7 +220,7 @@ class InvoiceProcessingWorkflow:
                 logger.warning(f"Invoice validation failed: {validation_result}")
                 if "vendor_name" not in extracted_dict or not extracted_dict["vendor_name"]:
                     extracted_dict["confidence"] = 0.1
-                    extracted_dict["file_name"] = os.path.basename(document_path)
+                    extracted_dict["file_name"] = file_name
                     extracted_dict["reason"] = "Non-invoice document detected"
                     invoice_entry = {
                         **extracted_dict,
@@ -128,7 +232,7 @@ class InvoiceProcessingWorkflow:
                         "review_time": 0,
                         "total_time": extraction_time + validation_time
                     }
-                    self._save_anomaly_entry(invoice_entry)
+                    await self._save_anomaly_entry(invoice_entry)
                     return {
                         "anomaly": True,
                         "extracted_data": extracted_dict,
@@ -158,18 +262,18 @@ class InvoiceProcessingWorkflow:
                 invoice_entry.update({
                     "review_status": "needs_review",
                     "confidence": 0.1,
-                    "file_name": os.path.basename(document_path),
+                    "file_name": file_name,
                     "reason": "Non-invoice document detected"
                 })
-                self._save_anomaly_entry(invoice_entry)
+                await self._save_anomaly_entry(invoice_entry)
             else:
-                self._save_invoice_entry(invoice_entry)
+                await self._save_invoice_entry(invoice_entry)
             return invoice_entry
 
         # Matching
         try:
             monitoring.start_timer("matching")
-            matching_result = await self._retry_with_backoff(lambda: self.matching_agent.run(extracted_data))
+            matching_result = await self._run_stage("matching", lambda: self.matching_agent.run(extracted_data))
             matching_time = monitoring.stop_timer("matching")
             logger.info(f"Matching completed: {matching_result}")
         except Exception as e:
@@ -187,13 +291,13 @@ class InvoiceProcessingWorkflow:
                 "review_time": 0,
                 "total_time": extraction_time + validation_time + matching_time
             }
-            self._save_invoice_entry(invoice_entry)
+            await self._save_invoice_entry(invoice_entry)
             return invoice_entry
 
         # Review
         try:
             monitoring.start_timer("review")
-            review_result = await self._retry_with_backoff(lambda: self.review_agent.run(extracted_data, validation_result))
+            review_result = await self._run_stage("review", lambda: self.review_agent.run(extracted_data, validation_result))
             review_time = monitoring.stop_timer("review")
             logger.info(f"Review completed: {review_result}")
         except Exception as e:
@@ -211,7 +315,7 @@ class InvoiceProcessingWorkflow:
                 "review_time": review_time,
                 "total_time": extraction_time + validation_time + matching_time + review_time
             }
-            self._save_invoice_entry(invoice_entry)
+            await self._save_invoice_entry(invoice_entry)
             return invoice_entry
 
         # All steps completed successfully
@@ -227,19 +331,14 @@ class InvoiceProcessingWorkflow:
             "review_time": review_time,
             "total_time": total_time
         }
-        self._save_invoice_entry(invoice_entry)
+        await self._save_invoice_entry(invoice_entry)
 
-        # Save the PDF and upload to S3
+        # Persist the PDF once to the storage backend
         try:
             if save_pdf and extracted_dict.get('invoice_number'):
-                pdf_path = PROCESSED_DIR / f"{extracted_dict['invoice_number']}.pdf"
-                shutil.copy2(document_path, pdf_path)
-                logger.info(f"Saved PDF for invoice {extracted_dict['invoice_number']} to {pdf_path}")
-                
-                # Upload to S3
-                logger.info(f"Uploading invoice {extracted_dict['invoice_number']} to S3")
-                pdf_url = upload_to_s3(str(pdf_path))
-                logger.info(f"Successfully uploaded to S3: {pdf_url}")
+                logger.info(f"Storing PDF for invoice {extracted_dict['invoice_number']}")
+                pdf_url = await asyncio.to_thread(self._store_pdf, extracted_dict['invoice_number'], document_path)
+                logger.info(f"Stored PDF for invoice {extracted_dict['invoice_number']}: {pdf_url}")
                 
                 # Save to database
                 db_entry = {
@@ -251,13 +350,17 @@ class InvoiceProcessingWorkflow:
                     'pdf_url': pdf_url
                 }
                 
-                try:
-                    invoice_id = self.db.insert_invoice(db_entry)
-                    logger.info(f"Invoice {extracted_dict['invoice_number']} inserted into database with ID {invoice_id}")
-                except Exception as db_error:
-                    logger.error(f"Failed to insert invoice into database: {str(db_error)}")
-        except Exception as s3_error:
-            logger.error(f"Failed during S3 upload or database insertion: {str(s3_error)}")
+                if defer_db_insert:
+                    # Written by the caller's next flush_db_entries() bulk insert
+                    self.pending_db_entries.append(db_entry)
+                else:
+                    try:
+                        invoice_id = await self.db.insert_invoice(db_entry)
+                        logger.info(f"Invoice {extracted_dict['invoice_number']} inserted into database with ID {invoice_id}")
+                    except Exception as db_error:
+                        logger.error(f"Failed to insert invoice into database: {str(db_error)}")
+        except Exception as storage_error:
+            logger.error(f"Failed during PDF storage or database insertion: {str(storage_error)}")
             pdf_url = None
 
         result = {
@@ -270,68 +373,48 @@ class InvoiceProcessingWorkflow:
             "matching_time": matching_time,
             "review_time": review_time,
             "total_time": total_time,
-            "pdf_url": pdf_url  # Include the S3 URL in the result
+            "pdf_url": pdf_url  # Include the stored PDF URL in the result
         }
-        logger.info(f"Invoice processing completed: {document_path}")
+        logger.info(f"Invoice processing completed: {file_name}")
         logger.debug(f"Final result: {result}")
         return result
 
-    def _save_invoice_entry(self, invoice_entry):
+    def _store_pdf(self, invoice_number: str, document_path: PdfSource) -> str:
+        """Write the PDF to the storage backend, streaming from disk when given a path."""
+        key = invoice_pdf_key(invoice_number)
+        if isinstance(document_path, bytes):
+            return self.storage.save(key, document_path)
+        with open(document_path, "rb") as pdf_file:
+            return self.storage.save(key, pdf_file)
+
+    async def _save_invoice_entry(self, invoice_entry):
         try:
-            PROCESSED_DIR.mkdir(exist_ok=True)
-            try:
-                with open(INVOICES_FILE, "r") as f:
-                    all_invoices = json.load(f)
-            except (FileNotFoundError, json.JSONDecodeError):
-                all_invoices = []
-            for idx, inv in enumerate(all_invoices):
-                if inv.get('invoice_number') == invoice_entry.get('invoice_number'):
-                    all_invoices[idx] = invoice_entry
-                    break
-            else:
-                all_invoices.append(invoice_entry)
-            with open(INVOICES_FILE, "w") as f:
-                json.dump(all_invoices, f, indent=4)
-            logger.info(f"Saved invoice entry to {INVOICES_FILE}")
+            # The upsert takes a file lock and may compact or snapshot the journal; keep it off the event loop
+            await asyncio.to_thread(self.invoice_journal.upsert, invoice_entry, ("invoice_number",))
+            logger.info(f"Saved invoice entry to {INVOICES_JOURNAL}")
         except Exception as e:
             logger.error(f"Failed to save invoice entry: {str(e)}")
 
-    def _save_anomaly_entry(self, anomaly_entry):
+    async def _save_anomaly_entry(self, anomaly_entry):
         try:
-            PROCESSED_DIR.mkdir(exist_ok=True)
-            try:
-                with open(ANOMALIES_FILE, "r") as f:
-                    all_anomalies = json.load(f)
-            except (FileNotFoundError, json.JSONDecodeError):
-                all_anomalies = []
-            is_duplicate = False
-            for idx, anomaly in enumerate(all_anomalies):
-                if (anomaly.get('file_name') == anomaly_entry.get('file_name') or 
-                    anomaly.get('invoice_number') == anomaly_entry.get('invoice_number')):
-                    all_anomalies[idx] = anomaly_entry
-                    is_duplicate = True
-                    break
-            if not is_duplicate:
-                all_anomalies.append(anomaly_entry)
-            with open(ANOMALIES_FILE, "w") as f:
-                json.dump(all_anomalies, f, indent=4)
-            logger.info(f"Saved anomaly entry to {ANOMALIES_FILE}")
+            if await self.db.upsert_anomaly(anomaly_entry, match_on=("file_name", "invoice_number")) is None:
+                raise RuntimeError("database write failed")
+            logger.info("Saved anomaly entry to database")
         except Exception as e:
             logger.error(f"Failed to save anomaly entry: {str(e)}")
 
 async def main():
     workflow = InvoiceProcessingWorkflow()
     invoice_dir = "data/raw/invoices/"
-    for filename in os.listdir(invoice_dir):
-        if filename.endswith(".pdf"):
-            document_path = os.path.join(invoice_dir, filename)
-            try:
-                logger.info(f"Starting invoice processing for: {document_path}")
-                result = await workflow.process_invoice(document_path)
-                logger.info(f"Processed {filename}: {result}")
-                print(f"Result for {filename}: {result}")
-            except Exception as e:
-                logger.error(f"Failed to process {filename}: {str(e)}")
+    document_paths = [
+        os.path.join(invoice_dir, filename)
+        for filename in os.listdir(invoice_dir)
+        if filename.endswith(".pdf")
+    ]
+    for document_path, result in await workflow.process_many(document_paths):
+        filename = os.path.basename(document_path)
+        logger.info(f"Processed {filename}: {result}")
+        print(f"Result for {filename}: {result}")
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,108 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, List, Optional, Tuple
+from config.logging_config import logger
+from config.settings import (
+    UPLOAD_WORKERS, UPLOAD_QUEUE_SIZE, UPLOAD_MAX_RETRIES, UPLOAD_RETRY_BASE_DELAY, DB_BULK_INSERT_CHUNK_SIZE
+)
+
+# (job, upload result or None, error message or None)
+UploadOutcome = Tuple[dict, Any, Optional[str]]
+
+class UploadStage:
+    """
+    Pipeline stage that uploads finished invoices in the background.
+
+    Jobs are fed through a bounded asyncio queue to `workers` consumers, each
+    running the blocking `upload(job)` call on a dedicated thread pool with
+    exponential-backoff retries, so network I/O overlaps with parsing of the
+    invoices still in flight. Outcomes are handed to `on_complete` in batches:
+    once `batch_size` have accumulated, or whenever the stage goes idle.
+    """
+
+    def __init__(
+        self,
+        upload: Callable[[dict], Any],
+        on_complete: Callable[[List[UploadOutcome]], Awaitable[None]],
+        workers: int = UPLOAD_WORKERS,
+        queue_size: int = UPLOAD_QUEUE_SIZE,
+        max_retries: int = UPLOAD_MAX_RETRIES,
+        base_delay: float = UPLOAD_RETRY_BASE_DELAY,
+        batch_size: int = DB_BULK_INSERT_CHUNK_SIZE
+    ):
+        self.upload = upload
+        self.on_complete = on_complete
+        self.workers = max(1, workers)
+        self.max_retries = max(1, max_retries)
+        self.base_delay = base_delay
+        self.batch_size = max(1, batch_size)
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, queue_size))
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.tasks: List[asyncio.Task] = []
+        self.pending: List[UploadOutcome] = []
+        self.in_flight = 0
+        self.flush_lock = asyncio.Lock()
+
+    async def __aenter__(self) -> "UploadStage":
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def start(self):
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="upload-stage")
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logger.debug(f"Upload stage started with {self.workers} workers")
+
+    async def submit(self, job: dict):
+        """Queue a job; waits while the queue is full so producers cannot outrun the uploads."""
+        await self.queue.put(job)
+
+    async def close(self):
+        """Finish every queued upload, deliver the remaining outcomes and stop the workers."""
+        await self.queue.join()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        await self._flush()
+        if self.executor:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self.queue.get()
+            self.in_flight += 1
+            try:
+                outcome = await self._upload_with_retry(loop, job)
+                self.in_flight -= 1
+                self.pending.append(outcome)
+                if len(self.pending) >= self.batch_size or (self.queue.empty() and self.in_flight == 0):
+                    await self._flush()
+            finally:
+                self.queue.task_done()
+
+    async def _upload_with_retry(self, loop, job: dict) -> UploadOutcome:
+        for attempt in range(self.max_retries):
+            try:
+                return job, await loop.run_in_executor(self.executor, self.upload, job), None
+            except Exception as e:
+                if attempt == self.max_retries - 1:
+                    logger.error(f"Upload failed after {self.max_retries} attempts: {str(e)}")
+                    return job, None, str(e)
+                delay = self.base_delay * (2 ** attempt)
+                logger.warning(f"Upload attempt {attempt + 1} failed: {str(e)}. Retrying in {delay}s...")
+                await asyncio.sleep(delay)
+
+    async def _flush(self):
+        async with self.flush_lock:
+            batch, self.pending = self.pending, []
+            if not batch:
+                return
+            try:
+                await self.on_complete(batch)
+            except Exception as e:
+                logger.error(f"Upload completion callback failed for {len(batch)} jobs: {str(e)}")